@@ -0,0 +1,154 @@
+"""
+Messages per second of SIPMsgFactory.parse (single pass over bytes, lazy headers) against the
+regex + split parser it replaced (legacy_parse, kept here only), on REGISTER, INVITE with SDP
+and 200 OK corpora. "fast+headers" also touches every header, so nothing stays lazy.
+
+run from the repo root: python -m benchmarks.sip_parse_bench
+"""
+import re
+import sys
+import time
+
+from utils.sdp_class import SDP
+from utils.sip_msgs import SIPMethod, SIPMsgFactory, SIPRequest, SIPResponse, SIPStatusCode, REQUIRED_HEADERS
+
+SIP_VERSION = "SIP/2.0"
+CORPUS_SIZE = 200
+ROUNDS = 20
+
+# the old parser's patterns
+SIP_MSG_PATTERN = r"^.*?\r\n([^:]+:[^\r\n]*\r\n)+\r\n"
+REQUEST_START_LINE_PATTERN = r'^[A-Z]+\ssip:.+\sSIP/\d\.\d'
+RESPONSE_START_LINE_PATTERN = r'^SIP/\d\.\d\s\d+\s[A-Za-z\s]+'
+
+
+def register_corpus():
+    msgs = []
+    for i in range(CORPUS_SIZE):
+        auth = (f'Digest username="user{i}", realm="myserver", nonce="{i:032x}", '
+                f'uri="sip:myserver", response="{i * 7919:032x}"')
+        req = SIPMsgFactory.create_request(SIPMethod.REGISTER, SIP_VERSION, f"user{i}", f"user{i}",
+                                           f"call{i:012d}", 2,
+                                           additional_headers={'authorization': auth, 'expires': '3600',
+                                                               'user-agent': 'bench/1.0'})
+        msgs.append(str(req).encode())
+    return msgs
+
+
+def invite_corpus():
+    msgs = []
+    for i in range(CORPUS_SIZE):
+        sdp = SDP(0, f"10.0.{i // 256}.{i % 256}", SDP.generate_session_id(),
+                  video_port=20000 + i, video_format='h.264', audio_port=30000 + i, audio_format='acc')
+        req = SIPMsgFactory.create_request(SIPMethod.INVITE, SIP_VERSION, f"callee{i}", f"caller{i}",
+                                           f"call{i:012d}", 1, additional_headers={'max-forwards': '70'},
+                                           body=str(sdp))
+        msgs.append(str(req).encode())
+    return msgs
+
+
+def ok_corpus():
+    msgs = []
+    for raw in invite_corpus():
+        req = SIPMsgFactory.parse(raw)
+        res = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK, req.uri, body=req.body)
+        msgs.append(str(res).encode())
+    return msgs
+
+
+def _legacy_can_parse(msg, start_line_pattern):
+    """
+    The old SIPMsg.can_parse - the whole message regex, then a split and a look at every header.
+    """
+    try:
+        if re.match(SIP_MSG_PATTERN, msg):
+            headers_part, body_part = msg.split("\r\n\r\n", 1)
+            lines = headers_part.split("\r\n")
+            if re.match(start_line_pattern, lines[0]):
+                key_set = set()
+                value_set = set()
+                for item in lines[1:]:
+                    key, value = item.split(": ", 1)
+                    key_set.add(key.lower())
+                    value_set.add(value)
+                return not {value for value in value_set if value.strip() == ""}
+    except Exception as err:
+        print(f"something went wrong: {err}")
+    return False
+
+
+def legacy_parse(raw_msg):
+    """
+    The regex + split parser SIPMsgFactory.parse replaced.
+
+    :param raw_msg: The raw SIP message as a string.
+    :type raw_msg: str
+
+    :return: Parsed SIPRequest or SIPResponse object if valid, otherwise None.
+    :rtype: Union[SIPRequest, SIPResponse, None]
+    """
+    is_request = not re.match(r"^SIP", raw_msg)
+    if not _legacy_can_parse(raw_msg, REQUEST_START_LINE_PATTERN if is_request else RESPONSE_START_LINE_PATTERN):
+        return None
+    headers_part, body = raw_msg.split("\r\n\r\n", 1)
+    lines = headers_part.split("\r\n")
+    if is_request:
+        msg = SIPRequest()
+        msg.method, uri, msg.version = lines[0].split()
+        msg.uri = uri.removeprefix("sip:")
+    else:
+        msg = SIPResponse()
+        msg.version, code, _ = lines[0].split(" ", 2)
+        code_num = int(code)
+        for member in SIPStatusCode:
+            if member.value[0] == code_num:
+                msg.status_code = member
+    msg.body = body
+    msg.headers = dict(item.lower().split(": ") for item in lines[1:])
+    msg._strip_essential_headers()
+    return msg
+
+
+def legacy(raw):
+    return legacy_parse(raw.decode())  # the server decoded before parsing
+
+
+def fast(raw):
+    return SIPMsgFactory.parse(raw)
+
+
+def fast_all_headers(raw):
+    msg = SIPMsgFactory.parse(raw)
+    msg.missing_headers(REQUIRED_HEADERS)
+    return msg.headers
+
+
+def rate(parser, corpus):
+    """
+    :return: messages parsed per second
+    :rtype: float
+    """
+    for raw in corpus:
+        parser(raw)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for raw in corpus:
+            parser(raw)
+    return ROUNDS * len(corpus) / (time.perf_counter() - start)
+
+
+def main():
+    corpora = {"REGISTER": register_corpus(), "INVITE+SDP": invite_corpus(), "200 OK": ok_corpus()}
+    for raw in corpora["INVITE+SDP"][:5]:
+        assert dict(fast(raw).headers) == dict(legacy(raw).headers)
+    print(f"{'corpus':<12} {'legacy msg/s':>14} {'fast msg/s':>12} {'fast+headers':>14} {'speedup':>8}")
+    for name, corpus in corpora.items():
+        old = rate(legacy, corpus)
+        new = rate(fast, corpus)
+        full = rate(fast_all_headers, corpus)
+        print(f"{name:<12} {old:>14,.0f} {new:>12,.0f} {full:>14,.0f} {new / old:>7.1f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
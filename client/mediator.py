@@ -97,6 +97,20 @@ class Mediator(MediatorInterface):
         self._ensure_running()
         return self.rtp_manager.get_recv_video()
 
+    def get_local_crypto(self, media):
+        """
+        Get our srtp key of a media type for the sdp.
+        """
+        self._ensure_running()
+        return self.rtp_manager.get_local_crypto(media)
+
+    def set_remote_crypto(self, media, crypto):
+        """
+        Set the srtp key the remote offered for a media type.
+        """
+        self._ensure_running()
+        self.rtp_manager.set_remote_crypto(media, crypto)
+
     # def clear_rtp_ports(self):
     #     """
     #     Clear all RTP ports and reset state.
@@ -67,6 +67,31 @@ class MediatorInterface(ABC):
                 """
             pass
 
+        @abstractmethod
+        def get_local_crypto(self, media):
+            """
+            get our srtp key of a media type, for the sdp
+
+            :param media: 'audio' or 'video'
+            :type media: str
+
+            :returns: the sdp crypto attribute, None if media isn't encrypted
+            :rtype: str or None
+            """
+            pass
+
+        @abstractmethod
+        def set_remote_crypto(self, media, crypto):
+            """
+            set the srtp key the remote sent in its sdp
+
+            :param media: 'audio' or 'video'
+            :type media: str
+            :param crypto: the sdp crypto attribute, None if the remote didn't send one
+            :type crypto: str or None
+            """
+            pass
+
         # sip client -> all
         @abstractmethod
         def start_stream(self):
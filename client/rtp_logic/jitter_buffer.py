@@ -0,0 +1,196 @@
+import heapq
+import time
+
+CLOCK_RATE = 1000  # RTPPacket timestamps are in milliseconds
+MIN_DELAY = 0.02  # seconds of playout delay even on a perfect network
+MAX_DELAY = 0.4  # more delay than this hurts a conversation more than the lost packets do
+JITTER_FACTOR = 4  # playout delay is this many jitters on top of the minimum
+CAPACITY = 512  # packets held at most (~750KB of full size packets)
+MAX_DROPOUT = 3000  # a sequence number jump bigger than this is a restarted stream (rfc 3550 a.1)
+OFFSET_CREEP = 256  # frames it takes the sender to receiver clock offset to follow a slower network
+RESYNC_SECONDS = 2.0  # a transit jump bigger than this is a jump (or wrap) of the sender's clock
+
+
+class JitterBuffer:
+    def __init__(self, clock_rate=CLOCK_RATE, min_delay=MIN_DELAY, max_delay=MAX_DELAY, capacity=CAPACITY,
+                 discard=None):
+        """
+        Reorders received rtp packets and holds them back until their playout time.
+
+        Packets come out in sequence number order (16 bit, wrapping), each once the playout
+        delay after its sender timestamp passed. The delay adapts to the interarrival jitter
+        (the rfc 3550 estimator), between min_delay and max_delay. A missing packet is waited
+        for until the packet after it is due; packets that arrive after their turn passed are
+        discarded, and so are the oldest packets when more than capacity are held. Packets the
+        buffer drops itself (overflow, a new stream) go to discard, so pooled packets can be reused.
+
+        :param clock_rate: Timestamp units per second
+        :type clock_rate: int
+        :param min_delay: Smallest playout delay, seconds
+        :type min_delay: float
+        :param max_delay: Largest playout delay, seconds
+        :type max_delay: float
+        :param capacity: Most packets held
+        :type capacity: int
+        :param discard: Called with every held packet that is dropped instead of played
+        :type discard: callable or None
+        """
+        self.clock_rate = clock_rate
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self.discard = discard
+        self.packets = {}
+        # stats, for the whole life of the buffer
+        self.received = 0
+        self.late = 0  # arrived after their turn
+        self.duplicates = 0
+        self.lost = 0  # never arrived in time, skipped
+        self.overflow = 0  # discarded because the buffer was full
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the stream - the next packet starts a new one.
+        """
+        if self.discard:
+            for packet in self.packets.values():
+                self.discard(packet)
+        self.ssrc = None
+        self.packets = {}  # extended sequence number -> RTPPacket
+        self.heap = []  # extended sequence numbers held
+        self.next_seq = None  # extended sequence number of the next packet to play
+        self.highest = None  # highest extended sequence number received
+        self.jitter = 0.0  # interarrival jitter, seconds
+        self.last_transit = None
+        self.last_timestamp = None
+        self.offset = None  # low estimate of the transit (arrival - sender time), maps sender time to ours
+        self.delay = self.min_delay
+
+    def _extend(self, seq):
+        """
+        :return: The sequence number with the wrap count above its 16 bits, guessed from the highest one
+        :rtype: int
+        """
+        if self.highest is None:
+            return seq | 0x10000  # a cycle up, so packets from before the first one don't go negative
+        ext = (self.highest & ~0xFFFF) | seq
+        if ext - self.highest > 0x8000:
+            ext -= 0x10000
+        elif self.highest - ext > 0x8000:
+            ext += 0x10000
+        return ext
+
+    def _update_delay(self, timestamp, now):
+        """
+        Jitter estimate of rfc 3550 6.4.1 and the playout delay it gives. Only the first packet
+        of a frame counts - the fragments of a frame share its timestamp but not its arrival.
+        """
+        if timestamp == self.last_timestamp:
+            return
+        self.last_timestamp = timestamp
+        transit = now - timestamp / self.clock_rate
+        if self.last_transit is not None:
+            d = abs(transit - self.last_transit)
+            if d > RESYNC_SECONDS:
+                self.last_transit = self.offset = transit  # the sender's clock jumped
+                return
+            self.jitter += (d - self.jitter) / 16
+        self.last_transit = transit
+        if self.offset is None or transit < self.offset:
+            self.offset = transit
+        else:
+            # creep up, or a receiver clock that runs faster than the sender's leaves no delay at all
+            self.offset += (transit - self.offset) / OFFSET_CREEP
+        self.delay = min(self.min_delay + JITTER_FACTOR * self.jitter, self.max_delay)
+
+    def put(self, packet, now=None):
+        """
+        Add a received packet.
+
+        :param packet: The packet
+        :type packet: RTPPacket
+        :param now: Arrival time (time.monotonic), now if None
+        :type now: float or None
+
+        :return: True if it was kept, False if it was late or a duplicate
+        :rtype: bool
+        """
+        now = time.monotonic() if now is None else now
+        if packet.ssrc != self.ssrc:
+            self.reset()
+            self.ssrc = packet.ssrc
+        ext = self._extend(packet.sequence_number)
+        if self.next_seq is not None and abs(ext - self.next_seq) > MAX_DROPOUT:
+            # the sender restarted its sequence numbers - start over
+            self.reset()
+            self.ssrc = packet.ssrc
+            ext = self._extend(packet.sequence_number)
+        self.received += 1
+        self._update_delay(packet.timestamp, now)
+        if self.next_seq is None:
+            self.next_seq = ext
+        if ext < self.next_seq:
+            self.late += 1
+            return False
+        if ext in self.packets:
+            self.duplicates += 1
+            return False
+        self.packets[ext] = packet
+        heapq.heappush(self.heap, ext)
+        if self.highest is None or ext > self.highest:
+            self.highest = ext
+        while len(self.packets) > self.capacity:
+            dropped = self._release()
+            self.overflow += 1
+            if self.discard:
+                self.discard(dropped)
+        return True
+
+    def _playout_time(self, packet):
+        return packet.timestamp / self.clock_rate + self.offset + self.delay
+
+    def _release(self):
+        ext = heapq.heappop(self.heap)
+        if ext > self.next_seq:
+            self.lost += ext - self.next_seq  # gave up on them
+        self.next_seq = ext + 1
+        return self.packets.pop(ext)
+
+    def wait_time(self, now=None):
+        """
+        :return: Seconds until the next packet is due (0 if it is), None if the buffer is empty
+        :rtype: float or None
+        """
+        if not self.heap:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(self._playout_time(self.packets[self.heap[0]]) - now, 0.0)
+
+    def pop(self, now=None):
+        """
+        :return: The next packet in sequence order if its playout time came, else None
+        :rtype: RTPPacket or None
+        """
+        if not self.heap:
+            return None
+        now = time.monotonic() if now is None else now
+        if self._playout_time(self.packets[self.heap[0]]) > now:
+            return None
+        return self._release()
+
+    def drain(self, now=None):
+        """
+        :return: All the packets that are due, in sequence order
+        :rtype: list[RTPPacket]
+        """
+        now = time.monotonic() if now is None else now
+        packets = []
+        while True:
+            packet = self.pop(now)
+            if packet is None:
+                return packets
+            packets.append(packet)
+
+    def __len__(self):
+        return len(self.packets)
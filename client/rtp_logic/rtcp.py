@@ -0,0 +1,420 @@
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+
+#     RTCP (rfc 3550 6) - every report is a compound packet: SR or RR first, then SDES CNAME.
+#     0                   1                   2                   3
+#     0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+#    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#    |V=2|P|    RC   |   PT=SR=200   |             length            |
+#    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#    |                         SSRC of sender                        |
+#    +=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+
+#    |       NTP timestamp, most and least significant word          |
+#    |                         RTP timestamp                         |
+#    |                     sender's packet count                     |
+#    |                      sender's octet count                     |
+#    +=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+=+
+#    |                 report blocks (SSRC, fraction lost,           |
+#    |      cumulative lost, highest seq, jitter, LSR, DLSR)         |
+#    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#     an RR is the same without the sender info.
+
+RTCP_VERSION = 2
+PT_SR = 200
+PT_RR = 201
+PT_SDES = 202
+PT_BYE = 203
+SDES_CNAME = 1
+
+RTCP_INTERVAL = 5.0  # seconds between reports (rfc 3550 6.2 minimum), randomized by +-50%
+CLOCK_RATE = 1000  # RTPPacket timestamps are in milliseconds
+MAX_DROPOUT = 3000  # a bigger sequence number jump is a restarted stream
+MAX_MISORDER = 100
+NTP_OFFSET = 2208988800  # seconds from 1900 to 1970
+
+_HEADER = struct.Struct('!BBHI')  # first byte, packet type, length in words - 1, ssrc
+_SENDER_INFO = struct.Struct('!IIIII')  # ntp msw, ntp lsw, rtp timestamp, packets, octets
+_REPORT_BLOCK = struct.Struct('!IIIIII')  # ssrc, fraction lost + cumulative lost, highest seq, jitter, lsr, dlsr
+
+
+def ntp_time(now=None):
+    """
+    :return: The 64 bit ntp timestamp of a time.time()
+    :rtype: int
+    """
+    now = time.time() if now is None else now
+    return int((now + NTP_OFFSET) * (1 << 32))
+
+
+def ntp_middle(ntp):
+    """
+    :return: The middle 32 bits of a ntp timestamp, the form of lsr and round trip times (1/65536 seconds)
+    :rtype: int
+    """
+    return (ntp >> 16) & 0xFFFFFFFF
+
+
+def build_report(ssrc, blocks, sender_info=None, cname=None):
+    """
+    Build a compound rtcp packet - an SR (if sender_info is given) or an RR, then SDES CNAME.
+
+    :param ssrc: Our ssrc
+    :type ssrc: int
+    :param blocks: Report blocks, (ssrc, fraction lost, cumulative lost, highest seq, jitter, lsr, dlsr)
+    :type blocks: list[tuple]
+    :param sender_info: (ntp timestamp, rtp timestamp, packet count, octet count) or None
+    :type sender_info: tuple or None
+    :param cname: Canonical name of the source
+    :type cname: str or None
+
+    :return: The packet
+    :rtype: bytes
+    """
+    body = b''
+    if sender_info is not None:
+        ntp, rtp_ts, packets, octets = sender_info
+        body += _SENDER_INFO.pack(ntp >> 32, ntp & 0xFFFFFFFF, rtp_ts & 0xFFFFFFFF,
+                                  packets & 0xFFFFFFFF, octets & 0xFFFFFFFF)
+    for source, fraction, lost, highest, jitter, lsr, dlsr in blocks[:31]:
+        lost = max(min(lost, 0x7FFFFF), -0x800000) & 0xFFFFFF  # 24 bit signed
+        body += _REPORT_BLOCK.pack(source, (fraction & 0xFF) << 24 | lost, highest & 0xFFFFFFFF,
+                                   int(jitter) & 0xFFFFFFFF, lsr, dlsr)
+    packet_type = PT_SR if sender_info is not None else PT_RR
+    packet = _HEADER.pack(RTCP_VERSION << 6 | min(len(blocks), 31), packet_type,
+                          (_HEADER.size + len(body)) // 4 - 1, ssrc) + body
+    if cname:
+        packet += _build_sdes(ssrc, cname)
+    return packet
+
+
+def _build_sdes(ssrc, cname):
+    name = cname.encode()[:255]
+    chunk = struct.pack('!IBB', ssrc, SDES_CNAME, len(name)) + name + b'\x00'  # the end item
+    chunk += b'\x00' * (-len(chunk) % 4)
+    return struct.pack('!BBH', RTCP_VERSION << 6 | 1, PT_SDES, len(chunk) // 4) + chunk
+
+
+def build_bye(ssrc):
+    """
+    :return: A compound packet that says the source left - an empty RR and the BYE
+    :rtype: bytes
+    """
+    return build_report(ssrc, []) + _HEADER.pack(RTCP_VERSION << 6 | 1, PT_BYE, 1, ssrc)
+
+
+def parse_compound(data):
+    """
+    Parse the packets of a compound rtcp packet. Unknown packet types are skipped.
+
+    :param data: The received datagram
+    :type data: bytes
+
+    :return: dicts with 'type' and 'ssrc', 'sender_info' (ntp, rtp timestamp, packets, octets)
+             for an SR, 'blocks' (as in build_report) for an SR or RR. None if it is malformed
+    :rtype: list[dict] or None
+    """
+    packets = []
+    pos = 0
+    while pos + _HEADER.size <= len(data):
+        first, packet_type, length, ssrc = _HEADER.unpack_from(data, pos)
+        end = pos + (length + 1) * 4
+        if first >> 6 != RTCP_VERSION or end > len(data):
+            return None
+        packet = {'type': packet_type, 'ssrc': ssrc}
+        if packet_type in (PT_SR, PT_RR):
+            offset = pos + _HEADER.size
+            if packet_type == PT_SR:
+                if offset + _SENDER_INFO.size > end:
+                    return None
+                msw, lsw, rtp_ts, count, octets = _SENDER_INFO.unpack_from(data, offset)
+                packet['sender_info'] = (msw << 32 | lsw, rtp_ts, count, octets)
+                offset += _SENDER_INFO.size
+            blocks = []
+            for _ in range(first & 0x1F):
+                if offset + _REPORT_BLOCK.size > end:
+                    return None
+                source, lost_word, highest, jitter, lsr, dlsr = _REPORT_BLOCK.unpack_from(data, offset)
+                lost = lost_word & 0xFFFFFF
+                if lost & 0x800000:
+                    lost -= 0x1000000
+                blocks.append((source, lost_word >> 24, lost, highest, jitter, lsr, dlsr))
+                offset += _REPORT_BLOCK.size
+            packet['blocks'] = blocks
+        packets.append(packet)
+        pos = end
+    return packets if pos == len(data) and packets else None
+
+
+class StreamStats:
+    # sent - written by the sending process
+    PACKETS, OCTETS = range(2)
+    # received - written by the receiving process
+    R_SSRC, R_BASE, R_HIGHEST, R_RECEIVED, R_JITTER, R_ACTIVE = range(6)
+    # report - what the remote said about our stream, written by the rtcp session
+    FRACTION_LOST, CUMULATIVE_LOST, REMOTE_JITTER, RTT, REMOTE_HIGHEST, UPDATED = range(6)
+
+    def __init__(self, ssrc=None, clock_rate=CLOCK_RATE):
+        """
+        Statistics of one media stream (audio or video) in both directions, in shared memory:
+        the sending and receiving processes count their packets, the rtcp session reads them
+        for its reports and writes back what the remote reported. Plain unlocked arrays - a
+        report read in the middle of an update is off by a packet at most.
+
+        :param ssrc: The ssrc we send with, random if None
+        :type ssrc: int or None
+        :param clock_rate: Timestamp units per second
+        :type clock_rate: int
+        """
+        self.ssrc = ssrc if ssrc is not None else random.getrandbits(32)
+        self.clock_rate = clock_rate
+        self.sent = RawArray('d', 2)
+        self.received = RawArray('d', 6)
+        self.report = RawArray('d', 6)
+        # only used by the receiving process
+        self._max_seq = None
+        self._cycles = 0
+        self._transit = None
+        self._jitter = 0.0
+
+    def on_send(self, packets, octets):
+        """
+        :param packets: Packets sent
+        :type packets: int
+        :param octets: Payload bytes in them
+        :type octets: int
+        """
+        self.sent[self.PACKETS] += packets
+        self.sent[self.OCTETS] += octets
+
+    def on_receive(self, ssrc, seq, timestamp, arrival=None):
+        """
+        Count a received packet - sequence number extension of rfc 3550 a.1 and the jitter
+        estimate of a.8.
+
+        :param ssrc: The packet's ssrc
+        :param seq: Its sequence number
+        :param timestamp: Its timestamp
+        :param arrival: Arrival time (time.monotonic), now if None
+        """
+        arrival = time.monotonic() if arrival is None else arrival
+        received = self.received
+        if not received[self.R_ACTIVE] or ssrc != received[self.R_SSRC]:
+            self._restart(ssrc, seq)
+        else:
+            delta = (seq - self._max_seq) & 0xFFFF
+            if delta < MAX_DROPOUT:
+                if seq < self._max_seq:
+                    self._cycles += 0x10000
+                self._max_seq = seq
+            elif delta <= 0x10000 - MAX_MISORDER:
+                self._restart(ssrc, seq)  # a jump - the sender restarted
+            # else a duplicate or reordered packet, counts but doesn't move the highest
+        received[self.R_HIGHEST] = self._cycles + self._max_seq
+        received[self.R_RECEIVED] += 1
+
+        transit = arrival * self.clock_rate - timestamp
+        if self._transit is not None:
+            d = abs(transit - self._transit)
+            self._jitter += (d - self._jitter) / 16
+            received[self.R_JITTER] = self._jitter
+        self._transit = transit
+
+    def _restart(self, ssrc, seq):
+        received = self.received
+        self._max_seq = seq
+        self._cycles = 0
+        self._transit = None
+        self._jitter = 0.0
+        received[self.R_SSRC] = ssrc
+        received[self.R_BASE] = seq
+        received[self.R_RECEIVED] = 0
+        received[self.R_JITTER] = 0
+        received[self.R_ACTIVE] = 1
+
+    def remote_report(self):
+        """
+        :return: What the remote last reported about our stream - fraction_lost (0-1),
+                 cumulative_lost, jitter and rtt (seconds), highest_seq. None before the first report
+        :rtype: dict or None
+        """
+        report = list(self.report)
+        if not report[self.UPDATED]:
+            return None
+        return {'fraction_lost': report[self.FRACTION_LOST],
+                'cumulative_lost': int(report[self.CUMULATIVE_LOST]),
+                'jitter': report[self.REMOTE_JITTER],
+                'rtt': report[self.RTT] if report[self.RTT] >= 0 else None,
+                'highest_seq': int(report[self.REMOTE_HIGHEST]),
+                'updated': report[self.UPDATED]}
+
+    def local_report(self):
+        """
+        :return: Our side of the stream - packets and octets sent, and received, lost (expected
+                 minus received) and jitter (seconds) of what we receive
+        :rtype: dict
+        """
+        sent, received = list(self.sent), list(self.received)
+        expected = received[self.R_HIGHEST] - received[self.R_BASE] + 1 if received[self.R_ACTIVE] else 0
+        return {'packets_sent': int(sent[self.PACKETS]),
+                'octets_sent': int(sent[self.OCTETS]),
+                'packets_received': int(received[self.R_RECEIVED]),
+                'packets_lost': int(expected - received[self.R_RECEIVED]),
+                'jitter': received[self.R_JITTER] / self.clock_rate}
+
+
+class RTCPSession:
+    def __init__(self, stats, local_port=0, remote_addr=None, cname=None, interval=RTCP_INTERVAL):
+        """
+        Sends sender / receiver reports about a stream to the remote's rtcp port and reads the
+        remote's reports - loss, jitter and the round trip time of our stream go to the stats.
+
+        :param stats: The stream
+        :type stats: StreamStats
+        :param local_port: Our rtcp port (rtp port + 1), 0 for any
+        :type local_port: int
+        :param remote_addr: The remote's rtcp address (ip, rtp port + 1), learned from its reports if None
+        :type remote_addr: tuple or None
+        :param cname: Canonical name for the SDES
+        :type cname: str or None
+        :param interval: Mean seconds between reports
+        :type interval: float
+        """
+        self.stats = stats
+        self.remote_addr = remote_addr
+        self.cname = cname or f"{stats.ssrc:08x}@{socket.gethostname()}"
+        self.interval = interval
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('0.0.0.0', local_port))
+
+        self.running = False
+        self.thread = None
+
+        self.last_sr = 0  # middle of the ntp timestamp of the remote's last SR (lsr)
+        self.last_sr_time = None  # when it came (time.time)
+        # expected / received at the last report, for the fraction lost of the next interval
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.remote_ssrc = None
+        self.bye = False  # the remote left
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Tell the remote we left and stop.
+        """
+        if not self.running:
+            return
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1.0)
+        try:
+            if self.remote_addr:
+                self.socket.sendto(build_bye(self.stats.ssrc), self.remote_addr)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def _next_interval(self):
+        # randomized so the participants don't send in sync (rfc 3550 6.3.1)
+        return self.interval * random.uniform(0.5, 1.5)
+
+    def _loop(self):
+        next_report = time.monotonic() + self._next_interval() / 2  # the first one comes early
+        while self.running:
+            try:
+                wait = max(next_report - time.monotonic(), 0)
+                if select.select([self.socket], [], [], min(wait, 0.5))[0]:
+                    data, addr = self.socket.recvfrom(2048)
+                    self.handle(data, addr)
+                if time.monotonic() >= next_report:
+                    self.send_report()
+                    next_report = time.monotonic() + self._next_interval()
+            except Exception as e:
+                print(f"Error in rtcp loop: {e}")
+
+    def build(self, now=None):
+        """
+        :return: Our report - an SR if we sent media, else an RR
+        :rtype: bytes
+        """
+        now = time.time() if now is None else now
+        stats = self.stats
+        sent, received = list(stats.sent), list(stats.received)
+        sender_info = None
+        if sent[stats.PACKETS]:
+            # our timestamps are wall clock milliseconds, so the rtp timestamp of now is known
+            sender_info = (ntp_time(now), int(now * 1000) & 0xFFFFFFF, int(sent[stats.PACKETS]),
+                           int(sent[stats.OCTETS]))
+        blocks = []
+        if received[stats.R_ACTIVE]:
+            expected = int(received[stats.R_HIGHEST] - received[stats.R_BASE]) + 1
+            count = int(received[stats.R_RECEIVED])
+            expected_interval = expected - self.expected_prior
+            lost_interval = expected_interval - (count - self.received_prior)
+            self.expected_prior, self.received_prior = expected, count
+            fraction = (lost_interval << 8) // expected_interval if expected_interval > 0 and lost_interval > 0 else 0
+            dlsr = 0
+            if self.last_sr_time is not None:
+                dlsr = int((now - self.last_sr_time) * 65536) & 0xFFFFFFFF
+            blocks.append((int(received[stats.R_SSRC]), min(fraction, 255), expected - count,
+                           int(received[stats.R_HIGHEST]), received[stats.R_JITTER], self.last_sr, dlsr))
+        return build_report(stats.ssrc, blocks, sender_info, self.cname)
+
+    def send_report(self):
+        if self.remote_addr:
+            self.socket.sendto(self.build(), self.remote_addr)
+
+    def handle(self, data, addr, now=None):
+        """
+        Take in a received rtcp packet.
+
+        :param data: The datagram
+        :type data: bytes
+        :param addr: Where it came from
+        :type addr: tuple
+        :param now: Arrival time (time.time), now if None
+        :type now: float or None
+        """
+        packets = parse_compound(data)
+        if packets is None:
+            return
+        now = time.time() if now is None else now
+        if self.remote_addr is None:
+            self.remote_addr = addr  # symmetric rtcp
+        stats = self.stats
+        for packet in packets:
+            if packet['type'] == PT_BYE:
+                self.bye = True
+                continue
+            if 'sender_info' in packet:
+                self.remote_ssrc = packet['ssrc']
+                self.last_sr = ntp_middle(packet['sender_info'][0])
+                self.last_sr_time = now
+            for source, fraction, lost, highest, jitter, lsr, dlsr in packet.get('blocks', ()):
+                if source != stats.ssrc:
+                    continue
+                rtt = -1
+                if lsr:
+                    # rfc 3550 6.4.1 - arrival - lsr - dlsr, all in 1/65536 seconds
+                    rtt = ((ntp_middle(ntp_time(now)) - lsr - dlsr) & 0xFFFFFFFF) / 65536
+                    if rtt > 60:
+                        rtt = -1  # the clocks / counters don't add up
+                report = stats.report
+                report[stats.FRACTION_LOST] = fraction / 256
+                report[stats.CUMULATIVE_LOST] = lost
+                report[stats.REMOTE_JITTER] = jitter / stats.clock_rate
+                report[stats.RTT] = rtt
+                report[stats.REMOTE_HIGHEST] = highest
+                report[stats.UPDATED] = now
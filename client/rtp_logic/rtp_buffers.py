@@ -0,0 +1,160 @@
+from collections import deque
+
+from utils.RTP_msgs import RTP_HEADER
+
+FRAME_BUFFER_SIZE = 16 * 1024  # first size of a frame buffer, grown (and kept grown) for bigger frames
+
+
+class Pool:
+    def __init__(self, factory, limit):
+        """
+        Free list of reusable objects (packet slots, frame buffers).
+
+        :param factory: Makes a new object when the pool is empty
+        :type factory: callable
+        :param limit: Most free objects kept, the rest are left to the garbage collector
+        :type limit: int
+        """
+        self.factory = factory
+        self.limit = limit
+        self.free = deque()
+        self.created = 0
+
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            self.created += 1
+            return self.factory()
+
+    def release(self, obj):
+        if len(self.free) < self.limit:
+            self.free.append(obj)
+
+
+class RTPPacketSlot:
+    __slots__ = ('buffer', 'view', 'marker', 'payload_type', 'sequence_number', 'timestamp', 'ssrc', 'payload')
+
+    def __init__(self, size):
+        """
+        A received rtp packet in a reusable buffer - the socket receives straight into it and
+        the payload is a view of it, so receiving a packet allocates nothing.
+
+        :param size: Largest packet
+        :type size: int
+        """
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.marker = False
+        self.payload_type = 0
+        self.sequence_number = 0
+        self.timestamp = 0
+        self.ssrc = 0
+        self.payload = None
+
+    def decode(self, size):
+        """
+        Decode the header of the packet in the first size bytes of the buffer.
+
+        :param size: Size of the packet
+        :type size: int
+
+        :return: True if decoding succeeded, False if packet is malformed
+        :rtype: bool
+        """
+        if size < RTP_HEADER.size:
+            return False
+        first_byte, second_byte, self.sequence_number, self.timestamp, self.ssrc = RTP_HEADER.unpack_from(self.buffer)
+        end = size
+        if first_byte & 0x20:  # padding, its size is the last byte
+            padding_size = self.buffer[size - 1]
+            if padding_size > size - RTP_HEADER.size:
+                return False
+            end -= padding_size
+        self.marker = bool(second_byte & 0x80)
+        self.payload_type = second_byte & 0x7F
+        self.payload = self.view[RTP_HEADER.size:end]
+        return True
+
+
+class RTPFrame:
+    __slots__ = ('timestamp', 'ssrc', 'payload_type', 'payload', '_buffer', '_pool')
+
+    def __init__(self, buffer, size, timestamp, ssrc, payload_type, pool):
+        """
+        A reassembled frame. The payload is a view of a pooled buffer - call release() once
+        done with it (copy it first if it has to live longer).
+        """
+        self.timestamp = timestamp
+        self.ssrc = ssrc
+        self.payload_type = payload_type
+        self.payload = memoryview(buffer)[:size]
+        self._buffer = buffer
+        self._pool = pool
+
+    def release(self):
+        """
+        Give the buffer back for the next frames. The payload can't be used after this.
+        """
+        if self._buffer is None:
+            return
+        try:
+            self.payload.release()
+        except BufferError:
+            pass  # someone still holds a view of it - leave the buffer to them
+        else:
+            self._pool.release(self._buffer)
+        self._buffer = None
+
+
+class FrameAssembler:
+    def __init__(self, pool):
+        """
+        Builds frames from their packets in order - every payload is copied once, to its
+        offset in a pooled frame buffer.
+
+        :param pool: Pool of frame buffers (bytearray)
+        :type pool: Pool
+        """
+        self.pool = pool
+        self.buffer = None  # of the frame being built
+        self.size = 0
+        self.first = None  # header of the frame's first packet (timestamp, ssrc, payload type)
+
+    def start(self, packet):
+        self.buffer = self.pool.acquire()
+        self.size = 0
+        self.first = (packet.timestamp, packet.ssrc, packet.payload_type)
+        self.append(packet)
+
+    def append(self, packet):
+        end = self.size + len(packet.payload)
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+        self.buffer[self.size:end] = packet.payload
+        self.size = end
+
+    def finish(self):
+        """
+        :return: The built frame
+        :rtype: RTPFrame
+        """
+        frame = RTPFrame(self.buffer, self.size, *self.first, self.pool)
+        self.buffer = None
+        return frame
+
+    def drop(self):
+        """
+        Give up on the frame being built.
+        """
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+    @property
+    def building(self):
+        return self.buffer is not None
+
+    @property
+    def timestamp(self):
+        return self.first[0]
@@ -3,14 +3,21 @@ import random
 import socket
 import threading
 
+from client.rtp_logic.jitter_buffer import CAPACITY, JitterBuffer
+from client.rtp_logic.rtp_buffers import FRAME_BUFFER_SIZE, FrameAssembler, Pool, RTPPacketSlot
+from utils.datagram_batch import MAX_BATCH, DatagramBatcher
 from utils.RTP_msgs import *
+from utils.encryption.srtp import SRTP_TAG_SIZE
 
 MAX_PACKET_SIZE = int(1500)
+RECEIVE_QUEUE_SIZE = 64  # frames waiting for the player, older ones are dropped when it falls behind
+RECV_TIMEOUT = 0.5  # longest wait on the socket, so the running flag is checked
+RECV_BATCH = 32  # packets taken off the socket per system call
 
 
 class RTPHandler:
 
-    def __init__(self, send_ip, ssrc=None, listen_port=None, send_port=None):
+    def __init__(self, send_ip, ssrc=None, listen_port=None, send_port=None, srtp=None, stats=None):
         self.running = False
         self.send_ip = send_ip
         self.listen_port = listen_port
@@ -18,13 +25,20 @@ class RTPHandler:
 
         self.receive_lock = threading.Lock()
 
-        # RTPPacket objs
-        self.receive_queue = queue.Queue()
-        self.recv_payload = None
+        # RTPFrame objs - release() them when done
+        self.receive_queue = queue.Queue(maxsize=RECEIVE_QUEUE_SIZE)
+        # received packets and frames live in reused buffers - enough for a full jitter buffer and queue
+        self.packet_pool = Pool(lambda: RTPPacketSlot(MAX_PACKET_SIZE), CAPACITY)
+        # reorders the received packets and paces them by their timestamps, what it drops goes back to the pool
+        self.jitter_buffer = JitterBuffer(discard=self.packet_pool.release)
+        self.frame_pool = Pool(lambda: bytearray(FRAME_BUFFER_SIZE), RECEIVE_QUEUE_SIZE + 2)
+        self.assembler = FrameAssembler(self.frame_pool)
 
         # should be thread safe if 1 thread is reading only and one is writing only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 20)
+        # a frame's packets go out in one sendmmsg and arrive with one recvmmsg
+        self.batcher = DatagramBatcher(self.socket, max(MAX_BATCH, RECV_BATCH))
 
         self.receive_thread = None
         self.send_thread = None
@@ -33,6 +47,19 @@ class RTPHandler:
         self.remote_seq = None
         self.ssrc = ssrc if ssrc else random.randint(0, 50000) # identifies src
 
+        # media encryption (SRTPContext) - the sending key or the remote's key when receiving
+        self.srtp = srtp
+        self.overhead = SRTP_TAG_SIZE if srtp else 0  # bytes added to every packet
+        self.dropped = 0  # received packets that failed authentication or were replayed
+        # StreamStats shared with the rtcp session - counts what is sent and received
+        self.stats = stats
+
+        self.packetizer = RTPPacketizer(self.ssrc, MAX_PACKET_SIZE - RTP_HEADER.size - self.overhead)
+        self.send_buffers = []  # srtp packets are encrypted in these, grown to the biggest frame
+        # slots the next received packets go into - a filled one is swapped for a free one
+        self.recv_slots = []
+        self.recv_buffers = []
+
     def start(self):
         """
         Start the RTP handler: binds socket if in receive mode and starts receive thread.
@@ -72,128 +99,160 @@ class RTPHandler:
             #     self.my_seq += 1
             #     return
 
-            # packet: RTPPacket
-            # packet.sequence_number = self.my_seq
             # if packet is bigger than mmu split packet
-            pkts = self._build_packets(data)
-            for pkt in pkts:
-                pkt.sequence_number = self.my_seq
-                self.my_seq += 1
-                self.socket.sendto(pkt.build_packet(), (self.send_ip, self.send_port))
+            bounds = self.packetizer.packetize(data, self.my_seq, rtp_timestamp())
+            if self.srtp:
+                self.batcher.send(self._protect(data, bounds), (self.send_ip, self.send_port))
+            else:
+                # gathered from the header and the payload slice, nothing is copied
+                self.batcher.send_split(self.packetizer.headers, RTP_HEADER.size, data, bounds,
+                                        (self.send_ip, self.send_port))
+            self.my_seq += len(bounds)  # my_seq keeps counting - it's the srtp index
+            if self.stats:
+                self.stats.on_send(len(bounds), len(data))
         except Exception as e:
             print(f"Error in send loop: {e}")
 
+    def _protect(self, data, bounds):
+        """
+        Encrypt all the packets of a frame as one batch, each in a reused send buffer.
+
+        :param data: the frame
+        :type data: bytes
+        :param bounds: the payload bounds of its packets, their headers are in the packetizer
+        :type bounds: list[tuple]
+
+        :return: the srtp packets as datagrams for the batcher
+        :rtype: list[tuple]
+        """
+        while len(self.send_buffers) < len(bounds):
+            self.send_buffers.append(bytearray(MAX_PACKET_SIZE))
+        headers = self.packetizer.headers
+        packets = []
+        for i, (start, end) in enumerate(bounds):
+            buf = self.send_buffers[i]
+            size = RTP_HEADER.size + end - start
+            buf[:RTP_HEADER.size] = headers[i * RTP_HEADER.size:(i + 1) * RTP_HEADER.size]
+            buf[RTP_HEADER.size:size] = data[start:end]
+            packets.append(memoryview(buf)[:size + self.overhead])  # room for the auth tag
+        protected = self.srtp.protect_batch(packets, range(self.my_seq, self.my_seq + len(bounds)))
+        return [((packet, 0, len(packet)),) for packet in protected]
+
     def _receive_loop(self):
         """
-        Internal thread function that continuously receives RTP packets and reassembles full frames.
+        Internal thread function that continuously receives RTP packets, passes them through
+        the jitter buffer and reassembles full frames from what it releases.
         """
         while self.running:
             try:
-                # Set a timeout so we can check running flag periodically
-                self.socket.settimeout(0.5)
-                try:
-                    data, addr = self.socket.recvfrom(MAX_PACKET_SIZE)  # Max UDP packet size
-                    # self.receive_queue.put(data) # thread safe
-
-                    # build fragmented packets, only add a full frame
-                    packet = RTPPacket()
-                    if packet.decode_packet(data):
-                        # print(packet)
-                        # Case 1: A previous frame is being built
-                        if self.recv_payload:
-                            # If the timestamp changed, drop the old frame
-                            if packet.sequence_number != self.remote_seq:
-                                print(f"Dropped incomplete frame: {self.recv_payload}")
-                                self.recv_payload = None
-
-                            # If packet belongs to current frame but is not the expected sequence number, drop frame
-                            elif packet.sequence_number != self.remote_seq:
-                                print(f"Missing packet, dropped frame: {self.recv_payload}")
-                                self.recv_payload = None
-
-                        # Continue based on whether this is a marker (last fragment) or not
-                        if packet.marker:
-                            if self.recv_payload:
-                                # Append and complete the current frame
-                                self.recv_payload.payload += packet.payload
-                                self.receive_queue.put(self.recv_payload)
-                                self.recv_payload = None
-                                self.remote_seq = None
-                            else:
-                                # Full packet in one go, no fragmentation
-                                self.receive_queue.put(packet)
-                        else:
-                            # Intermediate or first fragment
-                            if self.recv_payload:
-                                # Append fragment
-                                self.recv_payload.payload += packet.payload
-                                self.remote_seq += 1
-                            else:
-                                # Start a new fragmented frame
-                                self.recv_payload = packet
-                                self.remote_seq = packet.sequence_number + 1
-
-                except socket.timeout:
-                    continue
-
-                # Parse the received packet
+                # wake up when the next buffered packet is due, and check the running flag periodically
+                wait = self.jitter_buffer.wait_time()
+                self._receive_packets(RECV_TIMEOUT if wait is None else min(max(wait, 0.001), RECV_TIMEOUT))
+
+                for packet in self.jitter_buffer.drain():
+                    self._reassemble(packet)
+
             except Exception as e:
                 print(f"Error in receive loop: {e}")
                 print(self.remote_seq)
 
+    def _receive_packets(self, timeout):
+        """
+        Receive the waiting packets straight into pooled slots and hand them to the jitter buffer.
+
+        :param timeout: longest wait for the first packet, seconds
+        :type timeout: float
+        """
+        while len(self.recv_slots) < RECV_BATCH:
+            slot = self.packet_pool.acquire()
+            self.recv_slots.append(slot)
+            self.recv_buffers.append(slot.buffer)
+        # the same buffer list every time, so the batcher doesn't set them up again
+        sizes = self.batcher.recv_into(self.recv_buffers, timeout)
+        for i, size in enumerate(sizes):
+            slot = self.recv_slots[i]
+            if self._accept(slot, size):
+                # the jitter buffer holds on to it - take a free slot in its place
+                slot = self.recv_slots[i] = self.packet_pool.acquire()
+                self.recv_buffers[i] = slot.buffer
+
+    def _accept(self, slot, size):
+        """
+        Decrypt and decode a received packet in place and give it to the jitter buffer.
+
+        :return: True if the jitter buffer kept it, False if the slot is free again
+        :rtype: bool
+        """
+        if self.srtp:
+            plain = self.srtp.unprotect(slot.view[:size])  # in place
+            if plain is None:
+                self.dropped += 1
+                return False
+            size = len(plain)
+        if not slot.decode(size):
+            return False
+        if self.stats:
+            self.stats.on_receive(slot.ssrc, slot.sequence_number, slot.timestamp)
+        return self.jitter_buffer.put(slot)
+
+    def _reassemble(self, packet):
+        """
+        Build fragmented packets, only add a full frame. Packets come in order from the jitter
+        buffer, so a sequence gap means a packet was lost.
 
-    def _build_packets(self, payload):
-        """
-        Build one or more RTP packets from a given payload, splitting if necessary.
-
-        :param payload: the full payload to be sent in RTP format (e.g., video frame)
-        :type payload: bytes
-
-        :return: list of RTPPacket objects, each containing part of the payload
-        :rtype: list[RTPPacket]
-        """
-        to_send = []
-        timestamp = RTPPacket().timestamp
-        m = RTPPacket()
-        m.payload = payload
-        # print(len(payload))
-        if len(m.build_packet()) > MAX_PACKET_SIZE:
-            header_size = len(RTPPacket().build_packet())
-            # Set the max payload size that ensures the full packet stays within limit
-            max_payload_size = MAX_PACKET_SIZE - header_size
-            # print(max_payload_size)
-
-            # Split the payload into safe-sized chunks
-            payloads = [payload[i:i + max_payload_size] for i in
-                        range(0, len(payload), max_payload_size)]
-            # print(len(payloads))
-
-            for payload1 in payloads[:-1]:  # All except the last
-                packet = RTPPacket(
-                    timestamp = timestamp,
-                    ssrc = self.ssrc
-                )
-                packet.payload = payload1
-                packet.marker = False
-                to_send.append(packet)
-
-            # Send the last payload with marker = True
-            packet = RTPPacket(
-                timestamp=timestamp,
-                ssrc = self.ssrc
-            )
-            packet.payload = payloads[-1]
-            packet.marker = True
-            to_send.append(packet)
-        else:
-            packet = RTPPacket(
-                timestamp = timestamp,
-                ssrc = self.ssrc
-            )
-            packet.payload = payload
-            to_send.append(packet)
-
-        return to_send
+        :param packet: the next packet of the stream, its slot goes back to the pool
+        :type packet: RTPPacketSlot
+        """
+        try:
+            # Case 1: A previous frame is being built
+            if self.assembler.building:
+                # If packet belongs to current frame but is not the expected sequence number, drop frame
+                if packet.sequence_number != self.remote_seq:
+                    print(f"Missing packet, dropped frame: {self.assembler.timestamp}")
+                    broken = self.assembler.timestamp
+                    self.assembler.drop()
+                    if packet.timestamp == broken:
+                        return  # the rest of the dropped frame
+
+            # Continue based on whether this is a marker (last fragment) or not
+            if packet.marker:
+                if self.assembler.building:
+                    # Append and complete the current frame
+                    self.assembler.append(packet)
+                    self.remote_seq = None
+                else:
+                    # Full packet in one go, no fragmentation
+                    self.assembler.start(packet)
+                self._put_frame(self.assembler.finish())
+            else:
+                # Intermediate or first fragment
+                if self.assembler.building:
+                    # Append fragment
+                    self.assembler.append(packet)
+                    self.remote_seq = (self.remote_seq + 1) & 0xFFFF  # sequence numbers wrap
+                else:
+                    # Start a new fragmented frame
+                    self.assembler.start(packet)
+                    self.remote_seq = (packet.sequence_number + 1) & 0xFFFF
+        finally:
+            self.packet_pool.release(packet)
+
+    def _put_frame(self, frame):
+        """
+        Queue a full frame for the player. If it fell behind the oldest frame is dropped -
+        late media is worth less than new media.
+        """
+        try:
+            self.receive_queue.put_nowait(frame)
+        except queue.Full:
+            try:
+                self.receive_queue.get_nowait().release()
+            except queue.Empty:
+                pass
+            try:
+                self.receive_queue.put_nowait(frame)
+            except queue.Full:
+                frame.release()
 
 
 # import time
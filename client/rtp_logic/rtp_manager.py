@@ -7,12 +7,24 @@ import queue
 import cv2
 
 from client.mediator_connect import *
+from utils.encryption.srtp import SRTPContext
+from .rtcp import RTCPSession, StreamStats
 from .rtp_handler import RTPHandler
 from .audio_capture import AudioInput
 from .video_capture import VideoInput, VideoEncoder, VideoDecoder
 
+MEDIA_ENCRYPTION = True  # offer srtp keys in the sdp, media is encrypted when the remote offers them too
 
-def _send_audio_process(send_ip, send_audio, running_event):
+
+def _srtp(crypto):
+    """
+    :return: The srtp context of an sdp crypto attribute, None for clear media
+    :rtype: SRTPContext or None
+    """
+    return SRTPContext.from_crypto_attribute(crypto) if crypto else None
+
+
+def _send_audio_process(send_ip, send_audio, running_event, crypto=None, stats=None):
     """
        Audio sending process function that reads audio data from input and sends RTP packets.
 
@@ -22,12 +34,17 @@ def _send_audio_process(send_ip, send_audio, running_event):
        :type send_audio: int
        :param running_event: A multiprocessing.Event controlling the process lifetime
        :type running_event: multiprocessing.Event
+       :param crypto: The srtp key to encrypt with (sdp crypto attribute), None to send in the clear
+       :type crypto: str or None
+       :param stats: The stream's statistics, the remote's reports of it are in stats.remote_report()
+       :type stats: StreamStats or None
 
        :returns: None
        """
     """Audio sending process function"""
     audio_io = AudioInput()
-    sender = RTPHandler(send_ip, send_port=send_audio)
+    sender = RTPHandler(send_ip, send_port=send_audio, srtp=_srtp(crypto),
+                        ssrc=stats.ssrc if stats else None, stats=stats)
     sender.start()
 
 
@@ -60,7 +77,7 @@ def _send_audio_process(send_ip, send_audio, running_event):
         audio_io.close()
 
 
-def _recv_audio_process(send_ip, recv_audio, recv_audio_queue, running_event):
+def _recv_audio_process(send_ip, recv_audio, recv_audio_queue, running_event, crypto=None, stats=None):
     """
         Audio receiving process function that listens for incoming RTP audio packets
         and places decoded audio frames into a multiprocessing queue.
@@ -73,18 +90,25 @@ def _recv_audio_process(send_ip, recv_audio, recv_audio_queue, running_event):
         :type recv_audio_queue: multiprocessing.Queue
         :param running_event: A multiprocessing.Event controlling the process lifetime
         :type running_event: multiprocessing.Event
+        :param crypto: The remote's srtp key (sdp crypto attribute), None for clear media
+        :type crypto: str or None
+        :param stats: The stream's statistics, counts what is received for the rtcp reports
+        :type stats: StreamStats or None
 
         :returns: None
         """
 
-    receiver = RTPHandler(send_ip, listen_port=recv_audio)
+    receiver = RTPHandler(send_ip, listen_port=recv_audio, srtp=_srtp(crypto), stats=stats)
     receiver.start()
 
     try:
         while running_event.is_set():
             try:
                 frame = receiver.receive_queue.get(timeout=1)
-                recv_audio_queue.put((frame.timestamp, frame.payload))
+                try:
+                    recv_audio_queue.put((frame.timestamp, bytes(frame.payload)))  # the queue pickles later
+                finally:
+                    frame.release()
             except queue.Empty:
                 continue
             except Exception:
@@ -93,7 +117,7 @@ def _recv_audio_process(send_ip, recv_audio, recv_audio_queue, running_event):
         receiver.stop()
 
 
-def _send_video_process(send_ip, send_video, running_event):
+def _send_video_process(send_ip, send_video, running_event, crypto=None, stats=None):
     """
     Video sending process function that reads video frames, encodes them,
     and sends RTP packets at a capped frame rate (30 FPS).
@@ -104,6 +128,10 @@ def _send_video_process(send_ip, send_video, running_event):
     :type send_video: int
     :param running_event: A multiprocessing.Event controlling the process lifetime
     :type running_event: multiprocessing.Event
+    :param crypto: The srtp key to encrypt with (sdp crypto attribute), None to send in the clear
+    :type crypto: str or None
+    :param stats: The stream's statistics, the remote's reports of it are in stats.remote_report()
+    :type stats: StreamStats or None
 
     :returns: None
     """
@@ -111,7 +139,8 @@ def _send_video_process(send_ip, send_video, running_event):
 
     # Hard coding fps for now
     frame_interval = 1.0 / 30.0  # 30 frames per second
-    sender = RTPHandler(send_ip, send_port=send_video)
+    sender = RTPHandler(send_ip, send_port=send_video, srtp=_srtp(crypto),
+                        ssrc=stats.ssrc if stats else None, stats=stats)
     sender.start()
 
     try:
@@ -138,7 +167,7 @@ def _send_video_process(send_ip, send_video, running_event):
         sender.stop()
 
 
-def _recv_video_process(send_ip, recv_video, recv_video_queue, running_event):
+def _recv_video_process(send_ip, recv_video, recv_video_queue, running_event, crypto=None, stats=None):
     """
     Video receiving process function that listens for incoming RTP video packets,
     decodes them, and places decoded frames into a multiprocessing queue.
@@ -151,10 +180,14 @@ def _recv_video_process(send_ip, recv_video, recv_video_queue, running_event):
     :type recv_video_queue: multiprocessing.Queue
     :param running_event: A multiprocessing.Event controlling the process lifetime
     :type running_event: multiprocessing.Event
+    :param crypto: The remote's srtp key (sdp crypto attribute), None for clear media
+    :type crypto: str or None
+    :param stats: The stream's statistics, counts what is received for the rtcp reports
+    :type stats: StreamStats or None
 
     :returns: None
     """
-    receiver = RTPHandler(send_ip, listen_port=recv_video)
+    receiver = RTPHandler(send_ip, listen_port=recv_video, srtp=_srtp(crypto), stats=stats)
     decoder = VideoDecoder()
     receiver.start()
 
@@ -162,7 +195,10 @@ def _recv_video_process(send_ip, recv_video, recv_video_queue, running_event):
         while running_event.is_set():
             try:
                 encoded_data = receiver.receive_queue.get(timeout=1)
-                decoded_frames = decoder.decode(encoded_data.payload)
+                try:
+                    decoded_frames = decoder.decode(encoded_data.payload)
+                finally:
+                    encoded_data.release()
                 for frame in decoded_frames:
                     f = frame.to_ndarray(format='bgr24')
                     recv_video_queue.put((encoded_data.timestamp, f))
@@ -175,7 +211,7 @@ def _recv_video_process(send_ip, recv_video, recv_video_queue, running_event):
 
 
 class RTPManager(ControllerAware):
-    def __init__(self):
+    def __init__(self, encrypt_media=MEDIA_ENCRYPTION):
         super().__init__()
         self.used_ports = []
 
@@ -188,24 +224,36 @@ class RTPManager(ControllerAware):
         self.recv_audio = None
         self.recv_video = None
 
+        # srtp keys (sdp crypto attributes) by media type - ours encrypt what we send,
+        # the remote's decrypt what we receive
+        self.encrypt_media = encrypt_media
+        self.local_crypto = {}
+        self.remote_crypto = {}
+
         self.running_event = None
         self.processes = []
 
+        # rtcp - StreamStats and RTCPSession by media type
+        self.stats = {}
+        self.rtcp_sessions = {}
+
         # Use multiprocessing queues for inter-process communication
         self.recv_audio_queue = multiprocessing.Queue()  # (timestamp, frame)
         self.recv_video_queue = multiprocessing.Queue()  # (timestamp, frame)
 
     def allocate_port(self):
         """
-        Allocates a random free UDP port for use.
+        Allocates a random free UDP port for use - an even one, the odd one after it is its
+        rtcp port (rfc 3550 11) and is taken too.
 
         :returns: A free port number
         :rtype: int
         """
         for _ in range(100):
-            port = random.randint(10000, 60000)
-            if port not in self.used_ports and self._is_port_free(port):
-                self.used_ports.append(port)
+            port = random.randint(5000, 29999) * 2
+            if (port not in self.used_ports and port + 1 not in self.used_ports
+                    and self._is_port_free(port) and self._is_port_free(port + 1)):
+                self.used_ports += [port, port + 1]
                 return port
         raise RuntimeError("Failed to allocate free port")
 
@@ -269,6 +317,46 @@ class RTPManager(ControllerAware):
             print(self.recv_audio)
         if video:
             self.recv_video = self.allocate_port()
+        if self.encrypt_media:
+            # fresh keys for every call
+            for media, wanted in (('audio', audio), ('video', video)):
+                if wanted:
+                    self.local_crypto[media] = SRTPContext().crypto_attribute()
+
+    def get_local_crypto(self, media):
+        """
+        Gets our srtp key of a media type, to offer in the sdp.
+
+        :param media: 'audio' or 'video'
+        :type media: str
+
+        :returns: The sdp crypto attribute or None if media encryption is off
+        :rtype: str or None
+        """
+        return self.local_crypto.get(media)
+
+    def set_remote_crypto(self, media, crypto):
+        """
+        Sets the srtp key the remote offered for a media type.
+
+        :param media: 'audio' or 'video'
+        :type media: str
+        :param crypto: The remote's sdp crypto attribute, None if it didn't offer one
+        :type crypto: str or None
+        """
+        if crypto:
+            self.remote_crypto[media] = crypto
+        else:
+            self.remote_crypto.pop(media, None)
+
+    def _crypto(self, media):
+        """
+        :returns: The (send, receive) keys of a media type - both None unless both sides offered keys
+        :rtype: tuple
+        """
+        if media in self.local_crypto and media in self.remote_crypto:
+            return self.local_crypto[media], self.remote_crypto[media]
+        return None, None
 
     def get_recv_audio(self):
         """
@@ -302,6 +390,46 @@ class RTPManager(ControllerAware):
         self.send_video = None
         self.recv_audio = None
         self.recv_video = None
+        self.local_crypto = {}
+        self.remote_crypto = {}
+        self.stats = {}
+        self.rtcp_sessions = {}
+
+    def _start_rtcp(self, media, send_port, recv_port):
+        """
+        Starts the rtcp session of a media type, on the port after its rtp port.
+
+        :returns: The stream's statistics, None if the media isn't used
+        :rtype: StreamStats or None
+        """
+        if not send_port and not recv_port:
+            return None
+        stats = self.stats[media] = StreamStats()
+        try:
+            session = RTCPSession(stats, local_port=recv_port + 1 if recv_port else 0,
+                                  remote_addr=(self.send_ip, send_port + 1) if send_port else None)
+        except OSError as e:
+            print(f"no rtcp for {media}: {e}")
+            return stats
+        session.start()
+        self.rtcp_sessions[media] = session
+        return stats
+
+    def get_stats(self, media):
+        """
+        Gets the statistics of a media stream - ours (sent, received, lost, jitter) and what the
+        remote reported about the stream we send (fraction lost, cumulative lost, jitter, rtt).
+
+        :param media: 'audio' or 'video'
+        :type media: str
+
+        :returns: {'local': dict, 'remote': dict or None} or None if the media isn't running
+        :rtype: dict or None
+        """
+        stats = self.stats.get(media)
+        if stats is None:
+            return None
+        return {'local': stats.local_report(), 'remote': stats.remote_report()}
 
     def start_rtp_comms(self):
         """
@@ -313,19 +441,24 @@ class RTPManager(ControllerAware):
         self.running_event.set()
 
         print(str(self))
+        audio_send_key, audio_recv_key = self._crypto('audio')
+        video_send_key, video_recv_key = self._crypto('video')
+        audio_stats = self._start_rtcp('audio', self.send_audio, self.recv_audio)
+        video_stats = self._start_rtcp('video', self.send_video, self.recv_video)
 
         if self.send_audio:
             print("send audio")
             p = multiprocessing.Process(
                 target=_send_audio_process,
-                args=(self.send_ip, self.send_audio, self.running_event)
+                args=(self.send_ip, self.send_audio, self.running_event, audio_send_key, audio_stats)
             )
             self.processes.append(p)
 
         if self.recv_audio:
             p = multiprocessing.Process(
                 target=_recv_audio_process,
-                args=(self.send_ip, self.recv_audio, self.recv_audio_queue, self.running_event)
+                args=(self.send_ip, self.recv_audio, self.recv_audio_queue, self.running_event, audio_recv_key,
+                      audio_stats)
             )
             self.processes.append(p)
 
@@ -333,14 +466,15 @@ class RTPManager(ControllerAware):
             print("send video")
             p = multiprocessing.Process(
                 target=_send_video_process,
-                args=(self.send_ip, self.send_video, self.running_event)
+                args=(self.send_ip, self.send_video, self.running_event, video_send_key, video_stats)
             )
             self.processes.append(p)
 
         if self.recv_video:
             p = multiprocessing.Process(
                 target=_recv_video_process,
-                args=(self.send_ip, self.recv_video, self.recv_video_queue, self.running_event)
+                args=(self.send_ip, self.recv_video, self.recv_video_queue, self.running_event, video_recv_key,
+                      video_stats)
             )
             self.processes.append(p)
 
@@ -389,6 +523,9 @@ class RTPManager(ControllerAware):
                 process.terminate()
                 process.join()
 
+        for session in self.rtcp_sessions.values():
+            session.stop()  # says bye
+
         self.clear_ports()
 
     def __str__(self):
@@ -408,6 +545,7 @@ class RTPManager(ControllerAware):
             f"  Send Video Port: {self.send_video}\n"
             f"  Receive Audio Port: {self.recv_audio}\n"
             f"  Receive Video Port: {self.recv_video}\n"
+            f"  Media Encrypted: {sorted(m for m in ('audio', 'video') if self._crypto(m)[0])}\n"
             f"  Audio Queue Size: {self.recv_audio_queue.qsize()}\n"
             f"  Video Queue Size: {self.recv_video_queue.qsize()}\n"
             f"  Processes Running: {running_processes}"
@@ -3,8 +3,7 @@ from mediator_connect import ControllerAware
 import socket
 
 from utils.comms import recv_encrypted, send_encrypted
-from utils.encryption.aes import AESCryptGCM
-from utils.encryption.rsa import RSACrypt
+from utils.encryption.session_ticket import client_key_exchange
 
 SERVER_URI = "myserver"
 SERVER_IP = '127.0.0.1'
@@ -19,6 +18,7 @@ class SignupClient(ControllerAware):
         self.server_ip = SERVER_IP
         self.server_port = SERVER_PORT
         self.aes_obj = None
+        self.session = None  # (aes key, ticket) to resume the session on the next signup
 
     def connect(self):
         try:
@@ -31,18 +31,10 @@ class SignupClient(ControllerAware):
             print(f"Connection failed: {e}")
             return False
     def key_exchange(self):
-        self.aes_obj = AESCryptGCM()
-        rsa = RSACrypt()
-        rsa_key = recv_encrypted(self.socket)
-        if rsa_key != b'':
-            # print('--------------------')
-            # print(f"rsa key client: {rsa_key}")
-            # print('--------------------')
-            rsa.import_public_key(rsa_key)
-            enc_data = rsa.encrypt(self.aes_obj.export_key())
+        result = client_key_exchange(self.socket, self.session)
+        if result:
+            self.aes_obj, self.session = result
             print(f'client:\n{self.aes_obj.export_key()}')
-            # print(f"encoded: {enc_data}")
-            send_encrypted(self.socket, enc_data)
             return True
         return False
 
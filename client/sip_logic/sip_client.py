@@ -6,19 +6,21 @@ from typing import Optional
 
 import select
 
-from utils.comms import recv_encrypted, send_encrypted
+from utils.comms import send_encrypted, FrameDecoder
 from utils.sip_msgs import *
 from utils.authentication import *
 from utils.sdp_class import *
 from client.mediator_connect import *
-from utils.encryption.rsa import RSACrypt
 from utils.encryption.aes import AESCryptGCM
+from utils.encryption.session_ticket import client_key_exchange
 SERVER_IP = '127.0.0.1'
 SERVER_PORT = 4552
 SIP_VERSION = "SIP/2.0"
 SERVER_URI = "myserver"
 MAX_PASSES_META = 8000  # 8 kb
 MAX_PASSES_BODY = 1000
+# the media and formats we answer calls with
+SDP_NEGOTIATOR = SDPNegotiator([SDPMedia('audio', 0, ['acc']), SDPMedia('video', 0, ['h.264'])])
 
 
 @dataclass
@@ -47,6 +49,7 @@ class SIPHandler(ControllerAware):
         self.logged_in = False
 
         self.aes_obj = AESCryptGCM()
+        self.session = None  # (aes key, ticket) to resume the session on reconnect
 
         # self.auth_authority = AuthService(SERVER_URI)
 
@@ -68,16 +71,11 @@ class SIPHandler(ControllerAware):
             print("Disconnected from server")
 
     def encryption_pipeline(self):
-        rsa = RSACrypt()
-        rsa_key = recv_encrypted(self.socket)
-        if rsa_key != b'':
-            print(rsa_key)
-            rsa.import_public_key(rsa_key)
-            print(f"sending key: {self.aes_obj.export_key()}")
-            enc_data = rsa.encrypt(self.aes_obj.export_key())
-            print(f"encoded: {enc_data}")
-            send_encrypted(self.socket, enc_data)
-            print("sent!")
+        # resumes the last session if there is one - no rsa on reconnect
+        result = client_key_exchange(self.socket, self.session)
+        if result:
+            self.aes_obj, self.session = result
+            print(f"session key: {self.aes_obj.export_key()}")
             return True
         return False
 
@@ -88,28 +86,32 @@ class SIPHandler(ControllerAware):
     def _main_loop(self):
         if not self.connected:
             return
+        decoder = FrameDecoder()
         try:
             while self.connected:
                 readable, _, _ = select.select([self.socket], [], [], 0.5)
                 for sock in readable:
-                    msg_enc = recv_encrypted(sock)
-                    print(msg_enc)
-                    if msg_enc != b'':
+                    # only the frames that fully arrived. the rest waits for the next pass
+                    frames = decoder.recv_from(sock)
+                    if frames is None:
+                        self.connected = False
+                        break
+                    for msg_enc in frames:
+                        print(bytes(msg_enc))
                         msg_raw = self.aes_obj.decrypt(msg_enc).decode()
                         msg = SIPMsgFactory.parse(msg_raw)
                         print(f"{self.uri} recvd: {msg}")
 
-                        if msg is not None:
-                            if isinstance(msg, SIPRequest):
-                                self._handle_request(msg)
-                            elif self.call:
-                                if msg.get_header('call-id') == self.call.call_id:
-                                    self.process_response(msg)
-                            else:
-                                pass # this is for keep alive
-                            continue
-
-                    self.connected = False
+                        if msg is None:
+                            self.connected = False
+                            break
+                        if isinstance(msg, SIPRequest):
+                            self._handle_request(msg)
+                        elif self.call:
+                            if msg.get_header('call-id') == self.call.call_id:
+                                self.process_response(msg)
+                        else:
+                            pass # this is for keep alive
         except Exception as err:
             print("ERROR")
             print(err)
@@ -182,17 +184,22 @@ class SIPHandler(ControllerAware):
         if not sdp_recv:
             return
 
+        self.controller.set_recv_ports(video=True, audio=True)
+
+        # answer with our keys only for the media the caller wants encrypted
+        local_sdp = SDP_NEGOTIATOR.answer(
+            sdp_recv, socket.gethostbyname(socket.gethostname()), sdp_recv.session_id,
+            {'audio': self.controller.get_recv_audio_port(), 'video': self.controller.get_recv_video_port()},
+            {'audio': self.controller.get_local_crypto('audio'), 'video': self.controller.get_local_crypto('video')})
+
         self.controller.set_remote_ip(sdp_recv.ip)
-        if sdp_recv.audio_port:
+        # only send the media we accepted
+        if sdp_recv.audio_port and local_sdp.audio_port:
             self.controller.set_send_audio(sdp_recv.audio_port)
-        if sdp_recv.video_port:
+        if sdp_recv.video_port and local_sdp.video_port:
             self.controller.set_send_video(sdp_recv.video_port)
-
-        self.controller.set_recv_ports(video=True, audio=True)
-
-        local_sdp = SDP(0, socket.gethostbyname(socket.gethostname()), sdp_recv.session_id,
-                        video_port=self.controller.get_recv_video_port(), video_format='h.264',
-                        audio_port=self.controller.get_recv_audio_port(), audio_format='acc')
+        self.controller.set_remote_crypto('audio', sdp_recv.audio_crypto)
+        self.controller.set_remote_crypto('video', sdp_recv.video_crypto)
 
         res = SIPMsgFactory.create_response_from_request(
             self.call.call_data, SIPStatusCode.OK, self.uri, body=str(local_sdp))
@@ -326,6 +333,8 @@ class SIPHandler(ControllerAware):
                             self.controller.set_send_audio(sdp_recv.audio_port)
                         if sdp_recv.video_port:
                             self.controller.set_send_video(sdp_recv.video_port)
+                        self.controller.set_remote_crypto('audio', sdp_recv.audio_crypto)
+                        self.controller.set_remote_crypto('video', sdp_recv.video_crypto)
 
                         cseq = msg.get_header('cseq')[0] + 1
                         self.call.last_used_cseq_num = cseq
@@ -411,7 +420,9 @@ class SIPHandler(ControllerAware):
         self.controller.set_recv_ports(video=True, audio=True)
         sdp_body = SDP(0, socket.gethostbyname(socket.gethostname()), session_id,
                        video_port=self.controller.get_recv_video_port(), video_format='h.264',
-                       audio_port=self.controller.get_recv_audio_port(), audio_format='acc')
+                       audio_port=self.controller.get_recv_audio_port(), audio_format='acc',
+                       video_crypto=self.controller.get_local_crypto('video'),
+                       audio_crypto=self.controller.get_local_crypto('audio'))
 
         req = SIPMsgFactory.create_request(SIPMethod.INVITE, SIP_VERSION, uri, self.uri, self.call.call_id, self.call.last_used_cseq_num, body=str(sdp_body))
         self.send_encrypted(self.socket, str(req).encode())
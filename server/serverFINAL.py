@@ -1,5 +1,7 @@
+import asyncio
 import concurrent.futures
-from collections import defaultdict
+import multiprocessing
+import sys
 
 from utils.authentication import *
 from utils.encryption.aes import AESCryptGCM
@@ -7,15 +9,24 @@ from utils.user_database import UserDatabase
 import datetime
 import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from enum import Enum
 from utils.comms import *
-import select
+import selectors
 from typing import Optional
 from utils.encryption.rsa import RSACrypt
+from utils.encryption.handshake import HandshakePool
+from utils.encryption.session_ticket import RESUME_REJECTED, TicketIssuer, is_resume_frame, split_key_exchange
+from utils.cluster import (ClusterStore, RemoteSocket, RELAY_END, RELAY_FROM_CLIENT, RELAY_GONE,
+                           RELAY_TO_CLIENT)
+from utils.rate_limiter import GCRA, TokenBucket
+from utils.sip_transaction import MAX_DATAGRAM_SIZE, TransactionLayer, UDPPeer
+from utils.timer_scheduler import Timer, TimerScheduler
 
 # Constants
 DEFAULT_SERVER_PORT = 4552
 MAX_WORKERS = 10
+ASYNC_QUEUE_LEN = 1024  # listen backlog for the asyncio server
 SIP_VERSION = "SIP/2.0"
 SERVER_URI = "myserver"
 SERVER_IP = '127.0.0.1'  # need to find out using sbc
@@ -28,10 +39,21 @@ KEEP_ALIVE_MSG = SIPMsgFactory.create_request(SIPMethod.OPTIONS, SIP_VERSION, "k
 MAX_PASSES_META = 8000  # 8 kb
 MAX_PASSES_BODY = 1000
 KEEP_ALIVE_SECONDS = 30
+AUTH_CHALLENGE_LIMIT = 30  # seconds a client has to answer an auth challenge
+RATE_EVICT_SECONDS = 1
 
 BANNED_IPS_FILE = "banned_ips.txt"
+KEY_FILE = "server_key.pem"  # rsa key pair, shared by the workers and the signup server
+WAKEUP_KEY = "wakeup"  # selector data of the socket workers use to wake the loop
+PLAIN_LISTENER_KEY = "plain"  # selector data of the plain sip over tcp listener
+UDP_LISTENER_KEY = "udp"  # selector data of the sip over udp socket
+UDP_RECV_BATCH = 64  # datagrams read per readiness event, so udp can't starve the tcp clients
+UDP_PEER_IDLE_SECONDS = 60  # udp clients with no registration and no calls are forgotten after this
+MAX_QUEUED_FACTOR = 4  # connections queueing more than this many high water marks are dropped
+CALL_SHARDS = 16  # lock stripes of the call table
 
 class EncryptedSocket:
+    # encrypt_obj is None for plain sip over tcp connections - sent and received as is
     def __init__(self, sock, encrypt_obj):
         self.socket = sock
         self.encrypt_obj = encrypt_obj
@@ -57,6 +79,51 @@ class EncryptedSocket:
         return self.encrypt_obj.decrypt(data)
 
 
+class SIPDatagramProtocol(asyncio.DatagramProtocol):
+    """ Sip over udp socket of the asyncio server - datagrams go to the server's handler """
+    def __init__(self, handle):
+        self.handle = handle
+
+    def datagram_received(self, data, addr):
+        self.handle(data, addr)
+
+    def error_received(self, exc):
+        print(f"udp error: {exc}")  # icmp unreachable of a client that left - its transactions time out
+
+
+class AsyncEncryptedSocket:
+    """ EncryptedSocket counterpart for connections served by the asyncio loop """
+    def __init__(self, writer, encrypt_obj, loop):
+        self.writer = writer
+        self.encrypt_obj = encrypt_obj
+        self.loop = loop
+
+    def send(self, data):
+        # the transport buffers and coalesces the writes. a peer that doesn't read is dropped
+        if self.writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER * MAX_QUEUED_FACTOR:
+            raise ConnectionError("peer is not reading")
+        # handlers run in the worker threads - the write itself has to happen on the loop
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, bytes(data))
+        except RuntimeError:
+            raise ConnectionError("event loop is closed")
+        return len(data)
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass  # loop already closed the transport
+
+    def encrypt(self, data):
+        return self.encrypt_obj.encrypt(data)
+    def decrypt(self, data):
+        return self.encrypt_obj.decrypt(data)
+
+
 @dataclass
 class RegisteredUser:
     """ Struct for registered user """
@@ -65,6 +132,7 @@ class RegisteredUser:
     socket: EncryptedSocket
     registration_time: datetime.datetime
     expires: int  # amount of seconds
+    expiry_timer: Optional[Timer] = None
 
 
 # Dataclasses for storing session info for each message type
@@ -93,7 +161,317 @@ class AuthChallenge:
     # this is for remembering auth data sent to the client
     answer: str
     created_time: datetime.datetime
+    timer: Optional[Timer] = None
+
+
+class ConnectionState(Enum):
+    PENDING_CRYPT = "PENDING CRYPT"  # rsa key sent, waiting for the client's aes key
+    ENCRYPTED = "ENCRYPTED"
+    PLAIN = "PLAIN"  # rfc 3261 sip over tcp, no key exchange and no frames
+
+
+@dataclass(eq=False)  # identity hash - connections are kept in sets
+class Connection:
+    """ Per socket state stored in the connection registry """
+    sock: object  # raw socket while pending crypt, EncryptedSocket after the key exchange (or plain)
+    state: ConnectionState
+    created_time: datetime.datetime
+    keep_alive: Optional[KeepAlive] = None  # keep alive waiting for an answer
+    decoder: FrameDecoder = field(default_factory=FrameDecoder)  # partial frames (or sip messages) received so far
+    writer: Optional[FrameWriter] = None  # outbound frames, drained by the select loop
+    events: int = selectors.EVENT_READ  # what the selector currently watches for
+    timer: Optional[Timer] = None  # key exchange timeout, then the keep alive timer
+    handshake: Optional[concurrent.futures.Future] = None  # the aes key being decrypted in the pool
+    early_frames: list = field(default_factory=list)  # frames that came before the handshake ended
+    resume_refused: bool = False  # the client's session ticket was refused, it must use rsa now
+
+
+class ConnectionRegistry:
+    def __init__(self, selector=None):
+        """
+        Registry of every client connection and its state. Add, lookup and remove are O(1).
+        If a selector is given every connection is registered in it with its Connection
+        as the key data, so readiness dispatch doesn't need any lookups.
+
+        :param selector: Selector the connections are watched by, None when not select based
+        :type selector: selectors.BaseSelector or None
+        """
+        self.selector = selector
+        self.connections = {}  # sock -> Connection
+        self.established_count = 0  # encrypted and plain connections
+
+    def add_pending(self, sock):
+        """
+        Add a new connection that still needs to do the key exchange.
+
+        :param sock: The raw client socket
+        :type sock: socket.socket
+
+        :return: The connection state object
+        :rtype: Connection
+        """
+        conn = Connection(sock, ConnectionState.PENDING_CRYPT, datetime.datetime.now())
+        self.connections[sock] = conn
+        if self.selector:
+            conn.writer = FrameWriter()
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+        return conn
+
+    def add_encrypted(self, sock):
+        """
+        Add a connection that finished the key exchange.
+
+        :param sock: The encrypted client socket
+        :type sock: EncryptedSocket
+
+        :return: The connection state object
+        :rtype: Connection
+        """
+        conn = Connection(sock, ConnectionState.ENCRYPTED, datetime.datetime.now())
+        self.connections[sock] = conn
+        self.established_count += 1
+        if self.selector:
+            conn.writer = FrameWriter()
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+        return conn
+
+    def add_plain(self, sock):
+        """
+        Add a plain SIP over TCP connection - its messages are framed by their headers.
+
+        :param sock: The client socket, an EncryptedSocket without encryption
+        :type sock: EncryptedSocket or AsyncEncryptedSocket
+
+        :return: The connection state object
+        :rtype: Connection
+        """
+        conn = Connection(sock, ConnectionState.PLAIN, datetime.datetime.now(), decoder=SIPStreamDecoder())
+        self.connections[sock] = conn
+        self.established_count += 1
+        if self.selector:
+            conn.writer = FrameWriter()  # plain messages are queued the same way, with no prefix
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+        return conn
+
+    def promote(self, raw_sock, enc_sock):
+        """
+        Move a pending connection to the encrypted state under its new socket object.
+
+        :param raw_sock: The raw socket the connection was pending under
+        :type raw_sock: socket.socket
+        :param enc_sock: The socket wrapping raw_sock with the session encryption
+        :type enc_sock: EncryptedSocket
+
+        :return: The connection state object or None if it wasn't pending
+        :rtype: Connection or None
+        """
+        conn = self.connections.pop(raw_sock, None)
+        if not conn:
+            return None
+        conn.sock = enc_sock
+        conn.state = ConnectionState.ENCRYPTED
+        self.connections[enc_sock] = conn
+        self.established_count += 1
+        # the selector key holds the same Connection object, so no need to modify it
+        return conn
+
+    def remove(self, sock):
+        """
+        Remove a connection and stop watching it. Must be called before the socket is closed.
+
+        :param sock: The socket of the connection
+        :type sock: socket.socket or EncryptedSocket
+
+        :return: The removed connection or None if it wasn't registered
+        :rtype: Connection or None
+        """
+        conn = self.connections.pop(sock, None)
+        if not conn:
+            return None
+        if conn.state is not ConnectionState.PENDING_CRYPT:
+            self.established_count -= 1
+        if self.selector:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass  # already closed
+        return conn
+
+    def get(self, sock):
+        return self.connections.get(sock)
+
+    def watch(self, conn, events):
+        """
+        Change what the selector watches a connection for.
+
+        :param conn: The connection
+        :type conn: Connection
+        :param events: selectors.EVENT_READ and/or selectors.EVENT_WRITE
+        :type events: int
+        """
+        if self.selector and events != conn.events and conn.sock in self.connections:
+            self.selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+    def __contains__(self, sock):
+        return sock in self.connections
 
+    def __len__(self):
+        return self.established_count
+
+
+class CallTable:
+    def __init__(self, shards=CALL_SHARDS, on_remove=None):
+        """
+        Active calls sharded by a hash of the call id. Every shard has its own lock, so a
+        call only waits for calls that share its shard instead of for every call on the server.
+        The state of a call (and of its auth challenge) is changed under lock(call_id) and
+        messages are sent after the lock is released.
+
+        Calls are also indexed by socket and by uri, so finding the calls of a connection
+        or a user doesn't scan the table.
+
+        :param shards: Number of shards
+        :type shards: int
+        :param on_remove: Called with every removed call (under its shard lock)
+        :type on_remove: callable or None
+        """
+        self.on_remove = on_remove
+        self.shards = [{} for _ in range(shards)]  # call-id -> Call
+        self.locks = [threading.RLock() for _ in range(shards)]
+        self.by_sock = {}  # index lock. socket -> {call-id}
+        self.by_uri = {}  # index lock. uri -> {call-id}
+        self.index_lock = threading.Lock()  # held shortly, never while taking a shard lock
+
+    def _index(self, call_id):
+        return hash(call_id) % len(self.shards)
+
+    def lock(self, call_id):
+        """
+        :return: The lock of the shard call_id is in
+        :rtype: threading.RLock
+        """
+        return self.locks[self._index(call_id)]
+
+    def get(self, call_id):
+        return self.shards[self._index(call_id)].get(call_id)
+
+    def add(self, call):
+        """
+        Add a call, replaces a call with the same call id. Caller holds lock(call.call_id).
+
+        :param call: The call
+        :type call: Call
+        """
+        prev = self.shards[self._index(call.call_id)].get(call.call_id)
+        self.shards[self._index(call.call_id)][call.call_id] = call
+        with self.index_lock:
+            if prev:
+                self._unindex(prev)
+            self._link(self.by_sock, call.caller_socket, call.call_id)
+            self._link(self.by_sock, call.callee_socket, call.call_id)
+            self._link(self.by_uri, call.uri, call.call_id)
+            self._link(self.by_uri, call.uri_other, call.call_id)
+
+    def remove(self, call_id):
+        """
+        Remove a call. Caller holds lock(call_id).
+
+        :param call_id: The call id
+        :type call_id: str
+
+        :return: The removed call or None if it didn't exist
+        :rtype: Call or None
+        """
+        call = self.shards[self._index(call_id)].pop(call_id, None)
+        if call:
+            with self.index_lock:
+                self._unindex(call)
+            if self.on_remove:
+                self.on_remove(call)
+        return call
+
+    def set_callee(self, call, sock):
+        """
+        Set the callee socket of a call and keep the socket index up to date.
+        Caller holds lock(call.call_id).
+
+        :param call: The call
+        :type call: Call
+        :param sock: The callee socket
+        :type sock: EncryptedSocket
+        """
+        with self.index_lock:
+            if call.callee_socket is not call.caller_socket:
+                self._unlink(self.by_sock, call.callee_socket, call.call_id)
+            call.callee_socket = sock
+            self._link(self.by_sock, sock, call.call_id)
+
+    def set_uri_other(self, call, uri):
+        """
+        Set the other uri of a call and keep the uri index up to date.
+        Caller holds lock(call.call_id).
+
+        :param call: The call
+        :type call: Call
+        :param uri: The uri of the other side
+        :type uri: str
+        """
+        with self.index_lock:
+            if call.uri_other != call.uri:
+                self._unlink(self.by_uri, call.uri_other, call.call_id)
+            call.uri_other = uri
+            self._link(self.by_uri, uri, call.call_id)
+
+    def calls_of_socket(self, sock):
+        """
+        :return: Snapshot of the calls sock is the caller or callee in
+        :rtype: list[Call]
+        """
+        with self.index_lock:
+            call_ids = list(self.by_sock.get(sock, ()))
+        return [call for call in map(self.get, call_ids) if call]
+
+    def calls_of_uri(self, uri):
+        """
+        :return: Snapshot of the calls uri is a side of
+        :rtype: list[Call]
+        """
+        with self.index_lock:
+            call_ids = list(self.by_uri.get(uri, ()))
+        return [call for call in map(self.get, call_ids) if call]
+
+    def _unindex(self, call):
+        self._unlink(self.by_sock, call.caller_socket, call.call_id)
+        self._unlink(self.by_sock, call.callee_socket, call.call_id)
+        self._unlink(self.by_uri, call.uri, call.call_id)
+        self._unlink(self.by_uri, call.uri_other, call.call_id)
+
+    @staticmethod
+    def _link(index, key, call_id):
+        if key is not None:
+            index.setdefault(key, set()).add(call_id)
+
+    @staticmethod
+    def _unlink(index, key, call_id):
+        call_ids = index.get(key)
+        if call_ids is not None:
+            call_ids.discard(call_id)
+            if not call_ids:
+                del index[key]
+
+    def calls(self):
+        """
+        :return: Snapshot of every call
+        :rtype: list[Call]
+        """
+        return [call for shard in self.shards for call in list(shard.values())]
+
+    def __contains__(self, call_id):
+        return call_id in self.shards[self._index(call_id)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
 
 
 class BiMap:
@@ -183,18 +561,32 @@ class BiMap:
 
 
 class SIPServer:
-    def __init__(self, port=DEFAULT_SERVER_PORT):
+    def __init__(self, port=DEFAULT_SERVER_PORT, cluster=None, worker_id=0, plain_port=None, udp_port=None):
         """
         Initialize the SIP server with default settings, including networking, thread pool, locks,
         user registration, call management, and connection tracking.
 
         :param port: Port on which the server will listen for incoming connections
         :type port: int
+        :param plain_port: Port for plain (unencrypted) SIP over TCP clients, None to not listen for them
+        :type plain_port: int or None
+        :param udp_port: Port for SIP over UDP clients, None to not listen for them
+        :type udp_port: int or None
+        :param cluster: Shared store of the worker processes when running as one of several workers
+        :type cluster: ClusterStore or None
+        :param worker_id: Id of this worker in the cluster
+        :type worker_id: int
         """
         # Socket properties
         self.host = '0.0.0.0'
         self.port = port
         self.server_socket = None
+        self.plain_port = plain_port
+        self.plain_socket = None
+        self.udp_port = udp_port
+        self.udp_socket = None  # select loop
+        self.udp_transport = None  # asyncio
+        self.udp_loop = None
         self.running = False
         self.queue_len = 5
         # for the future dos blocker
@@ -210,29 +602,33 @@ class SIPServer:
         self.user_db = UserDatabase(DB_PATH)
         # self.authority = AuthService(SERVER_URI)
 
+        # every timeout (registrations, calls, keep alive, auth, key exchange) is a timer here
+        self.timers = TimerScheduler()
+        # sip over udp - retransmissions of the server's requests and absorbing the clients' ones
+        self.transactions = TransactionLayer(self.timers, self._udp_send, self._transaction_timed_out)
+        self.udp_peers = {}  # addr -> UDPPeer. udp lock
+        self.udp_lock = threading.Lock()
+
         # Locks - RLock for multiple acquisitions in the same thread
         self.reg_lock = threading.RLock()  # Lock for adding users to the registered_users dict
-        self.call_lock = threading.RLock()  # Lock for adding users to the active_calls dict
         self.conn_lock = threading.RLock()
         self.ip_lock = threading.RLock()
 
         # User management properties
         self.registered_user = BiMap(key_attr="socket", value_attr="uri")
 
-        # call lock
-        self.active_calls = {}  # call lock. call-id -> Call
-        # no use for bi map here. there can be a socket in multiple calls still O(n)
-        self.pending_auth = {}  # uri -> AuthChallenge
+        # sharded, every call has its shard's lock
+        self.active_calls = CallTable(on_remove=self._call_removed)  # call-id -> Call
+        self.pending_auth = {}  # call id -> AuthChallenge. under the call's shard lock
 
         # Connection management - con lock
-        self.connected_users = []  # EncryptedSocket
-        self.pending_crypt = {} # {socket -> creation_time}
+        self.selector = None  # created by start() for the select loop
+        self.wakeup_recv, self.wakeup_send = None, None  # socket pair to wake the select loop
+        self.flush_ready = set()  # connections with queued frames - flush lock
+        self.flush_lock = threading.Lock()
+        self.connections = ConnectionRegistry()  # sock -> Connection (rate limit and keep alive state)
         self.pending_keep_alive = {}  # call-id -> KeepAlive
 
-        # ip lock
-        self.ip_connection_counts = defaultdict(list)  # IP -> [timestamps]
-        self.ip_message_counts = defaultdict(list)  # sock -> [timestamps]
-
         # for ip block (dos stop)
         self.blacklist_ips = set()
         self.connection_threshold = 5  # max attempts
@@ -243,10 +639,28 @@ class SIPServer:
         self.msg_rate_limit = 100  # max allowed messages
         self.msg_time_window = 60  # seconds
 
+        # rate limiters - ip lock. any RateLimiter works here
+        self.conn_limiter = TokenBucket(self.connection_threshold, self.time_window)  # IP -> bucket
+        self.msg_limiter = GCRA(self.msg_rate_limit, self.msg_time_window)  # socket (udp: addr) -> tat
+
+        # multi process - calls with a side on another worker. relay lock
+        self.cluster = cluster
+        self.worker_id = worker_id
+        self.remote_sockets = {}  # (worker, uri) -> RemoteSocket. one object per remote client
+        self.relayed_calls = {}  # call-id -> (owner worker, local socket) for calls owned by another worker
+        self.relayed_socks = {}  # local socket -> {call-id}
+        self.relay_lock = threading.Lock()
+
         # encryption - with conn lock
+        # the key is loaded (or generated the first time) in the background while the listener binds
         self.rsa_crypt = RSACrypt()
-        self.rsa_crypt.generate_keys()
-        self.public_key = self.rsa_crypt.export_public_key() # bytes
+        self.public_key = None # bytes
+        self.handshakes = None  # rsa decrypt of new clients, off the loop. created with the key
+        self.key_thread = threading.Thread(target=self.rsa_crypt.load_or_generate, args=(KEY_FILE,),
+                                           name="key_loader", daemon=True)
+        self.key_thread.start()
+        self.handshakes_done = []  # (conn, future) for the select loop to finish - flush lock
+        self.tickets = TicketIssuer(cluster.ticket_key if cluster else None)  # session resumption
 
     def start(self):
         """
@@ -256,125 +670,633 @@ class SIPServer:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.running = True
+            if self.cluster:
+                # every worker listens on the port, the kernel spreads the connections
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(self.queue_len)
             print(f"listening on {self.host}:{self.port}")
-
-            # Clean any expired registrations or inactive users
-            cleanup_thread = threading.Thread(target=self._cleanup_expired_reg, daemon=True)
-            keepalive_thread = threading.Thread(target=self._keep_alive, daemon=True)
-            inactive_call_clean_thread = threading.Thread(target=self._cleanup_inactive_calls, daemon=True)
-            ip_cleanup_thread = threading.Thread(target=self._cleanup_ip_counters, daemon=True)
-            cleanup_thread.start()
-            keepalive_thread.start()
-            inactive_call_clean_thread.start()
-            ip_cleanup_thread.start()
-
+            if self.plain_port:
+                self.plain_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if self.cluster:
+                    self.plain_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.plain_socket.bind((self.host, self.plain_port))
+                self.plain_socket.listen(self.queue_len)
+                print(f"listening for plain sip on {self.host}:{self.plain_port}")
+            if self.udp_port:
+                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if self.cluster:
+                    self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.udp_socket.bind((self.host, self.udp_port))
+                self.udp_socket.setblocking(False)
+                print(f"listening for sip over udp on {self.host}:{self.udp_port}")
+            self._wait_for_keys()
+
+            # one persistent registry - sockets are added and removed as they come and go
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+            if self.plain_socket:
+                self.selector.register(self.plain_socket, selectors.EVENT_READ, PLAIN_LISTENER_KEY)
+            if self.udp_socket:
+                self.selector.register(self.udp_socket, selectors.EVENT_READ, UDP_LISTENER_KEY)
+            self.connections.selector = self.selector
+            # workers queue frames and wake the loop to write them
+            self.wakeup_recv, self.wakeup_send = socket.socketpair()
+            self.wakeup_recv.setblocking(False)
+            self.wakeup_send.setblocking(False)
+            self.selector.register(self.wakeup_recv, selectors.EVENT_READ, WAKEUP_KEY)
+
+            self._start_timers()
             self._load_banned_ips()
 
             # Start server loop
             while self.running:
-                with self.conn_lock:
-                    readable, _, _ = select.select(list(self.pending_crypt.keys()) + self.connected_users + [self.server_socket], [], [], 0.5)
-                with self.conn_lock:
-                    for sock in readable:
-                        if sock is self.server_socket:
+                for key, mask in self.selector.select(0.5):
+                    with self.conn_lock:
+                        if key.data is None:
                             # Incoming connection
                             client_sock, addr = self.server_socket.accept()
-                            client_ip = addr[0]
-                            if client_ip in self.blacklist_ips or len(self.connected_users) >= self.max_connected:
-                                print("blacklisted")
+                            if not self._accept_connection(addr[0]):
                                 client_sock.close()
                                 continue
-                            # sliding window
-                            with self.ip_lock:
-                                now = time.time()
-                                self.ip_connection_counts[client_ip] = [
-                                    t for t in self.ip_connection_counts[client_ip] if now - t < self.time_window
-                                ]
-                                self.ip_connection_counts[client_ip].append(now)
-                                print(f"{len(self.ip_connection_counts[client_ip])} for timeframe")
-
-                                if len(self.ip_connection_counts[client_ip]) > self.connection_threshold:
-                                    print(f"Blacklisting IP {client_ip} for excessive connections.")
-                                    self.blacklist_ips.add(client_ip)
-                                    del self.ip_connection_counts[client_ip]
-                                    client_sock.close()
-                                    continue
-
-                            # with self.conn_lock:
-                            #     # add encryption
-                            # self.connected_users.append(client_sock)
 
+                            # the loop never blocks on a client - writes go through the connection queue
+                            client_sock.setblocking(False)
+                            conn = self.connections.add_pending(client_sock)
+                            conn.timer = self.timers.schedule(KEEP_ALIVE_SECONDS, self._key_exchange_timeout, conn)
                             # send rsa key
                             print(f"sending: {self.public_key}")
-                            send_encrypted(client_sock, self.public_key)
-                            self.pending_crypt[client_sock] = datetime.datetime.now()
+                            conn.writer.push(self.public_key)
+                            self._flush_connection(conn)
                             print(f"added client to pending auth at {addr}")
-                        elif sock in self.pending_crypt:
-                            # client sent aes key
-                            # recv encrypted
-                            # create aes obj
-                            # add to connected_users
-                            # send keep alive msg + add to keep alive queue
-                            rsa_encrypted = recv_encrypted(sock)
-                            if rsa_encrypted != b'':
-                                print(f"encrypted: {rsa_encrypted}")
-                                aes_key = self.rsa_crypt.decrypt(rsa_encrypted) # aes key is bytes obj
-                                print(f"decrypted: {aes_key}")
-                                encrypt_obj = AESCryptGCM(aes_key)
-                                self.connected_users.append(EncryptedSocket(sock, encrypt_obj))
-                                del self.pending_crypt[sock]
-                                print("added user!")
-
-                                # send keep alive + add to keep alive queue
-                        else:
-                            # Rate-limit messages per connection
-                            with self.ip_lock:
-                                now = time.time()
-                                self.ip_message_counts[sock] = [
-                                    t for t in self.ip_message_counts[sock] if now - t < self.msg_time_window
-                                ]
-                                self.ip_message_counts[sock].append(now)
-
-                                # if too many msgs close connection
-                                if len(self.ip_message_counts[sock]) > self.msg_rate_limit:
-                                    print(f"Too many messages from {sock}, closing connection.")
-                                    del self.ip_message_counts[sock]
-                                    self._close_connection(sock)
-                                    continue
-
-                            # returns sip msg object and checks is in format and in valid bounds
-                            # recv encrypted(sock, aes key)
-                            # msg = parse_sip(decrypted_bytes)
-                            # msg = receive_tcp_sip(sock, MAX_PASSES_META, MAX_PASSES_BODY)
-
-                            print("got msg")
-                            msg_encrypted = recv_encrypted(sock)
-                            print(msg_encrypted)
-                            if msg_encrypted != b'':
-                                print(f"msg enc: {msg_encrypted}")
-                                print(f"decrypt with key: {sock.encrypt_obj.key}")
-                                msg_raw = sock.decrypt(msg_encrypted).decode() # decrypt returns bytes so decode to get str
-                                print(f"msg_raw is: {msg_raw}")
-                                msg = SIPMsgFactory.parse(msg_raw)
-                                print(f"got msg: {msg}")
-                                if msg:
-                                    self.thread_pool.submit(self._worker_process_msg, sock, msg)
-                                    continue
-                            # if msg wasn't valid close connection
-                            self._close_connection(sock)
+                            continue
+
+                        if key.data == WAKEUP_KEY:
+                            self._flush_ready_connections()
+                            self._finish_handshakes()
+                            continue
+
+                        if key.data == PLAIN_LISTENER_KEY:
+                            self._accept_plain()
+                            continue
+
+                        if key.data == UDP_LISTENER_KEY:
+                            self._handle_datagrams()
+                            continue
+
+                        # the connection may have been closed by a worker after select returned
+                        conn = key.data
+                        if mask & selectors.EVENT_WRITE and conn.sock in self.connections:
+                            self._flush_connection(conn)
+                        if mask & selectors.EVENT_READ and conn.sock in self.connections:
+                            self._handle_readable(conn)
+        except Exception as err:
+            print(str(err) + ' ' + "something went wrong!")
+        finally:
+            self._shutdown()
+
+    def _accept_plain(self):
+        """
+        Accept a plain SIP over TCP client. There is no key exchange, the connection
+        is established right away.
+        """
+        client_sock, addr = self.plain_socket.accept()
+        if not self._accept_connection(addr[0]):
+            client_sock.close()
+            return
+        client_sock.setblocking(False)
+        conn = self.connections.add_plain(EncryptedSocket(client_sock, None))
+        self._schedule_keep_alive(conn)
+        print(f"added plain sip client at {addr}")
+
+    def _handle_datagrams(self):
+        """
+        Read the datagrams waiting on the udp socket (up to a batch) and handle them.
+        """
+        for _ in range(UDP_RECV_BATCH):
+            try:
+                data, addr = self.udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as err:
+                print(f"udp error: {err}")  # icmp unreachable of a client that left
+                continue
+            self._handle_datagram(data, addr)
+
+    def _handle_datagram(self, data, addr):
+        """
+        Handle a sip over udp datagram - rate limit, let the transaction layer absorb
+        retransmissions and pass new messages to the workers.
+
+        :param data: The datagram
+        :type data: bytes
+        :param addr: The sender
+        :type addr: tuple
+        """
+        if addr[0] in self.blacklist_ips:
+            return
+        with self.ip_lock:
+            if not self.msg_limiter.allow(addr):
+                print(f"Too many messages from {addr}, dropping.")
+                return
+        msg = self.transactions.receive(data, addr)
+        if not msg:
+            return
+        self.thread_pool.submit(self._worker_process_msg, self._udp_peer(addr), msg)
+
+    def _udp_peer(self, addr):
+        """
+        :return: The stand in socket of a udp client, one object per address
+        :rtype: UDPPeer
+        """
+        with self.udp_lock:
+            peer = self.udp_peers.get(addr)
+            if peer is None:
+                peer = self.udp_peers[addr] = UDPPeer(addr)
+            peer.last_seen = time.monotonic()
+            return peer
+
+    def _udp_send(self, data, addr):
+        """
+        Put a datagram on the wire. A datagram that can't be sent is lost like any other -
+        the transaction layer retransmits requests and clients retransmit theirs.
+        """
+        try:
+            if self.udp_transport:
+                # the transport belongs to the event loop thread
+                self.udp_loop.call_soon_threadsafe(self._udp_sendto_async, bytes(data), addr)
+            elif self.udp_socket:
+                self.udp_socket.sendto(data, addr)
+        except (OSError, RuntimeError) as err:
+            print(f"couldnt send to {addr}: {err}")
+
+    def _transaction_timed_out(self, addr, data):
+        """
+        Transaction layer hook - a request the server sent over udp got no final response in
+        time (timer B / F), the peer is gone. Ends the call of the request and answers the side
+        that sent it with 408 Request Timeout, instead of leaving the call to the idle timer.
+
+        :param addr: The peer that didn't answer
+        :type addr: tuple
+        :param data: The request that timed out
+        :type data: bytes
+        """
+        req = SIPMsgFactory.parse(data)
+        if not isinstance(req, SIPRequest) or not req.call_id:
+            return
+        with self.active_calls.lock(req.call_id):
+            call = self.active_calls.get(req.call_id)
+            if call is None:
+                return  # not a call's request or the call already ended
+            if isinstance(call.callee_socket, UDPPeer) and call.callee_socket.addr == addr:
+                send_sock = call.caller_socket
+            elif isinstance(call.caller_socket, UDPPeer) and call.caller_socket.addr == addr:
+                send_sock = call.callee_socket
+            else:
+                return
+            self.active_calls.remove(call.call_id)
+            self._drop_auth_challenge(call.call_id)
+        print(f"no answer from {addr}, ending call: {call}")
+        if send_sock:
+            self._send_to_client(send_sock, *self._reply(req, SIPStatusCode.REQUEST_TIMEOUT))
+
+    def _udp_sendto_async(self, data, addr):
+        if self.udp_transport and not self.udp_transport.is_closing():  # not after shutdown
+            self.udp_transport.sendto(data, addr)
+
+    def _handle_readable(self, conn):
+        """
+        Read whatever bytes a ready connection has and handle every complete frame in them.
+        A client that sent only part of a frame is simply left until the rest arrives.
+
+        :param conn: The connection that is ready for reading
+        :type conn: Connection
+        """
+        sock = conn.sock
+        try:
+            frames = conn.decoder.recv_from(sock)
+        except (ValueError, socket.error) as err:
+            print(f"bad frame from {sock}: {err}")
+            frames = None
+        if frames is None:
+            self._close_connection(sock)
+            return
+
+        for frame in frames:
+            if conn.state is not ConnectionState.PENDING_CRYPT:
+                if not self._handle_frame(conn, frame):
+                    return
+            elif conn.handshake is None:
+                if is_resume_frame(frame) and not conn.resume_refused:
+                    # returning client - resuming costs one aes decrypt and an hmac, no rsa
+                    aes_key = self.tickets.resume(frame)
+                    if aes_key is None:
+                        conn.resume_refused = True
+                        conn.writer.push(RESUME_REJECTED)  # the client falls back to rsa
+                        self._flush_connection(conn)
+                    else:
+                        self._establish_session(conn, aes_key, True)
+                    continue
+                # client sent aes key. decrypted in the handshake pool, the loop goes on meanwhile
+                future = self.handshakes.submit(frame)
+                if future is None:
+                    print("handshake queue is full")
+                    self._close_connection(sock)
+                    return
+                conn.handshake = future
+                future.add_done_callback(lambda done, conn=conn: self._handshake_done(conn, done))
+            else:
+                # the client didn't wait for the key exchange, keep its messages for after it
+                conn.early_frames.append(bytes(frame))
+
+    def _handle_frame(self, conn, frame):
+        """
+        Handle a frame of an established connection - rate limit, decrypt and pass to the workers.
+
+        :param conn: The connection
+        :type conn: Connection
+        :param frame: The encrypted frame, or the sip message of a plain connection
+        :type frame: bytes or memoryview
+
+        :return: False if the connection was closed
+        :rtype: bool
+        """
+        sock = conn.sock
+        # Rate-limit messages per connection
+        if not self._check_msg_rate(sock):
+            self._close_connection(sock)
+            return False
+
+        # returns sip msg object and checks is in format and in valid bounds
+        print("got msg")
+        try:
+            if conn.state is ConnectionState.PLAIN:
+                msg = SIPMsgFactory.parse(frame)  # copies out of the decoder's buffer
+            else:
+                msg = self._decrypt_msg(sock, frame)
+        except (ValueError, UnicodeDecodeError):
+            msg = None  # failed authentication or garbage
+        if not msg:
+            # if msg wasn't valid close connection
+            self._close_connection(sock)
+            return False
+        self.thread_pool.submit(self._worker_process_msg, sock, msg)
+        return True
+
+    def _handshake_done(self, conn, future):
+        """
+        Handshake pool callback - hand the result back to the select loop.
+        """
+        with self.flush_lock:
+            self.handshakes_done.append((conn, future))
+        self._wake_loop()
+
+    def _finish_handshakes(self):
+        """
+        Move the connections whose aes key was decrypted to the encrypted state
+        and handle the frames they sent meanwhile.
+        """
+        with self.flush_lock:
+            done, self.handshakes_done = self.handshakes_done, []
+        for conn, future in done:
+            if conn.sock not in self.connections:
+                continue  # timed out meanwhile
+            try:
+                aes_key, wants_ticket = split_key_exchange(future.result()) # aes key is bytes obj
+            except (ValueError, concurrent.futures.CancelledError, concurrent.futures.BrokenExecutor):
+                self._close_connection(conn.sock)
+                continue
+            self._establish_session(conn, aes_key, wants_ticket)
+            early, conn.early_frames = conn.early_frames, []
+            for frame in early:
+                if not self._handle_frame(conn, frame):
+                    break
+
+    def _establish_session(self, conn, aes_key, send_ticket):
+        """
+        Move a connection to the encrypted state once its session key is known.
+
+        :param conn: The pending connection
+        :type conn: Connection
+        :param aes_key: The session key
+        :type aes_key: bytes
+        :param send_ticket: Send the client a ticket to resume the session with
+        :type send_ticket: bool
+        """
+        sock = EncryptedSocket(conn.sock, AESCryptGCM(aes_key))
+        self.connections.promote(conn.sock, sock)
+        conn.handshake = None
+        conn.timer.cancel()
+        self._schedule_keep_alive(conn)
+        if send_ticket:
+            self._send_to_client(sock, self.tickets.issue(aes_key))
+        print("added user!")
+
+    def _flush_ready_connections(self):
+        """
+        Drain the wakeup socket and flush every connection the workers queued frames for.
+        All the frames queued since the last pass (e.g. TRYING to the caller and the INVITE
+        to the callee) go out in this single pass, one sendmsg per connection.
+        """
+        try:
+            while self.wakeup_recv.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        with self.flush_lock:
+            ready, self.flush_ready = self.flush_ready, set()
+        for conn in ready:
+            if conn.sock in self.connections:
+                self._flush_connection(conn)
+
+    def _flush_connection(self, conn):
+        """
+        Send what the socket takes from the connection's queue and update what the selector
+        watches: write readiness while frames are left, and no reads while the client isn't
+        reading its responses (above the high water mark).
+
+        :param conn: The connection to flush
+        :type conn: Connection
+        """
+        try:
+            conn.writer.flush(conn.sock)
+        except socket.error as err:
+            print(f"couldnt send: {err}")
+            self._close_connection(conn.sock)
+            return
+        events = 0 if conn.writer.paused else selectors.EVENT_READ
+        if len(conn.writer):
+            events |= selectors.EVENT_WRITE
+        self.connections.watch(conn, events)
+
+    def start_async(self):
+        """
+        Start the SIP server on an asyncio event loop instead of the select loop.
+
+        Every connection gets its own reader task, so idle registered clients cost nothing
+        per loop pass and the server is not bound by the select fd limit. Parsed messages
+        are routed to the same worker pool and handlers as in start().
+        """
+        try:
+            asyncio.run(self._serve_async())
+        except KeyboardInterrupt:
+            print("stopping")
         except Exception as err:
             print(str(err) + ' ' + "something went wrong!")
         finally:
-            self.thread_pool.shutdown(wait=True)
-            self.running = False
+            self._shutdown()
+
+    async def _serve_async(self):
+        """
+        Bind the asyncio listener and keep it open while the server is running.
+        """
+        self.running = True
+        server = await asyncio.start_server(self._handle_async_client, self.host, self.port,
+                                            backlog=ASYNC_QUEUE_LEN, reuse_port=self.cluster is not None,
+                                            start_serving=False)
+        print(f"listening on {self.host}:{self.port} (asyncio)")
+        # bound - clients wait in the backlog until the key is ready
+        await asyncio.get_running_loop().run_in_executor(None, self._wait_for_keys)
+        await server.start_serving()
+        if self.udp_port:
+            self.udp_loop = asyncio.get_running_loop()
+            self.udp_transport, _ = await self.udp_loop.create_datagram_endpoint(
+                lambda: SIPDatagramProtocol(self._handle_datagram), local_addr=(self.host, self.udp_port),
+                reuse_port=self.cluster is not None)
+            print(f"listening for sip over udp on {self.host}:{self.udp_port} (asyncio)")
+        plain_server = None
+        if self.plain_port:
+            plain_server = await asyncio.start_server(self._handle_async_plain_client, self.host, self.plain_port,
+                                                      backlog=ASYNC_QUEUE_LEN, reuse_port=self.cluster is not None)
+            print(f"listening for plain sip on {self.host}:{self.plain_port} (asyncio)")
+
+        self._start_timers()
+        self._load_banned_ips()
+
+        try:
+            async with server:
+                while self.running:
+                    await asyncio.sleep(0.5)
+        finally:
+            if plain_server:
+                plain_server.close()
+            if self.udp_transport:
+                self.udp_transport.close()
+
+    async def _handle_async_client(self, reader, writer):
+        """
+        Reader task for a single client connection: key exchange, then receive,
+        decrypt and dispatch SIP messages until the connection ends.
+
+        :param reader: Stream reader of the client connection
+        :type reader: asyncio.StreamReader
+        :param writer: Stream writer of the client connection
+        :type writer: asyncio.StreamWriter
+        """
+        loop = asyncio.get_running_loop()
+        addr = writer.get_extra_info('peername')
+        if not self._accept_connection(addr[0]):
+            writer.close()
+            return
+
+        sock = AsyncEncryptedSocket(writer, None, loop)
+        try:
+            # send rsa key and wait for the client's aes key (or session ticket)
+            send_encrypted(sock, self.public_key)
+            aes_key, wants_ticket, resume_refused = None, False, False
+            while aes_key is None:
+                key_frame = await asyncio.wait_for(recv_encrypted_async(reader), KEEP_ALIVE_SECONDS)
+                if key_frame == b'':
+                    writer.close()
+                    return
+                if is_resume_frame(key_frame) and not resume_refused:
+                    aes_key, wants_ticket = self.tickets.resume(key_frame), True
+                    if aes_key is None:
+                        resume_refused = True
+                        send_encrypted(sock, RESUME_REJECTED)  # the client falls back to rsa
+                    continue
+                # rsa is cpu heavy - keep it off the event loop
+                future = self.handshakes.submit(key_frame)
+                if future is None:
+                    print("handshake queue is full")
+                    return
+                aes_key, wants_ticket = split_key_exchange(await asyncio.wrap_future(future))
+            sock.encrypt_obj = AESCryptGCM(aes_key)
             with self.conn_lock:
-                while self.connected_users:
-                    self.connected_users.pop().close()
-            print("ending1")
-            self._save_banned_ip()
+                self._schedule_keep_alive(self.connections.add_encrypted(sock))
+            if wants_ticket:
+                self._send_to_client(sock, self.tickets.issue(aes_key))
+            print(f"added user at {addr}")
+
+            while self.running:
+                msg_encrypted = await recv_encrypted_async(reader)
+                if msg_encrypted == b'' or not self._check_msg_rate(sock):
+                    break
+                msg = self._decrypt_msg(sock, msg_encrypted)
+                if not msg:
+                    break
+                self.thread_pool.submit(self._worker_process_msg, sock, msg)
+        except (asyncio.TimeoutError, ValueError, ConnectionError) as err:
+            print(f"closing {addr}: {err}")
+        except asyncio.CancelledError:
+            pass  # server is shutting down
+        finally:
+            with self.conn_lock:
+                connected = sock in self.connections
+            if connected:
+                self._close_connection(sock)
+            else:
+                writer.close()
+
+    async def _handle_async_plain_client(self, reader, writer):
+        """
+        Reader task for a plain SIP over TCP client: no key exchange, the messages are
+        framed by their headers and dispatched like the decrypted ones.
+
+        :param reader: Stream reader of the client connection
+        :type reader: asyncio.StreamReader
+        :param writer: Stream writer of the client connection
+        :type writer: asyncio.StreamWriter
+        """
+        addr = writer.get_extra_info('peername')
+        if not self._accept_connection(addr[0]):
+            writer.close()
+            return
+
+        sock = AsyncEncryptedSocket(writer, None, asyncio.get_running_loop())
+        with self.conn_lock:
+            conn = self.connections.add_plain(sock)
+            self._schedule_keep_alive(conn)
+        print(f"added plain sip client at {addr}")
+        try:
+            while self.running:
+                data = await reader.read(FRAME_BUFFER_SIZE)
+                if not data:
+                    break
+                for raw in conn.decoder.feed(data):
+                    if not self._check_msg_rate(sock):
+                        return
+                    msg = SIPMsgFactory.parse(raw)
+                    if not msg:
+                        return
+                    self.thread_pool.submit(self._worker_process_msg, sock, msg)
+        except (ValueError, ConnectionError) as err:
+            print(f"closing {addr}: {err}")
+        except asyncio.CancelledError:
+            pass  # server is shutting down
+        finally:
+            with self.conn_lock:
+                connected = sock in self.connections
+            if connected:
+                self._close_connection(sock)
+            else:
+                writer.close()
+
+    def _wait_for_keys(self):
+        """
+        Wait for the rsa key the constructor started loading and start the handshake pool with it.
+        """
+        self.key_thread.join()
+        self.public_key = self.rsa_crypt.export_public_key()
+        self.handshakes = HandshakePool(self.rsa_crypt)
+
+    def _start_timers(self):
+        """
+        Start the timer thread with the server's periodic timers (and the relay thread of a worker).
+        """
+        self.timers.start()
+        self.timers.schedule(RATE_EVICT_SECONDS, self._evict_rate_limits)
+        if self.udp_port:
+            self.timers.schedule(UDP_PEER_IDLE_SECONDS, self._sweep_udp_peers)
+        if self.cluster:
+            threading.Thread(target=self._relay_loop, name=f"relay_{self.worker_id}", daemon=True).start()
+
+    def _shutdown(self):
+        """
+        Stop the workers, close every client connection and persist the banned ips.
+        """
+        self.thread_pool.shutdown(wait=True)
+        if self.handshakes:
+            self.handshakes.shutdown()
+        self.running = False
+        self.timers.stop()
+        with self.conn_lock:
+            for sock in list(self.connections.connections):
+                self.connections.remove(sock)
+                sock.close()
+        print("ending1")
+        self._save_banned_ip()
+        if self.selector:
+            self.selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+        if self.server_socket:
             self.server_socket.close()
+        if self.plain_socket:
+            self.plain_socket.close()
+        if self.udp_socket:
+            self.udp_socket.close()
+
+    def _accept_connection(self, client_ip):
+        """
+        Check a new connection against the blacklist, the connection limit and the
+        per ip rate limit. Ips that connect too often are blacklisted.
+
+        :param client_ip: Ip address of the connecting client
+        :type client_ip: str
+
+        :return: True if the connection may proceed, False if it should be closed
+        :rtype: bool
+        """
+        if client_ip in self.blacklist_ips or len(self.connections) >= self.max_connected:
+            print("blacklisted")
+            return False
+        with self.ip_lock:
+            if not self.conn_limiter.allow(client_ip):
+                print(f"Blacklisting IP {client_ip} for excessive connections.")
+                self.blacklist_ips.add(client_ip)
+                self.conn_limiter.forget(client_ip)
+                return False
+        return True
+
+    def _check_msg_rate(self, sock):
+        """
+        Message rate limit for a single connection.
+
+        :param sock: Socket the message arrived on
+        :type sock: EncryptedSocket
+
+        :return: True if the message is within the limit, False if the connection should be closed
+        :rtype: bool
+        """
+        if sock not in self.connections:
+            return False
+        with self.ip_lock:
+            # if too many msgs close connection
+            if not self.msg_limiter.allow(sock):
+                print(f"Too many messages from {sock}, closing connection.")
+                return False
+        return True
+
+    def _decrypt_msg(self, sock, msg_encrypted):
+        """
+        Decrypt a received frame and parse it into a SIP message.
+
+        :param sock: Socket the frame arrived on
+        :type sock: EncryptedSocket
+        :param msg_encrypted: The encrypted frame
+        :type msg_encrypted: bytes or memoryview
+
+        :return: The parsed SIP message or None if it isn't valid
+        :rtype: SIPRequest or SIPResponse or None
+        """
+        print(f"msg enc: {msg_encrypted}")
+        print(f"decrypt with key: {sock.encrypt_obj.key}")
+        msg_raw = sock.encrypt_obj.decrypt(msg_encrypted)  # the frame is a view of the reader's buffer
+        print(f"msg_raw is: {msg_raw}")
+        msg = SIPMsgFactory.parse(msg_raw)
+        print(f"got msg: {msg}")
+        return msg
 
     def _load_banned_ips(self):
         """
@@ -417,6 +1339,8 @@ class SIPServer:
         :param msg: SIP message object (request or response)
         :type msg: SIPRequest or SIPResponse
         """
+        if self.cluster and self._relay_from_client(sock, msg):
+            return  # the call is handled by another worker
         if isinstance(msg, SIPRequest):
             self.process_request(sock, msg)
         else:
@@ -434,10 +1358,11 @@ class SIPServer:
         not_valid = self._check_request_validly(req)
         if not_valid:
             print("not valid request!")
-            self._send_to_client(sock, str(not_valid).encode())
-            if not_valid.get_header('call-id'):
-                with self.call_lock:
-                    call_obj = self.active_calls[req.get_header('call-id')]
+            self._send_to_client(sock, not_valid.to_bytes(), not_valid)
+            if not_valid.call_id:
+                call_id = req.call_id
+                with self.active_calls.lock(call_id):
+                    call_obj = self.active_calls.get(call_id)
                     if call_obj:
                         call_obj.last_used_cseq_num += 1  # Next request expects the next cseq number
         else:
@@ -466,14 +1391,14 @@ class SIPServer:
         if msg.version != SIP_VERSION:
             status = SIPStatusCode.VERSION_NOT_SUPPORTED
             msg.version = SIP_VERSION
-        if not REQUIRED_HEADERS.issubset(msg.headers):
+        missing = msg.missing_headers(REQUIRED_HEADERS)  # doesn't parse the optional headers
+        if missing:
             status = SIPStatusCode.BAD_REQUEST
-            missing = REQUIRED_HEADERS - msg.headers.keys()
-            for header in missing:
+            for header in missing - {'cseq'}:
                 msg.set_header(header, "missing")
-        if msg.get_header('cseq')[1] != msg.method:
+        if msg.cseq is None or msg.cseq.method != sip_method(msg.method):
             status = SIPStatusCode.BAD_REQUEST
-            msg.set_header('cseq', [msg.get_header('cseq')[0], msg.method.lower()])
+            msg.cseq = CSeq(msg.cseq.number if msg.cseq else 0, msg.method.lower())
         # elif len(msg.body) != msg.get_header('content-length'):
         #     error_msg.status_code = SIPStatusCode.BAD_REQUEST
 
@@ -491,30 +1416,30 @@ class SIPServer:
         :param req: The BYE SIP request
         :type req: SIPRequest
         """
-        uri_send = req.get_header('from')
-        uri_recv = req.get_header('to')
-        call_id = req.get_header("call-id")
-        cseq = req.get_header('cseq')[0]
-        with self.call_lock:  # it's better to get the lock for the whole func instead of acquiring multiple times
-            # verify call details are the ok
-            if call_id in self.active_calls:
-                print("in call")
-                call = self.active_calls[call_id]
-                if cseq != call.last_used_cseq_num + 1 or (
+        uri_send = req.from_uri
+        uri_recv = req.to_uri
+        call_id = req.call_id
+        cseq = req.cseq.number
+        sends = []  # sent once the shard lock is released
+        try:
+            with self.active_calls.lock(call_id):
+                # verify call details are the ok
+                call = self.active_calls.get(call_id)
+                if not call or cseq != call.last_used_cseq_num + 1 or (
                         call.uri != uri_recv and call.uri != uri_send) or call.call_type != SIPCallType.INVITE and call.call_state != SIPCallState.IN_CALL:
                     print("call invalid")
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+                    sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
                     return
                 call.last_active = datetime.datetime.now()
                 call.last_used_cseq_num = cseq
 
-            # call valid - foward request
-            print("bye valid")
-            send_sock = call.caller_socket if call.callee_socket == sock else call.callee_socket
-            self._send_to_client(send_sock, str(req).encode())
-            print("sended msg")
-            call.call_state = SIPCallState.WAITING_BYE
+                # call valid - foward request
+                print("bye valid")
+                send_sock = call.caller_socket if call.callee_socket == sock else call.callee_socket
+                sends.append((send_sock, req.to_bytes(), req))
+                call.call_state = SIPCallState.WAITING_BYE
+        finally:
+            self._send_all(sends)
 
     def ack_request(self, sock, req):
         """
@@ -525,41 +1450,43 @@ class SIPServer:
         :param req: The ACK SIP request
         :type req: SIPRequest
         """
-        print("starting")
-        uri_recv = req.get_header('to')
-        call_id = req.get_header("call-id")
-        cseq = req.get_header('cseq')[0]
+        uri_recv = req.to_uri
+        call_id = req.call_id
+        cseq = req.cseq.number
+        sends = []
         # pass ack to the other side start rtp
-        with self.call_lock:  # it's better to get the lock for the whole func instead of acquiring multiple times
-            # verify call details are the ok
-            if call_id in self.active_calls:
-                print("in call")
-                call = self.active_calls[call_id]
+        try:
+            with self.active_calls.lock(call_id):
+                # verify call details are the ok
+                call = self.active_calls.get(call_id)
+                if not call:
+                    return
                 print(call)
-                print(cseq)
+                if (call.call_state == SIPCallState.IN_CALL and cseq == call.last_used_cseq_num
+                        and call.call_type == SIPCallType.INVITE and call.caller_socket == sock):
+                    # the ACK again, for a retransmitted 200 OK - the callee didn't get the first one
+                    sends.append((call.callee_socket, req.to_bytes(), req))
+                    return
                 if cseq != call.last_used_cseq_num + 1 or call.uri != uri_recv or call.call_type != SIPCallType.INVITE or call.caller_socket != sock:
                     print("call invalid")
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+                    sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
                     return
                 call.last_active = datetime.datetime.now()
                 call.last_used_cseq_num = cseq
 
-                print("hello")
-                print(call.call_state)
                 # call is valid. now we need to check which type of ack is this
                 if call.call_state == SIPCallState.WAITING_ACK:
                     print("waiting to ack")
                     # this is an invite ack - set state to in call, pass to the other side
                     call.call_state = SIPCallState.IN_CALL
-                    print()
-                    self._send_to_client(call.callee_socket, str(req).encode())
+                    sends.append((call.callee_socket, req.to_bytes(), req))
                 elif call.call_state == SIPCallState.TRYING_CANCEL:
                     # maybe add another state for after trying
 
                     # this is a cancel ack - delete call
-                    del self.active_calls[call_id]
-        # call verified
+                    self.active_calls.remove(call_id)
+        finally:
+            self._send_all(sends)
 
     def cancel_request(self, sock, req):
         """
@@ -571,38 +1498,37 @@ class SIPServer:
         :type req: SIPRequest
         """
         # in register uri the uri you are trying to register
-        uri_sender = req.get_header('from')
-        uri_recv = req.get_header('to')
-        call_id = req.get_header("call-id")
-        cseq = req.get_header('cseq')[0]
-        with self.call_lock:  # it's better to get the lock for the whole func instead of acquiring multiple times
-            # verify call details are the ok
-            call = None
-            if call_id in self.active_calls:
-                call = self.active_calls[call_id]
-                if cseq != call.last_used_cseq_num + 1 or call.uri != uri_recv or call.method != req.method or call.call_type != SIPMethod.INVITE or sock is not call.callee_socket or call.call_state != SIPCallState.RINGING:
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+        uri_recv = req.to_uri
+        call_id = req.call_id
+        cseq = req.cseq.number
+        sends = []
+        try:
+            with self.active_calls.lock(call_id):
+                # verify call details are the ok
+                call = self.active_calls.get(call_id)
+                if not call or cseq != call.last_used_cseq_num + 1 or call.uri != uri_recv or call.method != req.method or call.call_type != SIPMethod.INVITE or sock is not call.callee_socket or call.call_state != SIPCallState.RINGING:
+                    sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
                     return
-                    # the call is in the correct state and can be canceled
+                # the call is in the correct state and can be canceled
                 call.last_active = datetime.datetime.now()
                 call.last_used_cseq_num = cseq
 
-            # send ok response so the client knows I received. the canceling side must be the callee
-            res_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK, SERVER_URI)
-            self._send_to_client(sock, str(res_msg).encode())
+                # send ok response so the client knows I received. the canceling side must be the callee
+                sends.append((sock, *self._reply(req, SIPStatusCode.OK)))
 
-            # send cancel to the other side
-            req.set_header('cseq', (cseq + 1, req.get_header('cseq')[1]))
-            req.set_header('from', SERVER_URI)
-            if call.uri_other is not None:
-                # other uri in invite is always the
-                req.set_header('to', call.uri_other)
-            else:
-                req.set_header('to', 'cancel')
+                # send cancel to the other side
+                req.set_header('cseq', CSeq(cseq + 1, req.cseq.method))
+                req.set_header('from', SERVER_URI)
+                if call.uri_other is not None:
+                    # other uri in invite is always the
+                    req.set_header('to', call.uri_other)
+                else:
+                    req.set_header('to', 'cancel')
 
-            self._send_to_client(call.caller_socket, str(req).encode())
-            self.active_calls[call_id].call_state = SIPCallState.INIT_CANCEL
+                sends.append((call.caller_socket, req.to_bytes(), req))
+                call.call_state = SIPCallState.INIT_CANCEL
+        finally:
+            self._send_all(sends)
 
     def invite_request(self, sock, req):
         """
@@ -616,111 +1542,106 @@ class SIPServer:
         print("-----------------------------------------")
         print(req)
         # in register uri the uri you are trying to register
-        uri_sender = req.get_header('from')
-        uri_recv = req.get_header('to')
-        call_id = req.get_header("call-id")
-        cseq = req.get_header('cseq')[0]
+        uri_sender = req.from_uri
+        uri_recv = req.to_uri
+        call_id = req.call_id
+        cseq = req.cseq.number
 
         # verify uri of the sender is real
         if not self.user_db.user_exists(uri_sender):
             print("didnt find user...")
-            error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.NOT_FOUND, SERVER_URI)
-            self._send_to_client(sock, str(error_msg).encode())
+            self._send_to_client(sock, *self._reply(req, SIPStatusCode.NOT_FOUND))
             return
         # verify not the same user
         if uri_sender == uri_recv:
             print("sending err")
-            error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-            self._send_to_client(sock, str(error_msg).encode())
+            self._send_to_client(sock, *self._reply(req, SIPStatusCode.BAD_REQUEST))
             return
 
-        with self.call_lock:  # it's better to get the lock for the whole func instead of acquiring multiple times
-            # verify call details are the ok
-            call = None
-            if call_id in self.active_calls:
-                call = self.active_calls[call_id]
-                if cseq != call.last_used_cseq_num + 1 or call.uri != uri_recv or call.call_type != SIPCallType.INVITE or sock is not call.caller_socket:
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
-                    return
-            else:
-                call = Call(
-                    call_type=SIPCallType.INVITE,
-                    call_id=call_id,
-                    uri=uri_recv,
-                    caller_socket=sock,
-                    call_state=SIPCallState.WAITING_AUTH,
-                    last_used_cseq_num=cseq,
-                    last_active=datetime.datetime.now()
-                )
-                self.active_calls[call_id] = call
-            call.last_active = datetime.datetime.now()
+        # make sure we can call the callee and check if the caller is authenticated.
+        # looked up before the call lock - the registrations are never locked under a call
+        with self.reg_lock:
+            user_recv = self.registered_user.get_by_val(uri_recv)
+            user_sender = self.registered_user.get_by_key(sock)
+            is_auth = bool(self.registered_user.get_by_val(uri_sender) and user_sender)
+        # the callee may be connected to another worker
+        callee_sock = user_recv.socket if user_recv else self._remote_client(uri_recv)
 
-            # made sure the user is auth
-            # make sure we can call the callee
-            is_auth = False
-            user_recv = None
-            with self.reg_lock:
-                user_recv = self.registered_user.get_by_val(uri_recv)
-                if not user_recv:
+        sends = []
+        try:
+            with self.active_calls.lock(call_id):
+                # verify call details are the ok
+                call = self.active_calls.get(call_id)
+                if call:
+                    if cseq != call.last_used_cseq_num + 1 or call.uri != uri_recv or call.call_type != SIPCallType.INVITE or sock is not call.caller_socket:
+                        sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
+                        return
+                else:
+                    call = Call(
+                        call_type=SIPCallType.INVITE,
+                        call_id=call_id,
+                        uri=uri_recv,
+                        caller_socket=sock,
+                        call_state=SIPCallState.WAITING_AUTH,
+                        last_used_cseq_num=cseq,
+                        last_active=datetime.datetime.now()
+                    )
+                    self.active_calls.add(call)
+                    self.timers.schedule(CALL_IDLE_LIMIT, self._call_idle_timeout, call)
+                call.last_active = datetime.datetime.now()
+
+                if not callee_sock:
                     print("user removes from register")
                     # can't contact callee
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.NOT_FOUND, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+                    sends.append((sock, *self._reply(req, SIPStatusCode.NOT_FOUND)))
                     return
                 # now we know who we're trying to call
-                call.callee_socket = user_recv.socket
-                if self.registered_user.get_by_val(uri_sender) and self.registered_user.get_by_key(sock):
-                    is_auth = True
-                    call.uri_other = self.registered_user.get_by_key(sock).uri  # set the other uri in the call
-
-            if not is_auth:
-                print("authing")
-                auth_header = req.get_header('www-authenticate')
-                if auth_header:
-                    if call_id not in self.pending_auth.keys():
-                        # auth request was either timed out or never sent
-                        self._create_auth_challenge(sock, req)
-                        return
-                    # verify auth response
-                    auth_header_parsed = self._parse_auth_header(auth_header)
-                    if not auth_header_parsed:
-                        error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST,
-                                                                               SERVER_URI)
-                        self._send_to_client(sock, str(error_msg).encode())
-                    else:
-                        password = self.user_db.get_password(uri_sender) # this is the ha1
-                        answer_now = calculate_hash_auth(
-                                                                        password,
-                                                                        SIPMethod.REGISTER.value,
-                                                                        auth_header_parsed['nonce'],
-                                                                        auth_header_parsed['realm'])
-                        # verify in server
-                        if answer_now != auth_header_parsed['response'] or answer_now != self.pending_auth[
-                            call_id].answer:
-                            error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.FORBIDDEN,
-                                                                                   SERVER_URI)
-                            self._send_to_client(sock, str(error_msg).encode())
+                self.active_calls.set_callee(call, callee_sock)
+                if is_auth:
+                    self.active_calls.set_uri_other(call, user_sender.uri)  # set the other uri in the call
+
+                if not is_auth:
+                    print("authing")
+                    auth_header = req.get_header('www-authenticate')
+                    if auth_header:
+                        if call_id not in self.pending_auth.keys():
+                            # auth request was either timed out or never sent
+                            sends.append((sock, self._create_auth_challenge(req), req, SIPStatusCode.UNAUTHORIZED))
                             return
-                else:
-                    # if not authenticated
-                    self._create_auth_challenge(sock, req)
+                        # verify auth response
+                        auth_header_parsed = self._parse_auth_header(auth_header)
+                        if not auth_header_parsed:
+                            sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
+                        else:
+                            password = self.user_db.get_password(uri_sender) # this is the ha1
+                            answer_now = calculate_hash_auth(
+                                                                            password,
+                                                                            SIPMethod.REGISTER.value,
+                                                                            auth_header_parsed['nonce'],
+                                                                            auth_header_parsed['realm'])
+                            # verify in server
+                            if answer_now != auth_header_parsed['response'] or answer_now != self.pending_auth[
+                                call_id].answer:
+                                sends.append((sock, *self._reply(req, SIPStatusCode.FORBIDDEN)))
+                                return
+                    else:
+                        # if not authenticated
+                        sends.append((sock, self._create_auth_challenge(req), req, SIPStatusCode.UNAUTHORIZED))
 
-            print("authd")
+                print("authd")
 
-            # now we know the user is authenticated we can proceed to send the invite
-            if call_id in self.pending_auth:
-                del self.pending_auth[call_id]
+                # now we know the user is authenticated we can proceed to send the invite
+                self._drop_auth_challenge(call_id)
 
-            call.call_state = SIPCallState.TRYING
-            if not req.body:
-                error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                self._send_to_client(sock, str(error_msg).encode())
-                return
-            self._send_to_client(call.callee_socket, str(req).encode())
-            self._send_to_client(call.caller_socket,
-                                 str(SIPMsgFactory.create_response_from_request(req, SIPStatusCode.TRYING,
-                                                                                SERVER_URI)).encode())
+                call.call_state = SIPCallState.TRYING
+                if not req.body:
+                    sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
+                    return
+                sends.append((call.callee_socket, req.to_bytes(), req))
+                sends.append((call.caller_socket,
+                              *self._reply(req, SIPStatusCode.TRYING)))
+        finally:
+            self._send_all(sends)
 
     def register_request(self, sock, req):
         """
@@ -732,40 +1653,36 @@ class SIPServer:
         :type req: SIPRequest
         """
         # in register uri the uri you are trying to register
-        uri = req.get_header('from')
-        to_uri = req.get_header('to')
-        call_id = req.get_header("call-id")
-        cseq = req.get_header('cseq')[0]
+        uri = req.from_uri
+        to_uri = req.to_uri
+        call_id = req.call_id
+        cseq = req.cseq.number
         expires = REGISTER_LIMIT
         if req.get_header('expires'):
             expires = int(req.get_header('expires'))
 
         if to_uri != SERVER_URI:
             # register is to the server only
-            error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_GATEWAY, SERVER_URI)
-            self._send_to_client(sock, str(error_msg).encode())
+            self._send_to_client(sock, *self._reply(req, SIPStatusCode.BAD_GATEWAY))
             return
 
         if not self.user_db.user_exists(uri):
             print("error")
             # register is to the server only
-            error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.NOT_FOUND, SERVER_URI)
-            self._send_to_client(sock, str(error_msg).encode())
+            self._send_to_client(sock, *self._reply(req, SIPStatusCode.NOT_FOUND))
             return
         print("user exists")
 
-        with self.call_lock:
+        with self.active_calls.lock(call_id):
             # verify call details are the ok
-            call = None
-            if call_id in self.active_calls:
-                call = self.active_calls[call_id]
+            call = self.active_calls.get(call_id)
+            if call:
                 if cseq != call.last_used_cseq_num + 1 or call.uri != uri or call.call_type != SIPCallType.REGISTER or sock is not call.caller_socket:
                     print(cseq)
                     print(call.last_used_cseq_num + 1)
                     print("not standart call")
                     error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
-                    return
+                    call = None
             else:
                 call = Call(
                     call_type=SIPCallType.REGISTER,
@@ -778,103 +1695,108 @@ class SIPServer:
                     last_used_cseq_num=cseq,
                     last_active=datetime.datetime.now(),
                 )
-                self.active_calls[call_id] = call
-
-            call.last_active = datetime.datetime.now()
+                self.active_calls.add(call)
+                self.timers.schedule(CALL_IDLE_LIMIT, self._call_idle_timeout, call)
+            if call:
+                call.last_active = datetime.datetime.now()
+        if not call:
+            self._send_to_client(sock, error_msg.to_bytes(), error_msg)
+            return
 
         print(f"for {uri} checking prev")
 
+        sends = []
         with self.reg_lock:
             need_auth = True
             if self.registered_user.get_by_key(sock):  # user has registered in the connection
                 if self.registered_user.get_by_key(sock).uri == uri:  # the registration was for the same uri
                     # this is the same user in the same connection that was already authenticated
-                    with self.reg_lock:
-                        user = RegisteredUser(
-                            uri=uri,
-                            address=sock.getpeername(),
-                            socket=sock,
-                            registration_time=datetime.datetime.now(),
-                            expires=expires,
-                        )
-                        print(user)
-                        self.registered_user.add(user)  # overrides previous register if exists
-                        print("registered")
-                        self._send_to_client(sock, str(SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK,
-                                                                                              SERVER_URI)).encode())
+                    user = RegisteredUser(
+                        uri=uri,
+                        address=sock.getpeername(),
+                        socket=sock,
+                        registration_time=datetime.datetime.now(),
+                        expires=expires,
+                    )
+                    print(user)
+                    self._add_registration(user)  # overrides previous register if exists
+                    print("registered")
+                    sends.append((sock, *self._reply(req, SIPStatusCode.OK)))
 
                     need_auth = False
 
             if self.registered_user.get_by_val(
-                    uri):  # if the tries to register to a uri that is logged in but isn't him
+                    uri) or self._registered_elsewhere(uri):  # if the tries to register to a uri that is logged in but isn't him
                 # someone is registered to the uri already
-                error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.FORBIDDEN, SERVER_URI)
-                self._send_to_client(sock, str(error_msg).encode())
+                sends.append((sock, *self._reply(req, SIPStatusCode.FORBIDDEN)))
                 need_auth = False
 
-            print(f"neede auth for {uri} - {need_auth}")
+        print(f"neede auth for {uri} - {need_auth}")
+        self._send_all(sends)
 
-            if not need_auth:
-                del self.active_calls[call_id]
-                return
+        if not need_auth:
+            with self.active_calls.lock(call_id):
+                self.active_calls.remove(call_id)
+            return
 
         auth_header = req.get_header('www-authenticate')
         print(f"got auth header - {bool(auth_header)}")
         if auth_header:
-            with self.call_lock:
+            authenticated = False
+            with self.active_calls.lock(call_id):
                 if call_id not in self.pending_auth:
                     # auth request was either timed out or never sent
-                    self._create_auth_challenge(sock, req)
-                    return
-                # verify auth response
-                auth_header_parsed = self._parse_auth_header(auth_header)
-                if not auth_header_parsed:
-                    print("couldnt pass auth header")
-                    error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.BAD_REQUEST, SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+                    sends = [(sock, self._create_auth_challenge(req), req, SIPStatusCode.UNAUTHORIZED)]
                 else:
-                    password = self.user_db.get_password(uri)
-                    answer_now = calculate_hash_auth(
-                                                                    password,
-                                                                    SIPMethod.REGISTER.value,
-                                                                    auth_header_parsed['nonce'],
-                                                                    auth_header_parsed['realm'])
-                    # answer now based on the vars he sent
-
-                    if answer_now != auth_header_parsed['response'] or answer_now != self.pending_auth[call_id].answer:
-                        error_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.FORBIDDEN, SERVER_URI)
-                        self._send_to_client(sock, str(error_msg).encode())
+                    sends = []
+                    # verify auth response
+                    auth_header_parsed = self._parse_auth_header(auth_header)
+                    if not auth_header_parsed:
+                        print("couldnt pass auth header")
+                        sends.append((sock, *self._reply(req, SIPStatusCode.BAD_REQUEST)))
                     else:
-                        # user authenticated
-                        del self.pending_auth[call_id]
-                        del self.active_calls[call_id]
-
-                        print("user authenticated")
-                        with self.reg_lock:
-                            # if user has previous registration delete it
-                            if self.registered_user.get_by_key(sock):
-                                print(f"removing prev reg: {self.registered_user.get_by_key(sock)}")
-                                self.registered_user.remove_by_key(sock)
-                            user = RegisteredUser(
-                                uri=uri,
-                                address=sock.getpeername(),
-                                socket=sock,
-                                registration_time=datetime.datetime.now(),
-                                expires=expires,
-                            )
-                            print("hello?")
-                            print(f"crated user: {user}")
-                            self.registered_user.add(user)  # overrides previous register if exists
-                            print(f"sending: {str(SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK,
-                                                                                                SERVER_URI))}")
-                            self._send_to_client(sock,
-                                                 str(SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK,
-                                                                                                SERVER_URI)).encode())
-                            print("send msg")
+                        password = self.user_db.get_password(uri)
+                        answer_now = calculate_hash_auth(
+                                                                        password,
+                                                                        SIPMethod.REGISTER.value,
+                                                                        auth_header_parsed['nonce'],
+                                                                        auth_header_parsed['realm'])
+                        # answer now based on the vars he sent
+
+                        if answer_now != auth_header_parsed['response'] or answer_now != self.pending_auth[call_id].answer:
+                            sends.append((sock, *self._reply(req, SIPStatusCode.FORBIDDEN)))
+                        else:
+                            # user authenticated
+                            self._drop_auth_challenge(call_id)
+                            self.active_calls.remove(call_id)
+                            authenticated = True
+            self._send_all(sends)
+
+            if authenticated:
+                print("user authenticated")
+                with self.reg_lock:
+                    # if user has previous registration delete it
+                    if self.registered_user.get_by_key(sock):
+                        print(f"removing prev reg: {self.registered_user.get_by_key(sock)}")
+                        self._remove_registration(sock)
+                    user = RegisteredUser(
+                        uri=uri,
+                        address=sock.getpeername(),
+                        socket=sock,
+                        registration_time=datetime.datetime.now(),
+                        expires=expires,
+                    )
+                    print(f"crated user: {user}")
+                    self._add_registration(user)  # overrides previous register if exists
+                ok_msg = SIPMsgFactory.create_response_from_request(req, SIPStatusCode.OK, SERVER_URI)
+                print(f"sending: {ok_msg}")
+                self._send_to_client(sock, ok_msg.to_bytes(), ok_msg)
 
         else:
             print("none")
-            self._create_auth_challenge(sock, req)
+            with self.active_calls.lock(call_id):
+                challenge_msg = self._create_auth_challenge(req)
+            self._send_to_client(sock, challenge_msg, req, SIPStatusCode.UNAUTHORIZED)
 
     def _parse_auth_header(self, header):
         """
@@ -910,21 +1832,22 @@ class SIPServer:
 
         return parsed
 
-    def _create_auth_challenge(self, sock, request):
+    def _create_auth_challenge(self, request):
         """
-        Send an authentication challenge to the client.
-        :param sock: Socket to send the challenge to
-        :type sock: EncryptedSocket
+        Create an authentication challenge for the client. The caller sends it.
         :param request: Original SIP request needing authentication
         :type request: SIPRequest
+
+        :return: The encoded challenge response
+        :rtype: bytes
         """
         # we assume the function that called us verified the user exists otherwise we store None
         method = request.method
-        call_id = request.get_header('call-id')
-        uri = request.get_header('from')
+        call_id = request.call_id
+        uri = request.from_uri
 
         # Store challenge
-        with self.call_lock:
+        with self.active_calls.lock(call_id):
             # Generate nonce
             nonce = generate_nonce().lower()
             print(nonce)
@@ -935,16 +1858,19 @@ class SIPServer:
                 answer=calculate_hash_auth(password, method, nonce, SERVER_URI),
                 created_time=datetime.datetime.now()
             )
+            self._drop_auth_challenge(call_id)  # a new challenge replaces the old one
+            challenge.timer = self.timers.schedule(AUTH_CHALLENGE_LIMIT, self._auth_challenge_expired,
+                                                   call_id, challenge)
             self.pending_auth[call_id] = challenge
         print("created")
 
         auth_header = f'digest realm="{SERVER_URI}", nonce="{nonce}", algorithm=MD5'
         # Create challenge response
-        response = SIPMsgFactory.create_response_from_request(request, SIPStatusCode.UNAUTHORIZED,
-                                                              SERVER_URI, {"www-authenticate": auth_header})
+        response = SIPMsgFactory.response_bytes(request, SIPStatusCode.UNAUTHORIZED,
+                                                SERVER_URI, {"www-authenticate": auth_header})
         print("auth challnange is:")
         print(response)
-        self._send_to_client(sock, str(response).encode())
+        return response
 
     def process_response(self, sock, res):
         """
@@ -958,16 +1884,16 @@ class SIPServer:
         not_valid = self._check_response_valid(res)
         if not_valid:
             print("not valid")
-            self._send_to_client(sock, str(not_valid).encode())
+            self._send_to_client(sock, not_valid.to_bytes(), not_valid)
             return
 
         print("valid res")
 
-        uri = res.get_header('from')
-        to_uri = res.get_header('to')
-        call_id = res.get_header("call-id")
-        cseq = res.get_header('cseq')[0]
-        call_id = res.get_header('call-id')
+        uri = res.from_uri
+        to_uri = res.to_uri
+        call_id = res.call_id
+        cseq = res.cseq.number
+        call_id = res.call_id
 
         print(f"msg: {res}")
         print(self.pending_keep_alive)
@@ -975,41 +1901,43 @@ class SIPServer:
         if to_uri == uri:
             # not valid recv
             not_valid.status_code = SIPStatusCode.BAD_REQUEST
-            self._send_to_client(sock, str(not_valid).encode())
+            self._send_to_client(sock, not_valid.to_bytes(), not_valid)
             return
-        with self.call_lock:
-            if call_id not in self.active_calls and call_id not in self.pending_keep_alive:
-                # the call doesn't exist
-                not_valid.status_code = SIPStatusCode.NOT_FOUND
-                self._send_to_client(sock, str(not_valid).encode())
-                return
-            if call_id in self.active_calls:
-                call = self.active_calls[call_id]
-                if cseq != call.last_used_cseq_num:
-                    not_valid.status_code = SIPStatusCode.BAD_REQUEST
-                    self._send_to_client(sock, str(not_valid).encode())
-                    return
-                call.last_active = datetime.datetime.now()
 
         if call_id in self.pending_keep_alive:
             print("keep alive response")
             with self.conn_lock:
                 # The response is to a keep alive
-
-                print(res.status_code is SIPStatusCode.OK and res.get_header('cseq')[0] == self.pending_keep_alive[
-                    call_id].last_used_cseq_num)
-                print(res.status_code is SIPStatusCode.OK)
-                print(res.get_header('cseq')[0] == self.pending_keep_alive[
-                    call_id].last_used_cseq_num)
-                if res.status_code is SIPStatusCode.OK and res.get_header('cseq')[0] == self.pending_keep_alive[
-                    call_id].last_used_cseq_num:
+                keep_alive = self.pending_keep_alive.get(call_id)
+                if keep_alive and res.status_code is SIPStatusCode.OK and res.cseq.number == keep_alive.last_used_cseq_num:
                     print("deleting entry")
-                    del self.pending_keep_alive[call_id]  # The response was valid so the connection is kept alive
-                # Else response is invalid, and we drop them at the next keep_alive check
-        else:
-            # If not keep alive then it's for an invite call
-            with self.call_lock:
-                call = self.active_calls[call_id]
+                    self.pending_keep_alive.pop(call_id)  # The response was valid so the connection is kept alive
+                    conn = self.connections.get(keep_alive.client_socket)
+                    if conn:
+                        conn.keep_alive = None
+                # Else response is invalid, and we drop them when the keep alive timer fires
+            return
+
+        # If not keep alive then it's for an invite call
+        sends = []  # sent once the shard lock is released
+        try:
+            with self.active_calls.lock(call_id):
+                call = self.active_calls.get(call_id)
+                if not call:
+                    # the call doesn't exist
+                    not_valid.status_code = SIPStatusCode.NOT_FOUND
+                    sends.append((sock, not_valid.to_bytes(), not_valid))
+                    return
+                if self._is_ok_retransmission(call, sock, res):
+                    # the caller's ACK got lost - pass the 200 on again so it ACKs again
+                    sends.append((call.caller_socket, res.to_bytes(), res))
+                    return
+                if cseq != call.last_used_cseq_num:
+                    not_valid.status_code = SIPStatusCode.BAD_REQUEST
+                    sends.append((sock, not_valid.to_bytes(), not_valid))
+                    return
+                call.last_active = datetime.datetime.now()
+
                 if call.call_type == SIPCallType.INVITE:
                     # now we check if we can advance state. if we cannot then we send and error response
 
@@ -1019,14 +1947,13 @@ class SIPServer:
 
                     elif call.call_state == SIPCallState.RINGING and res.status_code == SIPStatusCode.DECLINE:
                         print("call declined!")
-                        with self.call_lock:
-                            del self.active_calls[call_id]  # the call was declined, remove call send decline to other side
+                        self.active_calls.remove(call_id)  # the call was declined, remove call send decline to other side
                     elif call.call_state == SIPCallState.RINGING and res.status_code == SIPStatusCode.OK:
                         call.call_state = SIPCallState.WAITING_ACK
                         if not res.body:
                             print("not valid!")
                             not_valid.status_code = SIPStatusCode.BAD_REQUEST
-                            self._send_to_client(sock, str(not_valid).encode())
+                            sends.append((sock, not_valid.to_bytes(), not_valid))
                             return
                     elif call.call_state == SIPCallState.INIT_CANCEL and res.status_code == SIPStatusCode.OK:
                         call.call_state = SIPCallState.TRYING_CANCEL
@@ -1034,29 +1961,50 @@ class SIPServer:
                     elif call.call_state == SIPCallState.TRYING_CANCEL and res.status_code == SIPStatusCode.REQUEST_TERMINATED:
                         ack_req = SIPMsgFactory.create_request(SIPMethod.ACK, SIP_VERSION, uri, SERVER_URI, call_id,
                                                                cseq + 1)
-                        self._send_to_client(sock, str(ack_req).encode())
+                        sends.append((sock, ack_req.to_bytes(), ack_req))
                         # del self.active_calls[call_id] - do it in the ack
                     elif call.call_state == SIPCallState.WAITING_BYE and res.status_code == SIPStatusCode.OK:
                         print("call ended")
                         # delete call
-                        with self.call_lock:
-                            del self.active_calls[call_id]
+                        self.active_calls.remove(call_id)
 
                     else:
                         not_valid.status_code = SIPStatusCode.NOT_ACCEPTABLE
-                        self._send_to_client(sock, str(not_valid).encode())
+                        sends.append((sock, not_valid.to_bytes(), not_valid))
                         return  # we do not want to foward thhe invalid msg
 
                     # forward to other side
                     send_sock = call.caller_socket if sock != call.caller_socket else call.callee_socket
                     print(f"fowarding to: {send_sock}")
                     print(f"call:{call}")
-                    self._send_to_client(send_sock, str(res).encode())
+                    sends.append((send_sock, res.to_bytes(), res))
                 else:
                     # if the call was not an invite then it is not possible to send response
-                    error_msg = SIPMsgFactory.create_response_from_request(res, SIPStatusCode.NOT_ACCEPTABLE_ANYWHERE,
-                                                                           SERVER_URI)
-                    self._send_to_client(sock, str(error_msg).encode())
+                    sends.append((sock, *self._reply(res, SIPStatusCode.NOT_ACCEPTABLE_ANYWHERE)))
+        finally:
+            self._send_all(sends)
+
+    @staticmethod
+    def _is_ok_retransmission(call, sock, res):
+        """
+        Check if a response is the callee retransmitting the 200 OK of an accepted INVITE.
+
+        :param call: The call the response belongs to
+        :type call: Call
+        :param sock: Socket the response came from
+        :param res: The response
+        :type res: SIPResponse
+
+        :return: True if it is a retransmitted 200 OK
+        :rtype: bool
+        """
+        if (call.call_type != SIPCallType.INVITE or sock != call.callee_socket
+                or res.status_code != SIPStatusCode.OK or res.cseq.method is not SIPMethod.INVITE):
+            return False
+        if call.call_state == SIPCallState.WAITING_ACK:
+            return res.cseq.number == call.last_used_cseq_num
+        # the ACK (cseq + 1) was relayed already, the callee didn't get it
+        return call.call_state == SIPCallState.IN_CALL and res.cseq.number + 1 == call.last_used_cseq_num
 
     def _check_response_valid(self, msg):
         """
@@ -1072,10 +2020,10 @@ class SIPServer:
         if msg.version != SIP_VERSION:
             status = SIPStatusCode.VERSION_NOT_SUPPORTED
             msg.version = SIP_VERSION
-        if not REQUIRED_HEADERS.issubset(msg.headers):
+        missing = msg.missing_headers(REQUIRED_HEADERS)  # doesn't parse the optional headers
+        if missing:
             status = SIPStatusCode.BAD_REQUEST
-            missing = REQUIRED_HEADERS - msg.headers.keys()
-            for header in missing:
+            for header in missing - {'cseq'}:
                 msg.set_header(header, "missing")
         if msg.status_code not in SIPStatusCode:
             status = SIPStatusCode.BAD_REQUEST
@@ -1084,102 +2032,195 @@ class SIPServer:
         #     error_msg.status_code = SIPStatusCode.BAD_REQUEST
         error_msg = SIPMsgFactory.create_response(status, SIP_VERSION,
                                                   SIPMethod.OPTIONS,
-                                                  msg.get_header('cseq')[0],
-                                                  msg.get_header('from'),
+                                                  msg.cseq.number if msg.cseq else 0,
+                                                  msg.from_uri,
                                                   SERVER_URI,
-                                                  msg.get_header('call-id')
+                                                  msg.call_id
                                                   )
         if error_msg.status_code == SIPStatusCode.OK:
             return None
         return error_msg
 
-    def _cleanup_expired_reg(self):
-        while self.running:
-            """Removes registrations that are past expiration"""
-            with self.reg_lock:
-                for uri, user in list(self.registered_user.val_to_obj.items()):
-                    if (datetime.datetime.now() - user.registration_time).total_seconds() >= user.expires:
-                        print("expired reg")
-                        self.registered_user.remove_by_val(uri)
-            time.sleep(30)
+    def _add_registration(self, user):
+        """
+        Store a registration and schedule its expiry. Replaces the previous registration
+        of the same socket.
 
-    def _cleanup_inactive_calls(self):
-        while self.running:
-            """Removes calls with sockets that are inactive"""
-            with self.call_lock:
-                for call_id, call in list(self.active_calls.items()):
-                    if (datetime.datetime.now() - call.last_active).total_seconds() >= CALL_IDLE_LIMIT and call.call_state != SIPCallState.IN_CALL:
-
-                        # send to the clients that the call was terminated if active
-                        print(f"inactive call: {call}")
-                        end_msg = SIPMsgFactory.create_response(SIPStatusCode.DOES_NOT_EXIST_ANYWHERE, SIP_VERSION,
-                                                                SIPMethod.OPTIONS,
-                                                                call.last_used_cseq_num, 'none', SERVER_URI, call.call_id)
-                        send_sock = call.caller_socket
-                        if self.registered_user.get_by_key(send_sock):
-                            end_msg.set_header('to', self.registered_user.get_by_key(send_sock).uri)
-                        self._send_to_client(send_sock, str(end_msg).encode())
-                        del self.active_calls[call_id]
-
-                        send_sock = call.callee_socket # if it's register the callee socket will be none
-                        if send_sock:
-                            if self.registered_user.get_by_key(send_sock):
-                                end_msg.set_header('to', self.registered_user.get_by_key(send_sock).uri)
-                            else:
-                                end_msg.set_header('to', 'none')
-                            self._send_to_client(send_sock, str(end_msg).encode())
-
-                            del self.active_calls[call_id]
-
-                        # if the call was register then we need to remove the invalid auth challenge
-                        if call.uri in self.pending_auth:
-                            del self.pending_auth[call.uri]
-            time.sleep(30)
-
-    def _cleanup_ip_counters(self):
-        """
-        Periodically cleans up IP tracking dicts to prevent memory overflow.
+        :param user: The registration
+        :type user: RegisteredUser
         """
-        while self.running:
-            now = time.time()
+        with self.reg_lock:
+            prev = self.registered_user.get_by_key(user.socket)
+            if prev and prev.expiry_timer:
+                prev.expiry_timer.cancel()
+            self.registered_user.add(user)
+            user.expiry_timer = self.timers.schedule(user.expires, self._registration_expired, user)
+        if self.cluster:
+            if prev and prev.uri != user.uri:
+                self.cluster.unregister(prev.uri, self.worker_id)
+            self.cluster.register(user.uri, self.worker_id)
+
+    def _remove_registration(self, sock):
+        """
+        Remove the registration of a socket (if any) and cancel its expiry.
+
+        :param sock: The socket the user registered on
+        :type sock: EncryptedSocket
+        """
+        with self.reg_lock:
+            user = self.registered_user.get_by_key(sock)
+            if user and user.expiry_timer:
+                user.expiry_timer.cancel()
+            self.registered_user.remove_by_key(sock)
+        if user and self.cluster:
+            self.cluster.unregister(user.uri, self.worker_id)
+
+    def _registration_expired(self, user):
+        """Registration timer - removes the registration if it wasn't renewed"""
+        with self.reg_lock:
+            if self.registered_user.get_by_val(user.uri) is not user:
+                return
+            print("expired reg")
+            self.registered_user.remove_by_val(user.uri)
+        if self.cluster:
+            self.cluster.unregister(user.uri, self.worker_id)
+
+    def _drop_auth_challenge(self, call_id):
+        """
+        Forget the auth challenge of a call (if any) and cancel its expiry.
+
+        :param call_id: The call the challenge was sent in
+        :type call_id: str
+        """
+        with self.active_calls.lock(call_id):
+            challenge = self.pending_auth.pop(call_id, None)
+            if challenge and challenge.timer:
+                challenge.timer.cancel()
+
+    def _auth_challenge_expired(self, call_id, challenge):
+        """Auth challenge timer - the client didn't answer in time"""
+        with self.active_calls.lock(call_id):
+            if self.pending_auth.get(call_id) is challenge:
+                del self.pending_auth[call_id]
+
+    def _call_idle_timeout(self, call):
+        """
+        Idle timer of a call. Ends the call if nothing happened in it for CALL_IDLE_LIMIT
+        seconds, otherwise the timer is set again for the rest of the limit.
+        Calls that are in progress (IN_CALL) don't time out, their timer comes back every
+        CALL_IDLE_LIMIT seconds until the call leaves IN_CALL.
+
+        :param call: The call the timer was set for
+        :type call: Call
+        """
+        with self.active_calls.lock(call.call_id):
+            if self.active_calls.get(call.call_id) is not call:
+                return  # the call already ended
+            idle = (datetime.datetime.now() - call.last_active).total_seconds()
+            if call.call_state == SIPCallState.IN_CALL:
+                # idle is past the limit for most of a call - check back a full limit later, not every second
+                self.timers.schedule(CALL_IDLE_LIMIT, self._call_idle_timeout, call)
+                return
+            if idle < CALL_IDLE_LIMIT:
+                self.timers.schedule(max(CALL_IDLE_LIMIT - idle, 1), self._call_idle_timeout, call)
+                return
+            self.active_calls.remove(call.call_id)
+            # if the call was register then we need to remove the invalid auth challenge
+            self._drop_auth_challenge(call.call_id)
+
+        # send to the clients that the call was terminated if active
+        print(f"inactive call: {call}")
+        end_msg = SIPMsgFactory.create_response(SIPStatusCode.DOES_NOT_EXIST_ANYWHERE, SIP_VERSION,
+                                                SIPMethod.OPTIONS,
+                                                call.last_used_cseq_num, 'none', SERVER_URI, call.call_id)
+        send_sock = call.caller_socket
+        if self.registered_user.get_by_key(send_sock):
+            end_msg.set_header('to', self.registered_user.get_by_key(send_sock).uri)
+        self._send_to_client(send_sock, end_msg.to_bytes(), end_msg)
+
+        send_sock = call.callee_socket # if it's register the callee socket will be none
+        if send_sock:
+            if self.registered_user.get_by_key(send_sock):
+                end_msg.set_header('to', self.registered_user.get_by_key(send_sock).uri)
+            else:
+                end_msg.set_header('to', 'none')
+            self._send_to_client(send_sock, end_msg.to_bytes(), end_msg)
+
+    def _evict_rate_limits(self):
+        """
+        Rate limit timer - drops the state of ips that are back under their limit. Every run
+        only looks at a batch of entries, so it never sweeps the whole table at once.
+        """
+        with self.ip_lock:
+            self.conn_limiter.evict()
+            if self.udp_port:
+                self.msg_limiter.evict()  # udp clients are keyed by address and never close
+        self.timers.schedule(RATE_EVICT_SECONDS, self._evict_rate_limits)
+
+    def _sweep_udp_peers(self):
+        """
+        Udp peer timer - forgets the udp clients that were idle for a while and have no
+        registration or calls. There are no connections to close or keep alive.
+        """
+        now = time.monotonic()
+        with self.udp_lock:
+            idle = [peer for peer in self.udp_peers.values() if now - peer.last_seen > UDP_PEER_IDLE_SECONDS]
+        for peer in idle:
+            with self.reg_lock:
+                registered = self.registered_user.get_by_key(peer) is not None
+            with self.relay_lock:
+                relayed = peer in self.relayed_socks
+            if registered or relayed or self.active_calls.calls_of_socket(peer):
+                continue
+            with self.udp_lock:
+                if now - peer.last_seen <= UDP_PEER_IDLE_SECONDS:
+                    continue  # sent something meanwhile
+                del self.udp_peers[peer.addr]
             with self.ip_lock:
-                for ip_dict in [self.ip_connection_counts, self.ip_message_counts]:
-                    inactive_ips = []
-                    for key, value in ip_dict.items():
-                        ip_dict[key] = [t for t in value if now - t < self.time_window]
-                        if not ip_dict[key]:
-                            inactive_ips.append(key)
-                    for key in inactive_ips:
-                        del ip_dict[key]
-            time.sleep(60)
+                self.msg_limiter.forget(peer.addr)
+        self.timers.schedule(UDP_PEER_IDLE_SECONDS, self._sweep_udp_peers)
+
+    def _key_exchange_timeout(self, conn):
+        """Key exchange timer - closes connections that didn't send their aes key in time"""
+        with self.conn_lock:
+            if conn.state is ConnectionState.PENDING_CRYPT and conn.sock in self.connections:
+                print("key exchange timed out")
+                self._close_connection(conn.sock)
 
-    def _keep_alive(self):
+    def _schedule_keep_alive(self, conn):
         """
-        Send periodic keep-alive SIP messages and remove unresponsive clients.
+        Set the keep alive timer of an encrypted connection.
+
+        :param conn: The connection
+        :type conn: Connection
         """
-        while self.running:
-            with self.conn_lock:
-                for call_id, keep_alive in list(self.pending_keep_alive.items()):
-                    # Socket should be in connected users. Check for safety
-                    if keep_alive.client_socket in self.connected_users:
-                        del self.pending_keep_alive[call_id]
-                        print("removing client")
-                        self._close_connection(keep_alive.client_socket)
-                # Everyone that remained has answered the keep alive
-                for sock in self.connected_users:
-                    msg = KEEP_ALIVE_MSG
-                    call_id = generate_random_call_id()
-                    msg.set_header('call-id', call_id)
-                    print(f"sending: {msg}")
-                    self._send_to_client(sock, str(msg).encode())
-                    keep_alive_obj = KeepAlive(call_id, 1, sock)
-                    self.pending_keep_alive[call_id] = keep_alive_obj
-
-            # now add pending_auth_remove - will need to be it's own thread once i change func into sleep queue
-            for sock, creation_time in self.pending_crypt.items():
-                if (datetime.datetime.now() - creation_time).total_seconds() > KEEP_ALIVE_SECONDS:
-                    del self.pending_crypt[sock]
-            time.sleep(KEEP_ALIVE_SECONDS)
+        conn.timer = self.timers.schedule(KEEP_ALIVE_SECONDS, self._keep_alive, conn)
+
+    def _keep_alive(self, conn):
+        """
+        Keep alive timer of a connection. Closes it if the last keep alive wasn't answered,
+        otherwise sends a new one and sets the timer again.
+
+        :param conn: The connection
+        :type conn: Connection
+        """
+        with self.conn_lock:
+            if conn.sock not in self.connections:
+                return
+            if conn.keep_alive:
+                print("removing client")
+                self._close_connection(conn.sock)
+                return
+            # The client answered the last keep alive
+            msg = KEEP_ALIVE_MSG
+            call_id = generate_random_call_id()
+            msg.set_header('call-id', call_id)
+            print(f"sending: {msg}")
+            keep_alive_obj = KeepAlive(call_id, 1, conn.sock)
+            conn.keep_alive = keep_alive_obj
+            self.pending_keep_alive[call_id] = keep_alive_obj
+            self._send_to_client(conn.sock, msg.to_bytes(), msg)
+            self._schedule_keep_alive(conn)
 
     def _close_connection(self, sock):
         """
@@ -1190,66 +2231,328 @@ class SIPServer:
         """
         print("closing connection!")
         with self.conn_lock:
-            if sock in self.connected_users:
-                self.connected_users.remove(sock)
-                # pending_keep_alive entry would be removed by the _keep_alive func
-                # mabye remove keep alive here
-        with self.reg_lock:
-            self.registered_user.remove_by_key(sock)
-
+            conn = self.connections.get(sock)
+            if conn and conn.writer is not None:
+                # best effort for what is already queued (e.g. an error response)
+                try:
+                    conn.writer.flush(sock)
+                except socket.error:
+                    pass
+            # the ip rate limit stays - may be more than one connection
+            conn = self.connections.remove(sock)
+            if conn and conn.timer:
+                conn.timer.cancel()
+            if conn and conn.keep_alive:
+                self.pending_keep_alive.pop(conn.keep_alive.call_id, None)
         with self.ip_lock:
-            if sock in self.ip_message_counts:
-                # do not clean ip. may be more than one connection. this is for the CONNECTION
-                del self.ip_message_counts[sock] # if he has pending msgs which he probably has then clean his entry
-        with self.call_lock:
-            end_msg = None
-            # Remove a call that the sock is in. If there is another UAC send them an error msg
-            for call_id, call in list(self.active_calls.items()):
-                if call.caller_socket is sock or call.callee_socket is sock:
-                    print("in a call")
-                    if call.call_type == SIPCallType.INVITE:
-                        send_sock = call.caller_socket if call.callee_socket == sock else call.callee_socket
-                        print(send_sock)
-                        if send_sock: # if there was another side (maybe different case for bye?)
-
-                            with self.reg_lock:
-                                if self.registered_user.get_by_key(send_sock):
-                                    to_uri = self.registered_user.get_by_key(send_sock).uri
-                                    end_msg = SIPMsgFactory.create_response(SIPStatusCode.DOES_NOT_EXIST_ANYWHERE,
-                                                                            SIP_VERSION,
-                                                                            SIPMethod.OPTIONS, call.last_used_cseq_num,
-                                                                            to_uri, SERVER_URI, call.call_id)
-                    if call.uri in self.pending_auth:
-                        del self.pending_auth[call.uri]
-                    del self.active_calls[call_id]
-                    if end_msg:
-                        print(end_msg)
-                        self._send_to_client(send_sock, str(end_msg).encode())
+            self.msg_limiter.forget(sock)
+        if self.cluster:
+            self._relay_gone(sock)
+        self._remove_registration(sock)
+        self._end_calls_of(sock)
+        sock.close()
 
+    def _end_calls_of(self, sock):
+        """
+        Remove the calls a socket is in. If there is another UAC send them an error msg.
 
-        sock.close()
+        :param sock: The socket of the client that left
+        :type sock: EncryptedSocket or RemoteSocket
+        """
+        for call in self.active_calls.calls_of_socket(sock):
+            with self.active_calls.lock(call.call_id):
+                if self.active_calls.get(call.call_id) is not call:
+                    continue  # ended meanwhile
+                self.active_calls.remove(call.call_id)
+                self._drop_auth_challenge(call.call_id)
+            print("in a call")
+            if call.call_type == SIPCallType.INVITE:
+                send_sock = call.caller_socket if call.callee_socket == sock else call.callee_socket
+                if isinstance(send_sock, RemoteSocket):
+                    to_uri = send_sock.uri
+                else:
+                    with self.reg_lock:
+                        other = self.registered_user.get_by_key(send_sock) if send_sock else None
+                    to_uri = other.uri if other else None
+                if to_uri: # if there was another side (maybe different case for bye?)
+                    end_msg = SIPMsgFactory.create_response(SIPStatusCode.DOES_NOT_EXIST_ANYWHERE, SIP_VERSION,
+                                                            SIPMethod.OPTIONS, call.last_used_cseq_num,
+                                                            to_uri, SERVER_URI, call.call_id)
+                    print(end_msg)
+                    self._send_to_client(send_sock, end_msg.to_bytes(), end_msg)
+
+    @staticmethod
+    def _reply(req, status_code):
+        """
+        :return: The server's encoded status_code response to req with what it answers -
+                 (data, req, status_code), the rest of a _send_to_client call
+        :rtype: tuple
+        """
+        return SIPMsgFactory.response_bytes(req, status_code, SERVER_URI), req, status_code
+
+    def _send_all(self, sends):
+        """
+        Send messages collected while a lock was held.
 
-    def _send_to_client(self, sock, data):
+        :param sends: (socket, encoded message[, message[, status code]]) - _send_to_client arguments
+        :type sends: list[tuple]
         """
-        Send data to a client over TCP. Close the connection on failure.
+        for send in sends:
+            self._send_to_client(*send)
+
+    def _send_to_client(self, sock, data, msg=None, status_code=None):
+        """
+        Encrypt data and queue it for a client (plain clients get it as is). The select loop does
+        the actual write, so the worker never blocks on a slow receiver. Close the connection on
+        failure or when the client stopped reading.
 
         :param sock: Socket to send data through
         :type sock: EncryptedSocket
         :param data: Byte data to be sent
         :type data: bytes
+        :param msg: The message data encodes (or answers, with status_code) - udp transactions
+                    match it by its call-id and cseq instead of parsing data again
+        :type msg: SIPRequest or SIPResponse or None
+        :param status_code: Status of the response data encodes, if msg is the request it answers
+        :type status_code: SIPStatusCode or None
         """
         print(f"sending: {data}")
-        enc_data = sock.encrypt(data)
-        # send encrypted
-        if not send_encrypted(sock, enc_data):
+        if isinstance(sock, UDPPeer):
+            self.transactions.send(data, sock.addr, msg, status_code)
+            return
+        if isinstance(sock, RemoteSocket):
+            # the client's worker encrypts and sends
+            self.cluster.send(sock.worker, RELAY_TO_CLIENT, self.worker_id, sock.uri, data)
+            return
+        # length prefix, nonce, ciphertext and tag joined once
+        frame = sock.encrypt_obj.encrypt_frame(data) if sock.encrypt_obj else data
+        conn = self.connections.get(sock)
+        if conn and conn.writer is not None:
+            conn.writer.push_frame(frame)
+            if len(conn.writer) > conn.writer.high_water * MAX_QUEUED_FACTOR:
+                print("client isn't reading")
+                self._close_connection(sock)
+                return
+            self._wake_writer(conn)
+        elif not send_frame(sock, frame):
+            # asyncio connections - the transport does the queueing
             print("couldnt send")
             self._close_connection(sock)
 
+    def _wake_writer(self, conn):
+        """
+        Mark a connection as having queued frames and wake the select loop if it isn't awake yet.
+
+        :param conn: The connection with queued frames
+        :type conn: Connection
+        """
+        with self.flush_lock:
+            wake = not self.flush_ready
+            self.flush_ready.add(conn)
+        if wake:
+            self._wake_loop()
+
+    def _wake_loop(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # the loop is already going to wake up (or the server is closing)
+
+    def _registered_elsewhere(self, uri):
+        """
+        :return: True if uri is registered on another worker
+        :rtype: bool
+        """
+        return bool(self.cluster) and self.cluster.lookup(uri) not in (None, self.worker_id)
+
+    def _remote_client(self, uri):
+        """
+        Get the stand in socket of a uri registered on another worker.
+
+        :param uri: The uri
+        :type uri: str
+
+        :return: The socket or None if uri isn't registered on another worker
+        :rtype: RemoteSocket or None
+        """
+        if not self.cluster:
+            return None
+        worker = self.cluster.lookup(uri)
+        if worker is None or worker == self.worker_id:
+            return None
+        return self._remote_client_of(worker, uri)
+
+    def _relay_from_client(self, sock, msg):
+        """
+        Pass a message in a call owned by another worker to that worker.
+
+        :param sock: Socket the message arrived on
+        :type sock: EncryptedSocket
+        :param msg: The message
+        :type msg: SIPMsg
+
+        :return: True if the message was relayed
+        :rtype: bool
+        """
+        call_id = msg.call_id
+        with self.relay_lock:
+            route = self.relayed_calls.get(call_id)
+        if not route or call_id in self.active_calls:
+            return False
+        user = self.registered_user.get_by_key(sock)
+        if not user:
+            return False
+        self.cluster.send(route[0], RELAY_FROM_CLIENT, self.worker_id, user.uri, msg.to_bytes())
+        return True
+
+    def _relay_gone(self, sock):
+        """
+        Tell the owners of the relayed calls of a closing socket that its client left.
+
+        :param sock: The closing socket
+        :type sock: EncryptedSocket
+        """
+        user = self.registered_user.get_by_key(sock)
+        with self.relay_lock:
+            call_ids = self.relayed_socks.pop(sock, ())
+            owners = {self.relayed_calls.pop(call_id)[0] for call_id in call_ids}
+        if user:
+            for owner in owners:
+                self.cluster.send(owner, RELAY_GONE, self.worker_id, user.uri, None)
+
+    def _call_removed(self, call):
+        """
+        Call table hook - tells the workers of the remote sides of a call that it ended.
+
+        :param call: The removed call
+        :type call: Call
+        """
+        for side in (call.caller_socket, call.callee_socket):
+            if isinstance(side, RemoteSocket):
+                self.cluster.send(side.worker, RELAY_END, self.worker_id, side.uri, call.call_id)
+
+    def _relay_loop(self):
+        """
+        Handle the relay messages other workers send to this one.
+        """
+        while self.running:
+            item = self.cluster.recv(self.worker_id)
+            if item:
+                try:
+                    self._handle_relay(*item)
+                except Exception as err:
+                    print(f"relay failed: {err}")
+
+    def _handle_relay(self, kind, from_worker, uri, payload):
+        """
+        Handle a relay message.
+
+        :param kind: One of the RELAY_ kinds
+        :type kind: str
+        :param from_worker: The worker that sent it
+        :type from_worker: int
+        :param uri: The client the message is about
+        :type uri: str
+        :param payload: Sip message bytes or a call id
+        :type payload: bytes or str
+        """
+        if kind == RELAY_TO_CLIENT:
+            # a message for a client of ours in a call owned by from_worker
+            user = self.registered_user.get_by_val(uri)
+            if not user:
+                self.cluster.send(from_worker, RELAY_GONE, self.worker_id, uri, None)
+                return
+            call_id = SIPMsgFactory.parse(payload).call_id
+            with self.relay_lock:
+                if call_id not in self.relayed_calls:
+                    self.relayed_calls[call_id] = (from_worker, user.socket)
+                    self.relayed_socks.setdefault(user.socket, set()).add(call_id)
+            self._send_to_client(user.socket, payload)
+        elif kind == RELAY_FROM_CLIENT:
+            # a client of from_worker sent a message in one of our calls
+            msg = SIPMsgFactory.parse(payload)
+            sock = self._remote_client_of(from_worker, uri)
+            if msg:
+                self.thread_pool.submit(self._worker_process_msg, sock, msg)
+        elif kind == RELAY_END:
+            with self.relay_lock:
+                route = self.relayed_calls.pop(payload, None)
+                if route and route[1] in self.relayed_socks:
+                    self.relayed_socks[route[1]].discard(payload)
+                    if not self.relayed_socks[route[1]]:
+                        del self.relayed_socks[route[1]]
+        elif kind == RELAY_GONE:
+            with self.relay_lock:
+                sock = self.remote_sockets.pop((from_worker, uri), None)
+            if sock:
+                self._end_calls_of(sock)
+
+    def _remote_client_of(self, worker, uri):
+        with self.relay_lock:
+            # one object per client - calls compare sockets by identity
+            return self.remote_sockets.setdefault((worker, uri), RemoteSocket(worker, uri))
+
+
+def _run_worker(cluster, worker_id, port, use_async, plain_port, udp_port):
+    server = SIPServer(port, cluster, worker_id, plain_port, udp_port)
+    if use_async:
+        server.start_async()
+    else:
+        server.start()
+
+
+def run_workers(workers, port=DEFAULT_SERVER_PORT, use_async=False, plain_port=None, udp_port=None):
+    """
+    Run the server as several worker processes that all accept on the same port
+    (SO_REUSEPORT). Registrations are shared, and calls between clients of different
+    workers are relayed between the workers.
+
+    :param workers: Number of worker processes
+    :type workers: int
+    :param port: Port the workers listen on
+    :type port: int
+    :param use_async: Run the workers in asyncio mode
+    :type use_async: bool
+    :param plain_port: Port the workers also listen on for plain SIP over TCP, None for none
+    :type plain_port: int or None
+    :param udp_port: Port the workers also receive SIP over UDP on, None for none
+    :type udp_port: int or None
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("multiple workers need SO_REUSEPORT, not supported on this platform")
+        return
+    RSACrypt().load_or_generate(KEY_FILE)  # created once here, the workers load it
+    with multiprocessing.Manager() as manager:
+        cluster = ClusterStore(workers, manager)
+        processes = [multiprocessing.Process(target=_run_worker,
+                                             args=(cluster, i, port, use_async, plain_port, udp_port),
+                                             name=f"sip_worker_{i}")
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # the workers got the interrupt too and are shutting down
+            for process in processes:
+                process.join()
+
 
 """
 for each call have a state so you know if the msgs send are valid for the state. 
 have diuffernt thred for srt. send commands through queue.
 """
 
-server = SIPServer()
-server.start()
+if __name__ == '__main__':
+    plain = int(sys.argv[sys.argv.index('--plain-port') + 1]) if '--plain-port' in sys.argv else None
+    udp = int(sys.argv[sys.argv.index('--udp-port') + 1]) if '--udp-port' in sys.argv else None
+    if '--workers' in sys.argv:
+        run_workers(int(sys.argv[sys.argv.index('--workers') + 1]), use_async='--async' in sys.argv,
+                    plain_port=plain, udp_port=udp)
+    else:
+        server = SIPServer(plain_port=plain, udp_port=udp)
+        if '--async' in sys.argv:
+            server.start_async()
+        else:
+            server.start()
@@ -4,6 +4,8 @@ import threading
 from utils.comms import send_encrypted, recv_encrypted
 from utils.encryption.aes import AESCryptGCM
 from utils.encryption.rsa import RSACrypt
+from utils.encryption.handshake import HandshakePool
+from utils.encryption.session_ticket import RESUME_REJECTED, TicketIssuer, is_resume_frame, split_key_exchange
 from utils.user_database import UserDatabase
 
 SERVER_URI = "myserver"
@@ -12,6 +14,7 @@ DB_PATH = '../utils/users.db'
 MAX_CLIENTS = 5
 CLIENT_SEMAPHORE = threading.Semaphore(MAX_CLIENTS)
 SUCCESS_RESPONSE = "SIGNUP"
+KEY_FILE = "server_key.pem"  # same key as the sip server
 
 
 class SignupServer:
@@ -24,8 +27,10 @@ class SignupServer:
         self.lock = CLIENT_SEMAPHORE
 
         self.rsa_crypt = RSACrypt()
-        self.rsa_crypt.generate_keys()
+        self.rsa_crypt.load_or_generate(KEY_FILE)
         self.public_key = self.rsa_crypt.export_public_key() # bytes
+        self.handshakes = HandshakePool(self.rsa_crypt)  # rsa decrypt runs in the pool processes
+        self.tickets = TicketIssuer()  # returning clients resume without rsa
 
     def start(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -41,6 +46,7 @@ class SignupServer:
             print("ERROR")
             print(err)
         finally:
+            self.handshakes.shutdown()
             self.server_socket.close()
 
     def handle_client(self, sock):
@@ -49,10 +55,21 @@ class SignupServer:
         # print(f"rsa key server: {self.public_key}")
         # print('--------------------')
         send_encrypted(sock, self.public_key)
-        rsa_encrypted = recv_encrypted(sock)
-        if rsa_encrypted != b'':
-            aes_key = self.rsa_crypt.decrypt(rsa_encrypted)
+        key_frame = recv_encrypted(sock)
+        aes_key, wants_ticket = None, False
+        if is_resume_frame(key_frame):
+            aes_key, wants_ticket = self.tickets.resume(key_frame), True
+            if aes_key is None:
+                send_encrypted(sock, RESUME_REJECTED)  # the client falls back to rsa
+                key_frame = recv_encrypted(sock)
+        if aes_key is None and key_frame != b'':
+            plaintext = self.handshakes.decrypt(key_frame)  # None if the handshake queue is full
+            if plaintext:
+                aes_key, wants_ticket = split_key_exchange(plaintext)
+        if aes_key:
             encrypt_obj = AESCryptGCM(aes_key)
+            if wants_ticket:
+                send_encrypted(sock, encrypt_obj.encrypt(self.tickets.issue(aes_key)))
             print(f'server:\n{aes_key}')
 
             signup_msg_enc = recv_encrypted(sock)
@@ -23,11 +23,22 @@ import time
 from enum import Enum
 
 
+RTP_HEADER = struct.Struct('!BBHII')
+
+
 class PacketType(Enum):
     VIDEO = 1
     AUDIO = 7
 
 
+def rtp_timestamp():
+    """
+    :return: The timestamp of a packet sent now - milliseconds
+    :rtype: int
+    """
+    return int(time.time() * 1000) & 0xFFFFFFF
+
+
 class RTPPacket:
     def __init__(self, version=0, padding=False, extension=False, marker=False, payload_type=PacketType.VIDEO.value,
                  sequence_number=0, ssrc=0, timestamp=None):
@@ -65,7 +76,7 @@ class RTPPacket:
         self.payload_type = payload_type
         self.sequence_number = sequence_number % 0x10000
         self.ssrc = ssrc
-        self.timestamp = self.timestamp = timestamp if timestamp is not None else int(time.time() * 1000) & 0xFFFFFFF
+        self.timestamp = self.timestamp = timestamp if timestamp is not None else rtp_timestamp()
 
         self.cc = 0
         self.payload = b''
@@ -177,6 +188,52 @@ class RTPPacket:
                 f"TS={self.timestamp}, SSRC={self.ssrc}, "
                 f"Payload length={len(self.payload)}")
 
+class RTPPacketizer:
+    def __init__(self, ssrc, max_payload, payload_type=PacketType.VIDEO.value):
+        """
+        Splits whole frames into rtp packets. The headers of a frame's packets are patched
+        into one reused buffer with struct.pack_into and the payloads stay where they are,
+        so a packet is sent gathered from (header, payload slice) without building it.
+
+        :param ssrc: synchronization source identifier
+        :type ssrc: int
+        :param max_payload: Biggest payload of a packet
+        :type max_payload: int
+        :param payload_type: RTP payload type
+        :type payload_type: int
+        """
+        self.ssrc = ssrc
+        self.max_payload = max_payload
+        self.payload_type = payload_type
+        self.headers = bytearray(RTP_HEADER.size * 64)  # grown to the most packets a frame had
+
+    def packetize(self, payload, seq, timestamp):
+        """
+        Write the headers of a frame's packets - the last one has the marker bit.
+
+        :param payload: The frame
+        :type payload: bytes
+        :param seq: Sequence number of the first packet, the rest follow it
+        :type seq: int
+        :param timestamp: Timestamp of the frame
+        :type timestamp: int
+
+        :return: (payload start, payload end) of every packet, packet i's header is at i * RTP_HEADER.size
+        :rtype: list[tuple]
+        """
+        size = len(payload)
+        bounds = [(start, min(start + self.max_payload, size)) for start in range(0, size, self.max_payload)]
+        if not bounds:
+            bounds = [(0, 0)]
+        needed = len(bounds) * RTP_HEADER.size
+        if needed > len(self.headers):
+            self.headers = bytearray(needed)
+        last = len(bounds) - 1
+        for i in range(len(bounds)):
+            RTP_HEADER.pack_into(self.headers, i * RTP_HEADER.size, 0, (i == last) << 7 | self.payload_type,
+                                 (seq + i) & 0xFFFF, timestamp, self.ssrc)
+        return bounds
+
 # m = RTPPacket().build_packet()
 # bits = []
 # for b in m:
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import queue
+
+# relay messages between the worker processes: (kind, from worker, uri, payload)
+RELAY_TO_CLIENT = "to_client"  # call owner -> worker of the client: send payload (sip bytes) to uri
+RELAY_FROM_CLIENT = "from_client"  # worker of the client -> call owner: uri sent payload in the call
+RELAY_END = "end"  # call owner -> worker of the client: the call (payload is the call id) ended
+RELAY_GONE = "gone"  # worker of the client -> call owner: uri disconnected
+RELAY_POLL_SECONDS = 0.5
+
+
+class RemoteSocket:
+    def __init__(self, worker, uri):
+        """
+        Stands in for the socket of a client that is connected to another worker, so calls
+        can hold it like a local client socket. Messages for it are relayed to its worker,
+        which encrypts them with the client's key.
+
+        :param worker: Id of the worker the client is connected to
+        :type worker: int
+        :param uri: Uri the client registered
+        :type uri: str
+        """
+        self.worker = worker
+        self.uri = uri
+
+    def encrypt(self, data):
+        return data  # the client's worker encrypts
+
+    def getpeername(self):
+        return f"worker-{self.worker}", 0
+
+    def __repr__(self):
+        return f"RemoteSocket(worker={self.worker}, uri={self.uri})"
+
+
+class ClusterStore:
+    def __init__(self, workers, manager):
+        """
+        State shared by the worker processes of a server - the worker every uri is registered
+        on and an inbox queue per worker for relayed messages. Created by the parent before
+        the workers start and passed to each of them.
+
+        :param workers: Number of worker processes
+        :type workers: int
+        :param manager: Manager that holds the shared registrations
+        :type manager: multiprocessing.managers.SyncManager
+        """
+        self.workers = workers
+        self.ticket_key = os.urandom(32)  # session tickets of one worker are accepted by all of them
+        self.registrations = manager.dict()  # uri -> worker id
+        self.lock = manager.Lock()  # registrations - a re-register elsewhere can't land between check and delete
+        self.inboxes = [multiprocessing.Queue() for _ in range(workers)]
+
+    def register(self, uri, worker):
+        """
+        Record that uri registered on worker. Overrides the previous worker of the uri.
+        """
+        with self.lock:
+            self.registrations[uri] = worker
+
+    def unregister(self, uri, worker):
+        """
+        Forget the registration of uri if it is still on worker.
+        """
+        with self.lock:
+            if self.registrations.get(uri) == worker:
+                self.registrations.pop(uri, None)
+
+    def lookup(self, uri):
+        """
+        :return: Id of the worker uri is registered on, None if it isn't registered
+        :rtype: int or None
+        """
+        return self.registrations.get(uri)
+
+    def send(self, worker, kind, from_worker, uri, payload):
+        """
+        Put a relay message in the inbox of worker.
+
+        :param worker: The receiving worker
+        :type worker: int
+        :param kind: One of the RELAY_ kinds
+        :type kind: str
+        :param from_worker: The sending worker
+        :type from_worker: int
+        :param uri: The client the message is about
+        :type uri: str
+        :param payload: Sip message bytes or a call id
+        :type payload: bytes or str
+        """
+        self.inboxes[worker].put((kind, from_worker, uri, payload))
+
+    def recv(self, worker, timeout=RELAY_POLL_SECONDS):
+        """
+        :return: The next relay message of worker or None if none arrived in time
+        :rtype: tuple or None
+        """
+        try:
+            return self.inboxes[worker].get(timeout=timeout)
+        except queue.Empty:
+            return None
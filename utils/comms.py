@@ -1,12 +1,23 @@
+import asyncio
+import re
 import socket
 import struct
 import threading
 import time
+from collections import deque
 
 from utils.sip_msgs import *
 
 INT_SIZE = 4
 PACK_SIGN = "I"
+MAX_FRAME_SIZE = 64 * 1024  # encrypted sip messages are a few kb at most
+FRAME_BUFFER_SIZE = 4096
+WRITE_HIGH_WATER = 64 * 1024  # queued bytes before the writer asks to stop producing
+WRITE_LOW_WATER = 16 * 1024  # queued bytes where producing may continue
+MAX_SEND_BUFFERS = 64  # buffers handed to a single sendmsg call
+MAX_SIP_HEADER_SIZE = 8000  # start line + headers of a plain sip message
+# content-length (or its compact form l) of a sip header block, searched from the crlf of the line before
+CONTENT_LENGTH_PATTERN = re.compile(rb"\r\n(?:content-length|l)[ \t]*:([^\r\n]*)", re.IGNORECASE)
 
 
 def send_tcp(sock, data):
@@ -96,92 +107,20 @@ def receive_tcp(sock):
         return b''
 
 
-def recv_sip_metadata(sock, max_passes):
+def receive_tcp_sip(reader):
     """
-     receive metadata from the server
+    Receive and parse the next SIP message of a plain SIP-over-TCP connection.
 
-     :param sock: the socket for communication
-     :type sock: socket.socket
-
-     :return: received metadata
-     :rtype: str
-     """
-    client_request = ""
-    passes = 0
-    try:
-        while not re.search('\r\n\r\n', client_request) and passes < max_passes:
-            passes += 1
-            packet = sock.recv(1).decode()
-            if packet == '':
-                client_request = ''
-                break
-            client_request += packet
-    except socket.error as err:
-        # logging.error(f"error while recv metadata: {err}")
-        client_request = ''
-    finally:
-        return client_request
-
-
-def recv_sip_body(sock, num, max_passes):
-    """
-     receive a constant-sized message from the server
-
-     :param sock: the socket for communication
-     :type sock: socket.socket
-
-     :param num: the size of the message to receive
-     :type num: int
-
-     :return: received message
-     :rtype: bytes
-     """
-    bod = ''
-    passes = 0
-    try:
-        while len(bod) < num and passes < max_passes:
-            passes += 1
-            chunk = sock.recv(num - len(bod)).decode()
-            if chunk == '':
-                bod = ''
-                break
-            bod += chunk
-    except socket.error as err:
-        # logging.error(f"error while recv body: {err}")
-        bod = ''
-    finally:
-        return bod
-
-
-def receive_tcp_sip(sock, max_passes_metadata, max_passes_body):
-    """
-    Receive and parse a SIP message
-
-    This function first reads the SIP metadata from the socket, parses it into a SIP message,
-    and if a `Content-Length` header is present and non-zero, it reads the corresponding body as well.
-
-    :param sock: the TCP socket to receive data from
-    :type sock: socket.socket
-
-    :param max_passes_metadata: maximum number of read attempts for the SIP metadata
-    :type max_passes_metadata: int
-
-    :param max_passes_body: maximum number of read attempts for the SIP body
-    :type max_passes_body: int
+    :param reader: the reader of the connection
+    :type reader: SIPStreamReader
 
     :return: parsed SIP message if successful, otherwise None
     :rtype: SIPMessage or None
     """
-    metadata = recv_sip_metadata(sock, max_passes_metadata)
-    sip_msg = SIPMsgFactory.parse(metadata)
-    if sip_msg:
-        if sip_msg.get_header('content-length') is not None and sip_msg.get_header('content-length') != 0:
-            sip_msg.body = recv_sip_body(sock, sip_msg.get_header('content-length'), max_passes_body)
-            if len(sip_msg.body) == sip_msg.get_header('content-length'):
-                return sip_msg
-        else:
-            return sip_msg
-    return None
+    data = reader.read()
+    if not data:
+        return None
+    return SIPMsgFactory.parse(data)
 
 
 def send_encrypted(sock, data):
@@ -191,11 +130,17 @@ def send_encrypted(sock, data):
     """
 
     data_len = struct.pack(PACK_SIGN, socket.htonl(len(data)))
-    to_send = data_len + data
+    return send_frame(sock, data_len + data)
+
+def send_frame(sock, frame):
+    """
+    send a frame that already starts with its length (AESCryptGCM.encrypt_frame)
+    """
+    frame = memoryview(frame)
     try:
         sent = 0
-        while sent < len(to_send):
-            sent += sock.send(to_send[sent:])
+        while sent < len(frame):
+            sent += sock.send(frame[sent:])
         return True
     except socket.error as err:
         print(f"error while sending at: {err}")
@@ -229,6 +174,333 @@ def recv_encrypted(sock):
     return data
 
 
+async def recv_encrypted_async(reader):
+    """
+    asyncio version of recv_encrypted. reads one len(4 bytes) + data(bytes) frame
+
+    :param reader: the stream reader of the connection
+    :type reader: asyncio.StreamReader
+
+    :return: the frame data, b'' if the connection closed mid frame or the frame is too big
+    :rtype: bytes
+    """
+    try:
+        data_len_bytes = await reader.readexactly(INT_SIZE)
+        data_len = socket.htonl(struct.unpack(PACK_SIGN, data_len_bytes)[0])
+        if data_len > MAX_FRAME_SIZE:
+            return b''
+        return await reader.readexactly(data_len)
+    except (asyncio.IncompleteReadError, socket.error):
+        return b''
+
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=FRAME_BUFFER_SIZE):
+        """
+        Incremental decoder for the len(4 bytes) + data(bytes) framing.
+        Takes whatever bytes the socket has and returns only the complete frames, so a client
+        that sends half a frame never blocks the reader. The bytes are received straight into
+        a preallocated buffer that only grows when a frame doesn't fit (up to max_frame_size).
+
+        :param max_frame_size: biggest frame accepted, bigger frames are a protocol error
+        :type max_frame_size: int
+        :param buffer_size: initial size of the receive buffer
+        :type buffer_size: int
+        """
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte that wasn't returned as a frame yet
+        self.end = 0  # end of the received bytes
+
+    def recv_from(self, sock):
+        """
+        Do a single recv on the socket and return the frames that are complete.
+        The returned frames are memoryviews into the buffer, valid until the next call.
+
+        :param sock: a socket that is ready for reading
+        :type sock: socket.socket
+
+        :return: list of complete frames, None if the connection was closed
+        :rtype: list[memoryview] or None
+
+        :raises ValueError: if the peer announced a frame bigger than max_frame_size
+        """
+        self._make_room()
+        try:
+            received = sock.recv_into(self.view[self.end:])
+        except BlockingIOError:
+            return []
+        if received == 0:
+            return None
+        self.end += received
+        return self._frames()
+
+    def feed(self, data):
+        """
+        Add bytes that were received some other way and return the frames that are complete.
+        The returned frames are memoryviews into the buffer, valid until the next call.
+
+        :param data: the received bytes
+        :type data: bytes
+
+        :return: list of complete frames
+        :rtype: list[memoryview]
+
+        :raises ValueError: if the peer announced a frame bigger than max_frame_size
+        """
+        frames = []
+        data = memoryview(data)
+        while data:
+            self._make_room()
+            chunk = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + chunk] = data[:chunk]
+            self.end += chunk
+            data = data[chunk:]
+            # frames must be copied out if the buffer is going to be reused in this call
+            frames.extend(bytes(frame) if data else frame for frame in self._frames())
+        return frames
+
+    def _frames(self):
+        frames = []
+        while self.end - self.start >= INT_SIZE:
+            data_len = socket.htonl(struct.unpack_from(PACK_SIGN, self.buffer, self.start)[0])
+            if data_len > self.max_frame_size:
+                raise ValueError(f"frame of {data_len} bytes is over the limit")
+            frame_end = self.start + INT_SIZE + data_len
+            if frame_end > self.end:
+                self._reserve(INT_SIZE + data_len)
+                break
+            frames.append(self.view[self.start + INT_SIZE:frame_end])
+            self.start = frame_end
+        return frames
+
+    def _reserve(self, size):
+        """
+        make sure a frame of the given size fits in the buffer once it is compacted
+        """
+        if size > len(self.buffer):
+            # the old buffer is left to the frames that were already returned
+            buffer = bytearray(size)
+            buffer[:self.end - self.start] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.end -= self.start
+            self.start = 0
+
+    def _make_room(self):
+        """
+        move the unfinished frame to the front of the buffer so there is space to receive into
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer) or self.start > len(self.buffer) // 2:
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+
+
+class SIPStreamDecoder(FrameDecoder):
+    def __init__(self, max_body_size=MAX_FRAME_SIZE, max_header_size=MAX_SIP_HEADER_SIZE,
+                 buffer_size=FRAME_BUFFER_SIZE):
+        """
+        Incremental decoder for plain SIP over TCP (rfc 3261 18.3) - a message is its headers up
+        to the empty line and then content-length bytes of body. Same buffer handling as
+        FrameDecoder: bytes are received in big chunks and every complete message in them is
+        returned, so pipelined messages that arrive in one segment come out of one call.
+        The header terminator search goes on from where the last one stopped, a header block
+        is never scanned twice.
+
+        :param max_body_size: biggest body accepted
+        :type max_body_size: int
+        :param max_header_size: biggest start line + headers accepted
+        :type max_header_size: int
+        :param buffer_size: initial size of the receive buffer
+        :type buffer_size: int
+        """
+        super().__init__(max_body_size, buffer_size)
+        self.max_header_size = max_header_size
+        self.scanned = 0  # bytes of the current message already searched for the header end
+        self.msg_size = None  # size of the current message once its headers are in
+
+    def _frames(self):
+        messages = []
+        while True:
+            if self.msg_size is None and not self.scanned:
+                # crlfs between messages are keep alive pings (rfc 5626), not part of a message
+                while self.start < self.end and self.buffer[self.start] in b"\r\n":
+                    self.start += 1
+            if self.msg_size is None:
+                self.msg_size = self._message_size()
+                if self.msg_size is None:
+                    break
+            if self.end - self.start < self.msg_size:
+                self._reserve(self.msg_size)
+                break
+            messages.append(self.view[self.start:self.start + self.msg_size])
+            self.start += self.msg_size
+            self.msg_size = None
+            self.scanned = 0
+        return messages
+
+    def _message_size(self):
+        """
+        Look for the end of the current message's headers in the new bytes.
+
+        :return: size of the message (headers and body), None if the headers aren't all in yet
+        :rtype: int or None
+
+        :raises ValueError: if the headers or the body are over the limit or content-length isn't a number
+        """
+        # the terminator may have started in the last 3 bytes that were searched
+        headers_end = self.buffer.find(b"\r\n\r\n", self.start + max(self.scanned - 3, 0), self.end)
+        if headers_end == -1:
+            self.scanned = self.end - self.start
+            if self.scanned > self.max_header_size:
+                raise ValueError(f"sip headers over {self.max_header_size} bytes")
+            if self.scanned == len(self.buffer):
+                self._reserve(2 * len(self.buffer))  # one header block fills the buffer
+            return None
+        if headers_end - self.start > self.max_header_size:
+            raise ValueError(f"sip headers over {self.max_header_size} bytes")
+        body_size = 0
+        match = CONTENT_LENGTH_PATTERN.search(self.buffer, self.start, headers_end + 2)
+        if match:
+            body_size = int(match.group(1))
+        if not 0 <= body_size <= self.max_frame_size:
+            raise ValueError(f"sip body of {body_size} bytes")
+        return headers_end + 4 - self.start + body_size
+
+
+class SIPStreamReader:
+    def __init__(self, sock, decoder=None):
+        """
+        Blocking reader of one plain SIP-over-TCP connection. Reads through a SIPStreamDecoder
+        and hands out one message per call - messages that arrived together wait for the next calls.
+
+        :param sock: a blocking socket
+        :type sock: socket.socket
+        :param decoder: decoder of the connection, a new one if None
+        :type decoder: SIPStreamDecoder or None
+        """
+        self.sock = sock
+        self.decoder = decoder if decoder else SIPStreamDecoder()
+        self.messages = deque()
+
+    def read(self):
+        """
+        :return: the next message, b'' if the connection closed or broke the framing
+        :rtype: bytes
+        """
+        try:
+            while not self.messages:
+                messages = self.decoder.recv_from(self.sock)
+                if messages is None:
+                    return b''
+                # copied - the views are only valid until the next recv
+                self.messages.extend(bytes(message) for message in messages)
+        except (ValueError, socket.error):
+            return b''
+        return self.messages.popleft()
+
+
+class FrameWriter:
+    def __init__(self, high_water=WRITE_HIGH_WATER, low_water=WRITE_LOW_WATER):
+        """
+        Outbound queue of len(4 bytes) + data(bytes) frames for one non-blocking socket.
+        Any thread can push frames, the owner of the socket flushes them. A flush hands as
+        many queued buffers as possible to one sendmsg call (scatter-gather), so the length
+        prefixes are never concatenated with the data and several frames go out in one syscall.
+
+        :param high_water: queued bytes above which the writer is paused
+        :type high_water: int
+        :param low_water: queued bytes below which a paused writer is resumed
+        :type low_water: int
+        """
+        self.high_water = high_water
+        self.low_water = low_water
+        self.buffers = deque()  # memoryviews waiting to be sent
+        self.pending = 0  # queued bytes
+        self.paused = False  # above the high water mark - the producer should hold back
+        self.lock = threading.Lock()
+
+    def push(self, data):
+        """
+        Queue one frame.
+
+        :param data: the frame data
+        :type data: bytes
+
+        :return: False if the queue went over the high water mark
+        :rtype: bool
+        """
+        data_len = struct.pack(PACK_SIGN, socket.htonl(len(data)))
+        with self.lock:
+            self.buffers.append(memoryview(data_len))
+            self.buffers.append(memoryview(data))
+            self.pending += INT_SIZE + len(data)
+            if self.pending > self.high_water:
+                self.paused = True
+            return not self.paused
+
+    def push_frame(self, frame):
+        """
+        Queue one frame that already starts with its length prefix (AESCryptGCM.encrypt_frame),
+        a single buffer instead of a prefix and a data buffer.
+
+        :param frame: the whole frame
+        :type frame: bytes or memoryview
+
+        :return: False if the queue went over the high water mark
+        :rtype: bool
+        """
+        with self.lock:
+            self.buffers.append(memoryview(frame))
+            self.pending += len(frame)
+            if self.pending > self.high_water:
+                self.paused = True
+            return not self.paused
+
+    def flush(self, sock):
+        """
+        Send as much of the queue as the socket takes without blocking.
+
+        :param sock: the non-blocking socket to send on
+        :type sock: socket.socket
+
+        :return: True if the queue is empty
+        :rtype: bool
+
+        :raises socket.error: if the connection is broken
+        """
+        with self.lock:
+            while self.buffers:
+                batch = [self.buffers[i] for i in range(min(len(self.buffers), MAX_SEND_BUFFERS))]
+                try:
+                    if hasattr(sock, 'sendmsg'):
+                        sent = sock.sendmsg(batch)
+                    else:
+                        # no scatter-gather on this platform - one copy, still one syscall
+                        sent = sock.send(b''.join(batch))
+                except BlockingIOError:
+                    break
+                self.pending -= sent
+                full_send = sent == sum(len(buf) for buf in batch)
+                while self.buffers and len(self.buffers[0]) <= sent:
+                    sent -= len(self.buffers.popleft())
+                if sent:
+                    self.buffers[0] = self.buffers[0][sent:]
+                if not full_send:
+                    break  # the socket buffer is full
+            if self.paused and self.pending < self.low_water:
+                self.paused = False
+            return not self.buffers
+
+    def __len__(self):
+        return self.pending
+
+
 # aes1 = AESCryptGCM()
 #
 # def receiver():
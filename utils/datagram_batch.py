@@ -0,0 +1,285 @@
+import array
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+
+MAX_BATCH = 64  # datagrams per system call
+MAX_PARTS = 2  # buffers a datagram is gathered from (e.g. rtp header + payload)
+_MSG_DONTWAIT = 0x40  # linux
+_WORD = 'L' if array.array('L').itemsize == ctypes.sizeof(ctypes.c_size_t) else 'Q'  # iovec fields
+_EMPTY_PARTS = [(0, 0) * (MAX_PARTS - n) for n in range(MAX_PARTS + 1)]
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    """
+    :return: libc with sendmmsg / recvmmsg set up, None where they don't exist
+    :rtype: ctypes.CDLL or None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg, recvmmsg = libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+HAVE_MMSG = _libc is not None
+
+
+def buffer_address(buf, keep):
+    """
+    :param buf: bytes, bytearray or memoryview
+    :param keep: Gets what has to stay alive while the address is used
+    :type keep: list
+
+    :return: Address of the buffer's first byte
+    :rtype: int
+    """
+    if isinstance(buf, bytes):
+        pointer = ctypes.c_char_p(buf)  # points into the bytes object, no copy
+        keep.append(pointer)
+        return ctypes.cast(pointer, ctypes.c_void_p).value or 0
+    try:
+        # the first byte is enough to get the address, and it holds the buffer's export
+        first = ctypes.c_char.from_buffer(buf) if len(buf) else (ctypes.c_char * 0).from_buffer(buf)
+    except TypeError:
+        buf = bytes(buf)  # read only view - copy
+        return buffer_address(buf, keep)
+    keep.append(first)
+    return ctypes.addressof(first)
+
+
+class DatagramBatcher:
+    def __init__(self, sock, batch=MAX_BATCH, use_mmsg=HAVE_MMSG):
+        """
+        Sends and receives batches of datagrams on a udp socket - with one sendmmsg / recvmmsg
+        call per batch where the platform has them, else with a tight loop of sendmsg / sendto
+        and recv_into.
+
+        :param sock: IPv4 udp socket. Receiving makes it non blocking
+        :type sock: socket.socket
+        :param batch: Most datagrams per system call
+        :type batch: int
+        :param use_mmsg: Use sendmmsg / recvmmsg if they exist
+        :type use_mmsg: bool
+        """
+        self.sock = sock
+        self.batch = batch
+        self.use_mmsg = use_mmsg and _libc is not None and sock.family == socket.AF_INET
+        self._send_msgs = None  # the mmsghdr / iovec arrays, made on first use
+        self._recv_msgs = None
+        self._recv_buffers = [None] * batch  # what the receive iovecs point at, kept alive
+        self._recv_keep = [None] * batch
+        self._addr = None  # last destination and its sockaddr_in
+        self._sockaddr = ctypes.create_string_buffer(16)
+
+    @staticmethod
+    def _messages(batch, parts):
+        msgs = (_MMsgHdr * batch)()
+        iov = (_IOVec * (batch * parts))()
+        for i in range(batch):
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iov[i * parts])
+            msgs[i].msg_hdr.msg_iovlen = parts
+        return msgs, iov
+
+    def _set_destination(self, addr):
+        if addr != self._addr:
+            struct.pack_into('=H', self._sockaddr, 0, socket.AF_INET)
+            struct.pack_into('!H4s', self._sockaddr, 2, addr[1], socket.inet_aton(socket.gethostbyname(addr[0])))
+            self._addr = addr
+
+    def send(self, datagrams, addr):
+        """
+        Send datagrams to one address.
+
+        :param datagrams: Every datagram as the (buffer, start, end) parts it is gathered from,
+                          at most MAX_PARTS of them
+        :type datagrams: list[tuple]
+        :param addr: (ip, port)
+        :type addr: tuple
+        """
+        if not self.use_mmsg:
+            self._send_loop(datagrams, addr)
+            return
+        keep, bases = [], {}
+        flat = []
+        for parts in datagrams:
+            if len(parts) > MAX_PARTS:
+                raise ValueError(f"a datagram can be gathered from at most {MAX_PARTS} buffers")
+            for buf, start, end in parts:
+                base = bases.get(id(buf))
+                if base is None:
+                    base = bases[id(buf)] = buffer_address(buf, keep)
+                    keep.append(buf)
+                flat += (base + start, end - start)
+            flat += _EMPTY_PARTS[len(parts)]  # unused iovecs stay empty
+        self._sendmmsg(flat, datagrams, addr)
+
+    def send_split(self, head, head_size, body, bounds, addr):
+        """
+        Send datagrams that are each a fixed size head and a slice of one body - datagram i is
+        head[i * head_size:(i + 1) * head_size] + body[start:end] of bounds[i] (rtp packets of
+        a frame). Cheaper than building the parts for send.
+
+        :param head: The heads one after the other
+        :type head: bytearray
+        :param head_size: Size of a head
+        :type head_size: int
+        :param body: What the slices are of
+        :type body: bytes
+        :param bounds: (start, end) of every datagram's slice
+        :type bounds: list[tuple]
+        :param addr: (ip, port)
+        :type addr: tuple
+        """
+        if not self.use_mmsg:
+            self._send_loop([((head, i * head_size, (i + 1) * head_size), (body, start, end))
+                             for i, (start, end) in enumerate(bounds)], addr)
+            return
+        keep = [head, body]
+        head_address = buffer_address(head, keep)
+        body_address = buffer_address(body, keep)
+        flat = []
+        for start, end in bounds:
+            flat += (head_address, head_size, body_address + start, end - start)
+            head_address += head_size
+        self._sendmmsg(flat, None, addr, (head, head_size, body, bounds))
+
+    def _sendmmsg(self, flat, datagrams, addr, split=None):
+        """
+        Send with sendmmsg, MAX_PARTS (base, len) iovec words in flat per datagram. What the
+        socket can't take right now goes through _send_loop, which waits for it.
+        """
+        if self._send_msgs is None:
+            self._send_msgs = self._messages(self.batch, MAX_PARTS)
+            for msg in self._send_msgs[0]:
+                msg.msg_hdr.msg_name = ctypes.addressof(self._sockaddr)
+                msg.msg_hdr.msg_namelen = 16
+        msgs, iov = self._send_msgs
+        self._set_destination(addr)
+        words_per_datagram = 2 * MAX_PARTS
+        total = len(flat) // words_per_datagram
+        fd = self.sock.fileno()
+        # the iovecs are written as plain words in one go - ctypes fields are slow
+        words = memoryview(iov).cast('B').cast(_WORD)
+        try:
+            for first in range(0, total, self.batch):
+                count = min(self.batch, total - first)
+                words[:count * words_per_datagram] = array.array(
+                    _WORD, flat[first * words_per_datagram:(first + count) * words_per_datagram])
+                sent = 0
+                while sent < count:
+                    done = _libc.sendmmsg(fd, ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)), count - sent, 0)
+                    if done >= 0:
+                        sent += done
+                        continue
+                    err = ctypes.get_errno()
+                    if err == errno.EINTR:
+                        continue
+                    if err not in (errno.EAGAIN, errno.ENOBUFS):
+                        raise OSError(err, os.strerror(err))
+                    # let python wait for the socket with the rest
+                    if split is None:
+                        self._send_loop(datagrams[first + sent:], addr)
+                    else:
+                        head, head_size, body, bounds = split
+                        self._send_loop([((head, i * head_size, (i + 1) * head_size), (body, *bounds[i]))
+                                         for i in range(first + sent, total)], addr)
+                    return
+        finally:
+            words.release()
+
+    def _send_loop(self, datagrams, addr):
+        gather = hasattr(self.sock, 'sendmsg')
+        for parts in datagrams:
+            while True:
+                try:
+                    if len(parts) == 1:
+                        buf, start, end = parts[0]
+                        self.sock.sendto(memoryview(buf)[start:end], addr)
+                    elif gather:
+                        self.sock.sendmsg([memoryview(buf)[start:end] for buf, start, end in parts], [], 0, addr)
+                    else:
+                        self.sock.sendto(b''.join(memoryview(buf)[start:end] for buf, start, end in parts), addr)
+                    break
+                except BlockingIOError:
+                    select.select([], [self.sock], [])  # receiving made the socket non blocking
+
+    def recv_into(self, buffers, timeout):
+        """
+        Wait for datagrams and receive as many as are there, each into the next buffer.
+
+        :param buffers: Writable buffers (bytearray), at most batch of them. Reusing the same
+                        buffers across calls saves setting them up again
+        :type buffers: list[bytearray]
+        :param timeout: Seconds to wait for the first datagram
+        :type timeout: float
+
+        :return: The size of every datagram received, [] if none came in time
+        :rtype: list[int]
+        """
+        if self.sock.getblocking():
+            self.sock.setblocking(False)
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return []
+        if not self.use_mmsg:
+            sizes = []
+            for buf in buffers:
+                try:
+                    sizes.append(self.sock.recv_into(buf))
+                except BlockingIOError:
+                    break
+            return sizes
+        if self._recv_msgs is None:
+            msgs, iov = self._recv_msgs = self._messages(self.batch, 1)
+            self._recv_words = memoryview(iov).cast('B').cast(_WORD)
+            # msg_len of message i, as an index of 32 bit words
+            self._recv_lens = memoryview(msgs).cast('B').cast('I')
+            self._len_index = _MMsgHdr.msg_len.offset // 4
+            self._len_step = ctypes.sizeof(_MMsgHdr) // 4
+        msgs, iov = self._recv_msgs
+        words = self._recv_words
+        for i, buf in enumerate(buffers):
+            if self._recv_buffers[i] is not buf:
+                keep = []
+                words[2 * i] = buffer_address(buf, keep)
+                words[2 * i + 1] = len(buf)
+                self._recv_buffers[i] = buf  # also keeps its address from being reused
+                self._recv_keep[i] = keep
+        while True:
+            count = _libc.recvmmsg(self.sock.fileno(), msgs, len(buffers), _MSG_DONTWAIT, None)
+            if count >= 0:
+                return self._recv_lens[self._len_index:self._len_index + count * self._len_step:self._len_step].tolist()
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err == errno.EAGAIN:
+                return []
+            raise OSError(err, os.strerror(err))
@@ -0,0 +1,109 @@
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+from utils.encryption.rsa import RSACrypt
+
+HANDSHAKE_PROCESSES = max(1, (os.cpu_count() or 2) // 2)
+MAX_PENDING_HANDSHAKES = 256  # handshakes queued or running before new ones are refused
+
+_worker_rsa = None  # the private key, loaded once in every pool process
+
+
+def _init_worker(private_pem):
+    global _worker_rsa
+    _worker_rsa = RSACrypt()
+    _worker_rsa.import_private_key(private_pem)
+
+
+def _decrypt_key(encrypted_key):
+    return _worker_rsa.decrypt(encrypted_key)
+
+
+class HandshakePool:
+    def __init__(self, rsa_crypt, processes=HANDSHAKE_PROCESSES, max_pending=MAX_PENDING_HANDSHAKES):
+        """
+        Runs the rsa decrypt of key exchanges in a pool of processes, so a burst of new
+        clients doesn't hold the gil (and every connected client) for the length of the
+        rsa operations. The queue is bounded - when max_pending handshakes are already
+        waiting, new ones are refused and the caller drops the connection.
+
+        :param rsa_crypt: The server's rsa keys
+        :type rsa_crypt: RSACrypt
+        :param processes: Number of pool processes
+        :type processes: int
+        :param max_pending: Max handshakes queued or running
+        :type max_pending: int
+        """
+        # not fork - the server has threads running (and maybe holding locks) when the pool starts,
+        # the workers get the key from initargs and need nothing else from the parent
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_worker,
+            initargs=(rsa_crypt.export_private_key(),)
+        )
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # metrics - lock
+        self.depth = 0  # handshakes queued or running
+        self.peak_depth = 0
+        self.completed = 0
+        self.refused = 0
+
+    def submit(self, encrypted_key):
+        """
+        Queue the decrypt of an rsa encrypted aes key.
+
+        :param encrypted_key: The key the client sent
+        :type encrypted_key: bytes
+
+        :return: Future of the aes key (raises ValueError if the decrypt failed),
+                 None if the queue is full
+        :rtype: concurrent.futures.Future or None
+        """
+        with self.lock:
+            if self.depth >= self.max_pending:
+                self.refused += 1
+                return None
+            self.depth += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+        try:
+            future = self.executor.submit(_decrypt_key, bytes(encrypted_key))
+        except RuntimeError:  # shut down
+            self._done(None)
+            return None
+        future.add_done_callback(self._done)
+        return future
+
+    def decrypt(self, encrypted_key):
+        """
+        Decrypt an rsa encrypted aes key in the pool and wait for it. For thread per client servers.
+
+        :param encrypted_key: The key the client sent
+        :type encrypted_key: bytes
+
+        :return: The aes key or None if the queue is full
+        :rtype: bytes or None
+        """
+        future = self.submit(encrypted_key)
+        return future.result() if future else None
+
+    def _done(self, future):
+        with self.lock:
+            self.depth -= 1
+            if future is not None:
+                self.completed += 1
+
+    def stats(self):
+        """
+        :return: The handshake queue metrics
+        :rtype: dict
+        """
+        with self.lock:
+            return {"depth": self.depth, "peak_depth": self.peak_depth,
+                    "completed": self.completed, "refused": self.refused}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,3 +1,5 @@
+import os
+
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Random import get_random_bytes
@@ -17,6 +19,38 @@ class RSACrypt:
     def export_public_key(self):
         return self.public_key.export_key()
 
+    def export_private_key(self):
+        return self.private_key.export_key()
+
+    def import_private_key(self, private_pem):
+        self.private_key = RSA.import_key(private_pem)
+        self.public_key = self.private_key.publickey()
+
+    def load_or_generate(self, path):
+        """
+        Load the key pair from a pem file, or generate one and save it there if the file
+        doesn't exist. Creating is atomic - when several processes start at once only one
+        key is written and all of them end up with it.
+        """
+        try:
+            with open(path, 'rb') as key_file:
+                self.import_private_key(key_file.read())
+            return
+        except FileNotFoundError:
+            pass
+        self.generate_keys()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # private key - owner only
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(self.export_private_key())
+        try:
+            os.link(tmp_path, path)  # fails if another process saved its key first
+        except FileExistsError:
+            with open(path, 'rb') as key_file:
+                self.import_private_key(key_file.read())
+        finally:
+            os.remove(tmp_path)
+
     def import_public_key(self, public_pem):
         self.public_key = RSA.import_key(public_pem)
 
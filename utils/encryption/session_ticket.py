@@ -0,0 +1,146 @@
+import struct
+import time
+
+from Crypto.Hash import HMAC, SHA256
+from Crypto.Random import get_random_bytes
+
+from utils.comms import recv_encrypted, send_encrypted
+from utils.encryption.aes import AESCryptGCM, KEY_SIZE, NONCE_SIZE, TAG_SIZE
+from utils.encryption.rsa import RSACrypt
+
+TICKET_LIFETIME = 24 * 3600  # seconds a session can be resumed for
+TICKET_REQUEST = b"T"  # sent after the aes key (inside the rsa block) by clients that want tickets
+TICKET_PREFIX = b"TKT1"  # ticket frame (encrypted with the session key): prefix + ticket
+RESUME_MAGIC = b"RSM1"  # resume frame (plain): magic + client nonce + ticket
+RESUME_NONCE_SIZE = 16
+RESUME_REJECTED = b"RSM-NO"  # plain answer to a resume the server can't accept
+_TICKET_TIME = struct.Struct("!d")
+TICKET_SIZE = NONCE_SIZE + KEY_SIZE + _TICKET_TIME.size + TAG_SIZE
+RESUME_FRAME_SIZE = len(RESUME_MAGIC) + RESUME_NONCE_SIZE + TICKET_SIZE  # never the size of an rsa block
+
+
+def derive_resumed_key(key, nonce):
+    """
+    Key of a resumed session - HMAC-SHA256 of the client's nonce with the previous session key.
+
+    :param key: Key of the session the ticket was issued for
+    :type key: bytes
+    :param nonce: The client's resume nonce
+    :type nonce: bytes
+
+    :return: The new session key
+    :rtype: bytes
+    """
+    return HMAC.new(key, bytes(nonce), SHA256).digest()
+
+
+def is_resume_frame(frame):
+    return len(frame) == RESUME_FRAME_SIZE and bytes(frame[:len(RESUME_MAGIC)]) == RESUME_MAGIC
+
+
+def split_key_exchange(plaintext):
+    """
+    Split the rsa decrypted key exchange of a client.
+
+    :param plaintext: The decrypted rsa block
+    :type plaintext: bytes
+
+    :return: The aes key and whether the client wants session tickets
+    :rtype: tuple[bytes, bool]
+    """
+    if len(plaintext) == KEY_SIZE + len(TICKET_REQUEST) and plaintext.endswith(TICKET_REQUEST):
+        return plaintext[:KEY_SIZE], True
+    return plaintext, False
+
+
+class TicketIssuer:
+    def __init__(self, key=None, lifetime=TICKET_LIFETIME):
+        """
+        Server side of session resumption. A ticket is the session key and its issue time,
+        encrypted with a key only the server has, so the server keeps no state per session.
+        A client that presents its ticket and a fresh nonce gets a new session key
+        (derive_resumed_key) for one aes decrypt and one hmac instead of an rsa decrypt.
+
+        :param key: The ticket key - servers that share it accept each other's tickets
+        :type key: bytes or None
+        :param lifetime: Seconds a ticket is valid for
+        :type lifetime: int
+        """
+        self.cipher = AESCryptGCM(key)
+        self.lifetime = lifetime
+
+    def issue(self, session_key):
+        """
+        :return: The ticket frame for a session, to send encrypted with the session key
+        :rtype: bytes
+        """
+        return TICKET_PREFIX + self.cipher.encrypt(session_key + _TICKET_TIME.pack(time.time()))
+
+    def resume(self, frame):
+        """
+        Check a resume frame and derive the key of the resumed session.
+
+        :param frame: The resume frame the client sent
+        :type frame: bytes or memoryview
+
+        :return: The new session key or None if the ticket isn't valid (forged or expired)
+        :rtype: bytes or None
+        """
+        if not is_resume_frame(frame):
+            return None
+        frame = bytes(frame)
+        nonce_end = len(RESUME_MAGIC) + RESUME_NONCE_SIZE
+        try:
+            payload = self.cipher.decrypt(frame[nonce_end:])
+        except ValueError:
+            return None
+        key, issued = payload[:KEY_SIZE], _TICKET_TIME.unpack(payload[KEY_SIZE:])[0]
+        if time.time() - issued > self.lifetime:
+            return None
+        return derive_resumed_key(key, frame[len(RESUME_MAGIC):nonce_end])
+
+
+def client_key_exchange(sock, session=None):
+    """
+    Client side of the key exchange. Resumes the previous session if there is one,
+    otherwise (or if the server refuses the ticket) does the rsa exchange and asks for a ticket.
+
+    :param sock: Socket connected to the server
+    :type sock: socket.socket
+    :param session: (aes key, ticket) of the previous connection
+    :type session: tuple or None
+
+    :return: The session encryption and the (aes key, ticket) to resume it next time (ticket may be None),
+             or None if the connection failed
+    :rtype: tuple[AESCryptGCM, tuple] or None
+    """
+    rsa_key = recv_encrypted(sock)  # the server always starts with its public key
+    if rsa_key == b'':
+        return None
+    if session and session[1]:
+        nonce = get_random_bytes(RESUME_NONCE_SIZE)
+        send_encrypted(sock, RESUME_MAGIC + nonce + session[1])
+        answer = recv_encrypted(sock)
+        if answer == b'':
+            return None
+        if answer != RESUME_REJECTED:
+            aes_obj = AESCryptGCM(derive_resumed_key(session[0], nonce))
+            return aes_obj, (aes_obj.key, _read_ticket(aes_obj, answer))
+        # ticket expired or from another server - full exchange on the same connection
+
+    aes_obj = AESCryptGCM()
+    rsa = RSACrypt()
+    rsa.import_public_key(rsa_key)
+    send_encrypted(sock, rsa.encrypt(aes_obj.export_key() + TICKET_REQUEST))
+    answer = recv_encrypted(sock)
+    if answer == b'':
+        return None
+    return aes_obj, (aes_obj.key, _read_ticket(aes_obj, answer))
+
+
+def _read_ticket(aes_obj, frame):
+    try:
+        data = aes_obj.decrypt(frame)
+    except ValueError:
+        return None
+    return data[len(TICKET_PREFIX):] if data.startswith(TICKET_PREFIX) else None
@@ -0,0 +1,247 @@
+import base64
+import hashlib
+import hmac
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+CRYPTO_SUITE = "AES_CM_128_HMAC_SHA1_80"  # the sdp (a=crypto) name of the suite
+MASTER_KEY_SIZE = 16
+MASTER_SALT_SIZE = 14
+AUTH_KEY_SIZE = 20
+SRTP_TAG_SIZE = 10  # hmac-sha1 truncated to 80 bits, room for it is left at the end of every packet
+RTP_HEADER_SIZE = 12
+REPLAY_WINDOW = 64  # packets behind the highest index that are still accepted (once)
+_BLOCK_SIZE = 16
+_MAX_BLOCKS = 4096  # keystream blocks per packet - 64KB, more than any udp packet
+# block j of a packet is encrypted counter iv + j. the iv's low 16 bits are 0, so iv + j = iv ^ j
+# and all the counters of a packet are one xor of the iv repeated with this table
+_BLOCK_INDEXES = b''.join(j.to_bytes(_BLOCK_SIZE, 'big') for j in range(_MAX_BLOCKS))
+_LABEL_ENCRYPTION, _LABEL_AUTH, _LABEL_SALT = 0, 1, 2
+
+
+def _derive(master_key, master_salt, label, size):
+    """
+    Session key derivation of rfc 3711 (key derivation rate 0) - aes-cm keystream of the
+    master key at iv (label << 48 ^ master salt) << 16.
+    """
+    x = (label << 48) ^ int.from_bytes(master_salt, 'big')
+    cipher = AES.new(master_key, AES.MODE_CTR, nonce=b'', initial_value=(x << 16).to_bytes(_BLOCK_SIZE, 'big'))
+    return cipher.encrypt(bytes(size))
+
+
+def _header_size(packet):
+    """
+    :return: size of the rtp header - fixed header, csrcs and the extension
+    :rtype: int
+    """
+    size = RTP_HEADER_SIZE + 4 * (packet[0] & 0x0F)
+    if packet[0] & 0x10:
+        size += 4 + 4 * int.from_bytes(packet[size + 2:size + 4], 'big')
+    return size
+
+
+def _xor_into(view, keystream):
+    """
+    view ^= keystream in place. One big int xor instead of a python loop over the bytes.
+    """
+    size = len(view)
+    view[:] = (int.from_bytes(view, 'big') ^ int.from_bytes(keystream[:size], 'big')).to_bytes(size, 'big')
+
+
+class SRTPContext:
+    def __init__(self, master_key=None, master_salt=None):
+        """
+        SRTP (rfc 3711, AES_CM_128_HMAC_SHA1_80) for one direction of a media stream.
+        The keystream of a packet is keyed on its ssrc and index (roll over counter and
+        sequence number) and the packets are authenticated with a truncated hmac tag.
+
+        Packets are processed in place, in batches - the keystream of a whole batch
+        (e.g. all the packets of a video frame) is made by one aes call with a cipher
+        that is set up once, instead of a cipher object and an hmac key per packet.
+
+        :param master_key: The master key, random if None
+        :type master_key: bytes or None
+        :param master_salt: The master salt, random if None
+        :type master_salt: bytes or None
+        """
+        self.master_key = master_key if master_key else get_random_bytes(MASTER_KEY_SIZE)
+        self.master_salt = master_salt if master_salt else get_random_bytes(MASTER_SALT_SIZE)
+        enc_key = _derive(self.master_key, self.master_salt, _LABEL_ENCRYPTION, MASTER_KEY_SIZE)
+        auth_key = _derive(self.master_key, self.master_salt, _LABEL_AUTH, AUTH_KEY_SIZE)
+        salt = _derive(self.master_key, self.master_salt, _LABEL_SALT, MASTER_SALT_SIZE)
+        self.cipher = AES.new(enc_key, AES.MODE_ECB)  # encrypts the counter blocks
+        self.mac = hmac.new(auth_key, digestmod=hashlib.sha1)  # keyed once, copied per packet
+        self.salt = int.from_bytes(salt, 'big') << 16
+        # receiving side: ssrc -> [roll over counter, highest sequence number, replay bitmask]
+        self.streams = {}
+
+    @staticmethod
+    def from_crypto_attribute(value):
+        """
+        Context for the key of an sdp crypto attribute (rfc 4568), e.g.
+        '1 AES_CM_128_HMAC_SHA1_80 inline:<base64 of key + salt>'.
+
+        :param value: The attribute value (after a=crypto:)
+        :type value: str
+
+        :return: The context or None if the suite isn't supported or the key isn't valid
+        :rtype: SRTPContext or None
+        """
+        parts = value.split()
+        if len(parts) < 3 or parts[1] != CRYPTO_SUITE or not parts[2].startswith("inline:"):
+            return None
+        try:
+            key_salt = base64.b64decode(parts[2][len("inline:"):].split('|')[0], validate=True)
+        except ValueError:
+            return None
+        if len(key_salt) != MASTER_KEY_SIZE + MASTER_SALT_SIZE:
+            return None
+        return SRTPContext(key_salt[:MASTER_KEY_SIZE], key_salt[MASTER_KEY_SIZE:])
+
+    def crypto_attribute(self, tag=1):
+        """
+        :return: The sdp crypto attribute value of this context's key
+        :rtype: str
+        """
+        key = base64.b64encode(self.master_key + self.master_salt).decode()
+        return f"{tag} {CRYPTO_SUITE} inline:{key}"
+
+    def _counters(self, ssrc, index, size):
+        """
+        :return: The counter blocks of size bytes of keystream for a packet
+        :rtype: bytes
+        """
+        blocks = -(-size // _BLOCK_SIZE)
+        iv = (self.salt ^ (ssrc << 64) ^ (index << 16)).to_bytes(_BLOCK_SIZE, 'big')
+        counters_size = blocks * _BLOCK_SIZE
+        return (int.from_bytes(iv * blocks, 'big') ^
+                int.from_bytes(_BLOCK_INDEXES[:counters_size], 'big')).to_bytes(counters_size, 'big')
+
+    def _crypt_batch(self, views, indexes):
+        """
+        Encrypt / decrypt the payloads of a batch of packets in place.
+
+        :param views: (packet, payload start, payload end) of every packet
+        :type views: list[tuple]
+        :param indexes: The index of every packet
+        :type indexes: list[int]
+        """
+        counters = [self._counters(int.from_bytes(packet[8:12], 'big'), index, end - start)
+                    for (packet, start, end), index in zip(views, indexes)]
+        keystream = memoryview(self.cipher.encrypt(b''.join(counters)))
+        offset = 0
+        for (packet, start, end), packet_counters in zip(views, counters):
+            _xor_into(packet[start:end], keystream[offset:])
+            offset += len(packet_counters)
+
+    def _tag(self, packet, end, roc):
+        """
+        Auth tag of packet[:end] + roc. The roc is written into the tag room so the
+        authenticated data never has to be copied.
+        """
+        packet[end:end + 4] = roc.to_bytes(4, 'big')
+        mac = self.mac.copy()
+        mac.update(packet[:end + 4])
+        return mac.digest()[:SRTP_TAG_SIZE]
+
+    def protect_batch(self, packets, indexes):
+        """
+        Encrypt and authenticate a batch of rtp packets in place. Every packet has
+        SRTP_TAG_SIZE bytes of room for its tag at the end.
+
+        :param packets: The rtp packets
+        :type packets: list[bytearray]
+        :param indexes: The index of every packet - roll over counter << 16 | sequence number
+        :type indexes: list[int] or range
+
+        :return: The srtp packets (views of packets), ready to send
+        :rtype: list[memoryview]
+        """
+        views = []
+        for packet in packets:
+            packet = memoryview(packet)
+            views.append((packet, _header_size(packet), len(packet) - SRTP_TAG_SIZE))
+        self._crypt_batch(views, indexes)
+        for (packet, start, end), index in zip(views, indexes):
+            packet[end:] = self._tag(packet, end, index >> 16)
+        return [packet for packet, start, end in views]
+
+    def protect(self, packet, index):
+        return self.protect_batch([packet], [index])[0]
+
+    def _estimate_index(self, ssrc, seq):
+        """
+        Index of a received sequence number (rfc 3711 3.3.1) - the roll over counter is
+        guessed from the highest sequence number seen.
+        """
+        stream = self.streams.get(ssrc)
+        if stream is None:
+            return seq
+        roc, highest = stream[0], stream[1]
+        if highest < 0x8000:
+            guess = roc - 1 if seq - highest > 0x8000 else roc
+        else:
+            guess = roc + 1 if highest - 0x8000 > seq else roc
+        return (guess << 16) | seq
+
+    def _replayed(self, ssrc, index):
+        stream = self.streams.get(ssrc)
+        if stream is None:
+            return False
+        highest = (stream[0] << 16) | stream[1]
+        if index > highest:
+            return False
+        behind = highest - index
+        return behind >= REPLAY_WINDOW or bool(stream[2] >> behind & 1)
+
+    def _accept(self, ssrc, index):
+        stream = self.streams.get(ssrc)
+        if stream is None:
+            self.streams[ssrc] = [index >> 16, index & 0xFFFF, 1]
+            return
+        highest = (stream[0] << 16) | stream[1]
+        if index > highest:
+            shift = index - highest
+            stream[0], stream[1] = index >> 16, index & 0xFFFF
+            stream[2] = ((stream[2] << shift) | 1) & ((1 << REPLAY_WINDOW) - 1)
+        else:
+            stream[2] |= 1 << (highest - index)
+
+    def unprotect_batch(self, packets):
+        """
+        Authenticate and decrypt a batch of received srtp packets in place. Packets that
+        are too short, replayed or fail authentication are dropped.
+
+        :param packets: The received packets
+        :type packets: list[bytearray or memoryview]
+
+        :return: For every packet a view of the rtp packet (without the tag) or None if it was dropped
+        :rtype: list[memoryview or None]
+        """
+        views, indexes, results = [], [], []
+        for packet in packets:
+            packet = memoryview(packet)
+            end = len(packet) - SRTP_TAG_SIZE
+            if end < RTP_HEADER_SIZE or _header_size(packet) > end:
+                results.append(None)
+                continue
+            ssrc = int.from_bytes(packet[8:12], 'big')
+            index = self._estimate_index(ssrc, int.from_bytes(packet[2:4], 'big'))
+            if self._replayed(ssrc, index):
+                results.append(None)
+                continue
+            tag = bytes(packet[end:])
+            if not hmac.compare_digest(self._tag(packet, end, index >> 16), tag):
+                results.append(None)
+                continue
+            self._accept(ssrc, index)
+            views.append((packet, _header_size(packet), end))
+            indexes.append(index)
+            results.append(packet[:end])
+        if views:
+            self._crypt_batch(views, indexes)
+        return results
+
+    def unprotect(self, packet):
+        return self.unprotect_batch([packet])[0]
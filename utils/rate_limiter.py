@@ -0,0 +1,216 @@
+import time
+from abc import ABC, abstractmethod
+from array import array
+
+EVICT_BATCH = 256  # slots looked at per evict() call
+
+
+class SlotStore:
+    def __init__(self, fields):
+        """
+        Compact per key state for the rate limiters. Every key gets a slot index and each
+        state field is one array of doubles indexed by slot, so a key costs a dict entry and
+        a few floats instead of a python object. Freed slots are reused.
+
+        :param fields: number of float fields per key
+        :type fields: int
+        """
+        self.slots = {}  # key -> slot index
+        self.keys = []  # slot index -> key (None if free)
+        self.columns = [array('d') for _ in range(fields)]
+        self.free = []  # free slot indexes
+        self.cursor = 0  # where the next incremental eviction continues
+
+    def get(self, key):
+        """
+        :return: the slot of key or None if it has no state
+        :rtype: int
+        """
+        return self.slots.get(key)
+
+    def add(self, key):
+        """
+        Give key a slot, its fields start at 0.
+
+        :return: the new slot
+        :rtype: int
+        """
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+            for column in self.columns:
+                column[slot] = 0.0
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            for column in self.columns:
+                column.append(0.0)
+        self.slots[key] = slot
+        return slot
+
+    def remove(self, key):
+        """
+        Free the slot of key (if it has one).
+        """
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.keys[slot] = None
+            self.free.append(slot)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+
+class RateLimiter(ABC):
+    def __init__(self, limit, window, fields):
+        """
+        Base of the rate limiters - allows limit events per window seconds for every key,
+        with bursts of up to limit events. Not thread safe, callers lock.
+
+        :param limit: events allowed per window
+        :type limit: int
+        :param window: window length in seconds
+        :type window: float
+        :param fields: float fields of state per key
+        :type fields: int
+        """
+        self.limit = limit
+        self.window = window
+        self.store = SlotStore(fields)
+
+    @abstractmethod
+    def allow(self, key, cost=1, now=None):
+        """
+        Count an event of key and check it against the limit. O(1).
+
+        :param key: what is limited (ip, socket...)
+        :type key: hashable
+        :param cost: how many events this is
+        :type cost: int
+        :param now: time.monotonic() value, taken if not given
+        :type now: float
+
+        :return: True if the event is within the limit
+        :rtype: bool
+        """
+        pass
+
+    @abstractmethod
+    def _idle(self, slot, now):
+        """
+        :return: True if the state of slot is back to the initial state (may be dropped)
+        :rtype: bool
+        """
+        pass
+
+    def forget(self, key):
+        """
+        Drop the state of key.
+        """
+        self.store.remove(key)
+
+    def evict(self, now=None, batch=EVICT_BATCH):
+        """
+        Incremental eviction - looks at the next batch slots and drops the keys that are idle.
+        Calling it periodically walks the whole store without ever doing a full sweep at once.
+
+        :param now: time.monotonic() value, taken if not given
+        :type now: float
+        :param batch: max slots to look at
+        :type batch: int
+
+        :return: number of evicted keys
+        :rtype: int
+        """
+        now = time.monotonic() if now is None else now
+        store = self.store
+        size = len(store.keys)
+        if not size:
+            return 0
+        evicted = 0
+        slot = store.cursor % size
+        for _ in range(min(batch, size)):
+            key = store.keys[slot]
+            if key is not None and self._idle(slot, now):
+                store.remove(key)
+                evicted += 1
+            slot = (slot + 1) % size
+        store.cursor = slot
+        return evicted
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+
+class TokenBucket(RateLimiter):
+    def __init__(self, limit, window):
+        """
+        Token bucket - the bucket holds up to limit tokens and refills at limit / window
+        tokens a second. State per key: tokens, last refill time.
+
+        :param limit: bucket size (events allowed per window)
+        :type limit: int
+        :param window: seconds to refill a whole bucket
+        :type window: float
+        """
+        super().__init__(limit, window, 2)
+        self.rate = limit / window
+
+    def allow(self, key, cost=1, now=None):
+        now = time.monotonic() if now is None else now
+        store = self.store
+        tokens, last = store.columns
+        slot = store.get(key)
+        if slot is None:
+            slot = store.add(key)
+            level = float(self.limit)
+        else:
+            level = min(self.limit, tokens[slot] + (now - last[slot]) * self.rate)
+        last[slot] = now
+        if level < cost:
+            tokens[slot] = level
+            return False
+        tokens[slot] = level - cost
+        return True
+
+    def _idle(self, slot, now):
+        tokens, last = self.store.columns
+        return tokens[slot] + (now - last[slot]) * self.rate >= self.limit
+
+
+class GCRA(RateLimiter):
+    def __init__(self, limit, window):
+        """
+        Generic cell rate algorithm - the token bucket as a single timestamp per key.
+        Every event moves the theoretical arrival time (tat) forward by window / limit and
+        events are refused while tat is more than a whole window ahead.
+
+        :param limit: events allowed per window (burst size)
+        :type limit: int
+        :param window: window length in seconds
+        :type window: float
+        """
+        super().__init__(limit, window, 1)
+        self.interval = window / limit  # emission interval
+
+    def allow(self, key, cost=1, now=None):
+        now = time.monotonic() if now is None else now
+        store = self.store
+        tat, = store.columns
+        slot = store.get(key)
+        if slot is None:
+            slot = store.add(key)
+        new_tat = max(tat[slot], now) + cost * self.interval
+        if new_tat - now > self.window:
+            return False
+        tat[slot] = new_tat
+        return True
+
+    def _idle(self, slot, now):
+        return self.store.columns[0][slot] <= now
@@ -0,0 +1,256 @@
+import numpy as np
+
+from utils.RTP_msgs import RTP_HEADER, PacketType, RTPPacket
+
+# the fixed 12 byte header as it is on the wire
+RTP_HEADER_DTYPE = np.dtype([('first_byte', 'u1'), ('second_byte', 'u1'), ('sequence_number', '>u2'),
+                             ('timestamp', '>u4'), ('ssrc', '>u4')])
+
+# a decoded header and where its payload is in the batch's data
+RTP_FIELDS_DTYPE = np.dtype([('version', 'u1'), ('padding', '?'), ('extension', '?'), ('cc', 'u1'),
+                             ('marker', '?'), ('payload_type', 'u1'), ('sequence_number', 'u2'),
+                             ('timestamp', 'u4'), ('ssrc', 'u4'), ('payload_start', 'i8'),
+                             ('payload_end', 'i8'), ('valid', '?')])
+
+_HEADER_BYTES = np.arange(RTP_HEADER.size)
+
+
+def header_view(buffer, stride=RTP_HEADER.size, count=None):
+    """
+    Structured array over the headers of packets that sit every stride bytes of buffer (e.g. a
+    receive ring of 1500 byte slots). No copy - writing to it writes the buffer.
+
+    :param buffer: The packets
+    :type buffer: bytes or bytearray or memoryview or np.ndarray
+    :param stride: Bytes from one packet to the next
+    :type stride: int
+    :param count: Number of packets, as many as fit if None
+
+    :return: A RTP_HEADER_DTYPE like array (its itemsize is stride)
+    :rtype: np.ndarray
+    """
+    if stride < RTP_HEADER.size:
+        raise ValueError(f"packets are at least {RTP_HEADER.size} bytes apart")
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    if count is None:
+        count = (len(raw) - RTP_HEADER.size) // stride + 1 if len(raw) >= RTP_HEADER.size else 0
+    dtype = np.dtype({'names': RTP_HEADER_DTYPE.names,
+                      'formats': [RTP_HEADER_DTYPE[name] for name in RTP_HEADER_DTYPE.names],
+                      'offsets': [RTP_HEADER_DTYPE.fields[name][1] for name in RTP_HEADER_DTYPE.names],
+                      'itemsize': stride})
+    return np.ndarray((count,), dtype=dtype, buffer=raw, strides=(stride,))
+
+
+def extend_sequence_numbers(sequence_numbers):
+    """
+    Undo the 16 bit wrap of sequence numbers in arrival order - every one is put in the cycle
+    that is closest to the one before it (rfc 3550 a.1 without the probation).
+
+    :param sequence_numbers: 16 bit sequence numbers
+    :type sequence_numbers: np.ndarray
+
+    :return: The extended sequence numbers, the first one is in cycle 0
+    :rtype: np.ndarray
+    """
+    seq = np.asarray(sequence_numbers, dtype=np.int64)
+    if not len(seq):
+        return seq
+    step = np.diff(seq)
+    step = (step + 0x8000) % 0x10000 - 0x8000  # -0x8000 <= step < 0x8000
+    return np.concatenate(([seq[0]], seq[0] + np.cumsum(step)))
+
+
+class RTPBatch:
+    def __init__(self, data, offsets, sizes):
+        """
+        Many rtp packets in one contiguous buffer, decoded and built with one vectorized call
+        instead of a struct call per packet (recordings, replays, whole call statistics).
+
+        :param data: The packets
+        :type data: bytes or bytearray
+        :param offsets: Where every packet starts in data
+        :type offsets: np.ndarray
+        :param sizes: Size of every packet
+        :type sizes: np.ndarray
+        """
+        self.data = data
+        self.raw = np.frombuffer(data, dtype=np.uint8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        if len(self.offsets) != len(self.sizes):
+            raise ValueError("every packet needs an offset and a size")
+        if len(self.sizes) and (self.offsets.min() < 0 or (self.offsets + self.sizes).max() > len(self.raw)):
+            raise ValueError("packets must be inside the data")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def from_datagrams(cls, datagrams):
+        """
+        :param datagrams: Received packets
+        :type datagrams: list[bytes]
+
+        :return: The packets one after the other
+        :rtype: RTPBatch
+        """
+        sizes = np.fromiter(map(len, datagrams), dtype=np.int64, count=len(datagrams))
+        return cls(b''.join(datagrams), np.cumsum(sizes) - sizes, sizes)
+
+    @classmethod
+    def from_slots(cls, buffer, stride, sizes):
+        """
+        :param buffer: Packets every stride bytes, like a receive ring
+        :param stride: Bytes from one packet to the next
+        :type stride: int
+        :param sizes: Size of every packet
+        :type sizes: list[int] or np.ndarray
+
+        :return: The packets, without copying them
+        :rtype: RTPBatch
+        """
+        sizes = np.asarray(sizes, dtype=np.int64)
+        return cls(buffer, np.arange(len(sizes), dtype=np.int64) * stride, sizes)
+
+    @classmethod
+    def from_packets(cls, packets):
+        """
+        :param packets: Packets to put in one buffer
+        :type packets: list[RTPPacket]
+
+        :return: The built packets
+        :rtype: RTPBatch
+        """
+        if any(packet.padding for packet in packets):
+            # padding depends on every packet's size, build_packet knows it
+            return cls.from_datagrams([packet.build_packet() for packet in packets])
+        return cls.build([packet.payload for packet in packets],
+                         sequence_number=[packet.sequence_number for packet in packets],
+                         timestamp=[packet.timestamp for packet in packets],
+                         ssrc=[packet.ssrc for packet in packets],
+                         marker=[packet.marker for packet in packets],
+                         payload_type=[packet.payload_type for packet in packets],
+                         version=[packet.version for packet in packets],
+                         extension=[packet.extension for packet in packets],
+                         cc=[packet.cc for packet in packets])
+
+    @classmethod
+    def build(cls, payloads, sequence_number, timestamp, ssrc, marker=False,
+              payload_type=PacketType.VIDEO.value, version=0, extension=False, cc=0):
+        """
+        Build packets from their payloads - every header field is one value for all the packets
+        or a value per packet.
+
+        :param payloads: Payload of every packet
+        :type payloads: list[bytes]
+
+        :return: The packets one after the other
+        :rtype: RTPBatch
+        """
+        count = len(payloads)
+        headers = np.empty(count, dtype=RTP_HEADER_DTYPE)
+        headers['first_byte'] = ((np.asarray(version, dtype=np.uint8) & 0x03) << 6
+                                 | np.asarray(extension, dtype=np.uint8) << 4
+                                 | np.asarray(cc, dtype=np.uint8) & 0x0F)
+        headers['second_byte'] = (np.asarray(marker, dtype=np.uint8) << 7
+                                  | np.asarray(payload_type, dtype=np.uint8) & 0x7F)
+        headers['sequence_number'] = np.asarray(sequence_number, dtype=np.int64) & 0xFFFF
+        headers['timestamp'] = np.asarray(timestamp, dtype=np.int64) & 0xFFFFFFFF
+        headers['ssrc'] = np.asarray(ssrc, dtype=np.int64) & 0xFFFFFFFF
+
+        # one join of header, payload, header, payload...
+        header_bytes = headers.tobytes()
+        parts = [None] * (2 * count)
+        parts[0::2] = [header_bytes[i:i + RTP_HEADER.size] for i in range(0, len(header_bytes), RTP_HEADER.size)]
+        parts[1::2] = payloads
+        sizes = np.fromiter(map(len, payloads), dtype=np.int64, count=count) + RTP_HEADER.size
+        return cls(b''.join(parts), np.cumsum(sizes) - sizes, sizes)
+
+    def headers(self):
+        """
+        :return: A copy of the first 12 bytes of every packet (packets that are shorter are zeros)
+        :rtype: np.ndarray of RTP_HEADER_DTYPE
+        """
+        count = len(self)
+        headers = np.zeros(count, dtype=RTP_HEADER_DTYPE)
+        whole = self.sizes >= RTP_HEADER.size
+        if whole.all():
+            rows = self.raw[self.offsets[:, None] + _HEADER_BYTES]
+        else:
+            rows = np.zeros((count, RTP_HEADER.size), dtype=np.uint8)
+            rows[whole] = self.raw[self.offsets[whole, None] + _HEADER_BYTES]
+        headers.view(np.uint8).reshape(count, RTP_HEADER.size)[:] = rows
+        return headers
+
+    def decode(self):
+        """
+        Decode all the headers the way RTPPacket.decode_packet does.
+
+        :return: The fields of every packet, valid is False for malformed ones
+        :rtype: np.ndarray of RTP_FIELDS_DTYPE
+        """
+        headers = self.headers()
+        fields = np.zeros(len(self), dtype=RTP_FIELDS_DTYPE)
+        first, second = headers['first_byte'], headers['second_byte']
+        fields['version'] = first >> 6
+        fields['padding'] = first & 0x20
+        fields['extension'] = first & 0x10
+        fields['cc'] = first & 0x0F
+        fields['marker'] = second & 0x80
+        fields['payload_type'] = second & 0x7F
+        fields['sequence_number'] = headers['sequence_number']
+        fields['timestamp'] = headers['timestamp']
+        fields['ssrc'] = headers['ssrc']
+
+        valid = self.sizes >= RTP_HEADER.size
+        ends = self.offsets + self.sizes
+        padded = fields['padding'] & valid
+        padding_size = np.zeros(len(self), dtype=np.int64)
+        padding_size[padded] = self.raw[ends[padded] - 1]
+        valid &= padding_size <= self.sizes - RTP_HEADER.size
+        fields['payload_start'] = self.offsets + RTP_HEADER.size
+        fields['payload_end'] = ends - padding_size
+        fields['valid'] = valid
+        return fields
+
+    def to_packets(self, fields=None):
+        """
+        :param fields: What decode returned, decoded now if None
+
+        :return: A RTPPacket per packet, None for malformed ones
+        :rtype: list[RTPPacket or None]
+        """
+        if fields is None:
+            fields = self.decode()
+        data = bytes(self.data)
+        columns = [fields[name].tolist() for name in ('version', 'padding', 'extension', 'cc', 'marker',
+                                                      'payload_type', 'sequence_number', 'timestamp',
+                                                      'ssrc', 'payload_start', 'payload_end', 'valid')]
+        packets = []
+        for (version, padding, extension, cc, marker, payload_type, sequence_number, timestamp, ssrc,
+             start, end, valid) in zip(*columns):
+            if not valid:
+                packets.append(None)
+                continue
+            # skips __init__, it would only set the same attributes twice
+            packet = RTPPacket.__new__(RTPPacket)
+            packet.version = version
+            packet.padding = padding
+            packet.extension = extension
+            packet.marker = marker
+            packet.payload_type = payload_type
+            packet.sequence_number = sequence_number
+            packet.ssrc = ssrc
+            packet.timestamp = timestamp
+            packet.cc = cc
+            packet.payload = data[start:end]
+            packets.append(packet)
+        return packets
+
+    def datagrams(self):
+        """
+        :return: Every packet as bytes, ready to send
+        :rtype: list[bytes]
+        """
+        data = bytes(self.data)
+        return [data[start:start + size] for start, size in zip(self.offsets.tolist(), self.sizes.tolist())]
@@ -1,13 +1,114 @@
 import random
-import re
 import string
+import threading
+from collections import OrderedDict
+
+DIRECTIONS = ('sendrecv', 'sendonly', 'recvonly', 'inactive')
+DYNAMIC_PAYLOAD_TYPES = 96  # payload types from here on only mean something with an rtpmap
+ANSWER_CACHE_SIZE = 256  # negotiated answers kept per remote capability set
+# direction -> (we send, we receive) and back
+_DIRECTION_FLAGS = {'sendrecv': (True, True), 'sendonly': (True, False), 'recvonly': (False, True),
+                    'inactive': (False, False), None: (True, True)}
+_FLAGS_DIRECTION = {(True, True): None, (True, False): 'sendonly', (False, True): 'recvonly',
+                    (False, False): 'inactive'}
+
+
+class SDPMedia:
+    __slots__ = ('media_type', 'port', 'profile', 'formats', 'rtpmap', 'fmtp', 'direction', 'crypto', 'ip',
+                 'attributes')
+
+    def __init__(self, media_type, port, formats, profile=None, rtpmap=None, fmtp=None, direction=None,
+                 crypto=None, ip=None, attributes=None):
+        """
+        A media section of an SDP - the m= line and the attributes under it.
+
+        :param media_type: 'audio', 'video' ...
+        :type media_type: str
+        :param port: The port the media is received on, 0 for a rejected media
+        :type port: int
+        :param formats: Payload types / formats in order of preference
+        :type formats: list[str]
+        :param profile: The transport (RTP/AVP ...), None to pick it by the crypto
+        :type profile: str or None
+        :param rtpmap: Payload type -> 'encoding/clock rate[/channels]'
+        :type rtpmap: dict or None
+        :param fmtp: Payload type -> format parameters
+        :type fmtp: dict or None
+        :param direction: sendrecv / sendonly / recvonly / inactive, None for the session's
+        :type direction: str or None
+        :param crypto: The srtp key of the media (a=crypto value, rfc 4568)
+        :type crypto: str or None
+        :param ip: The media's own connection address (media level c=), None for the session's
+        :type ip: str or None
+        :param attributes: Other a= values, kept as is
+        :type attributes: list[str] or None
+        """
+        self.media_type = media_type
+        self.port = port
+        self.profile = profile
+        self.formats = formats
+        self.rtpmap = rtpmap if rtpmap is not None else {}
+        self.fmtp = fmtp if fmtp is not None else {}
+        self.direction = direction
+        self.crypto = crypto
+        self.ip = ip
+        self.attributes = attributes if attributes is not None else []
+
+    @property
+    def format(self):
+        return ' '.join(self.formats)
+
+    def codec(self, fmt):
+        """
+        :return: What a format means, to match it against the other side's formats -
+                 static payload types by number, dynamic ones by their rtpmap
+        :rtype: str
+        """
+        if fmt.isdigit() and int(fmt) < DYNAMIC_PAYLOAD_TYPES:
+            return fmt
+        rtpmap = self.rtpmap.get(fmt)
+        if rtpmap:
+            name, _, rate = rtpmap.partition('/')
+            if rate.endswith('/1'):
+                rate = rate[:-2]  # one channel is the default
+            return f"{name.lower()}/{rate}"
+        return fmt.lower()
+
+    def _add_lines(self, lines):
+        lines.append(f"m={self.media_type} {self.port} {self.profile or SDP._profile(self.crypto)} {self.format}")
+        if self.ip:
+            lines.append(f"c=IN IP4 {self.ip}")
+        for fmt in self.formats:
+            if fmt in self.rtpmap:
+                lines.append(f"a=rtpmap:{fmt} {self.rtpmap[fmt]}")
+            if fmt in self.fmtp:
+                lines.append(f"a=fmtp:{fmt} {self.fmtp[fmt]}")
+        if self.direction:
+            lines.append(f"a={self.direction}")
+        if self.crypto:
+            lines.append(f"a=crypto:{self.crypto}")
+        for attribute in self.attributes:
+            lines.append(f"a={attribute}")
+
+    def __repr__(self):
+        return f"SDPMedia({self.media_type} {self.port} {self.format})"
+
+
+def _media_field(media_type, field):
+    """
+    Property of the first media section of a type, None if there's none
+    """
+    def get(self):
+        media = self.get_media(media_type)
+        return getattr(media, field) if media else None
+    return property(get)
 
 
 class SDP:
-    REQUIRED = {'v', 'o', 'c', 'm'}
-    SDP_FORMAT = r'^[v,o,c,m].*?=.*'
+    REQUIRED = {'v', 'o', 'c', 'm'}  # also what the message may start with
 
-    def __init__(self, version, ip, session_id, video_port=None, video_format=None, audio_port=None, audio_format=None):
+    def __init__(self, version, ip, session_id, video_port=None, video_format=None, audio_port=None, audio_format=None,
+                 video_crypto=None, audio_crypto=None, media=None, direction=None, attributes=None):
         """
         Initializes an SDP object with the given session and media details.
 
@@ -31,71 +132,82 @@ class SDP:
 
         :param audio_format: Optional format(s) for audio media.
         :type audio_format: str or None
+
+        :param video_crypto: Optional srtp key of the video (a=crypto value, rfc 4568).
+        :type video_crypto: str or None
+
+        :param audio_crypto: Optional srtp key of the audio (a=crypto value, rfc 4568).
+        :type audio_crypto: str or None
+
+        :param media: Media sections, after the audio and video ones made of the arguments above.
+        :type media: list[SDPMedia] or None
+
+        :param direction: Session level direction, None for sendrecv.
+        :type direction: str or None
+
+        :param attributes: Other session level a= values.
+        :type attributes: list[str] or None
         """
         self.version = version # usually 0
         self.ip = ip
-        self.video_port = video_port
-        self.video_format = video_format
-        self.audio_port = audio_port
-        self.audio_format = audio_format
         self.session_id = session_id
+        self.direction = direction
+        self.attributes = attributes if attributes is not None else []
+        self.media = []
+        if audio_port and audio_format:
+            self.media.append(SDPMedia('audio', audio_port, audio_format.split(), crypto=audio_crypto))
+        if video_port and video_format:
+            self.media.append(SDPMedia('video', video_port, video_format.split(), crypto=video_crypto))
+        if media:
+            self.media.extend(media)
+
+    audio_port = _media_field('audio', 'port')
+    audio_format = _media_field('audio', 'format')
+    audio_crypto = _media_field('audio', 'crypto')
+    video_port = _media_field('video', 'port')
+    video_format = _media_field('video', 'format')
+    video_crypto = _media_field('video', 'crypto')
+
+    def get_media(self, media_type):
+        """
+        :return: The first media section of a type
+        :rtype: SDPMedia or None
+        """
+        for media in self.media:
+            if media.media_type == media_type:
+                return media
+        return None
+
+    def capabilities(self):
+        """
+        What an answer to this offer depends on - the media, their codecs and directions,
+        without the addresses, ports and keys that change every call.
+
+        :return: Hashable capability set
+        :rtype: tuple
+        """
+        return tuple((media.media_type, media.port != 0, tuple(media.formats), tuple(media.rtpmap.items()),
+                      tuple(media.fmtp.items()), media.direction or self.direction) for media in self.media)
 
     @staticmethod
     def can_parse(msg):
         """
         Validates whether the provided message can be parsed as a valid SDP.
 
-        Checks for required keys, non-empty values, and basic line structure.
-
         :param msg: Raw SDP message as a string.
         :type msg: str
 
         :return: True if the message can be parsed as a valid SDP, False otherwise.
         :rtype: bool
         """
-        try:
-            # Check if the message matches the expected format
-            if not re.match(SDP.SDP_FORMAT, msg):
-                print("Parse failed: Message doesn't match expected format (SDP_FORMAT).")
-                return False
-
-            lines = msg.split("\n")
-            key_set = set()
-            value_set = set()
-
-            for item in lines:
-                if not item.strip():
-                    continue
-                try:
-                    key, value = item.split("=", 1)
-                except ValueError:
-                    print(f"Parse failed: Line missing '=' character → '{item}'")
-                    return False
-
-                key = key.lower()
-                key_set.add(key)
-                value_set.add(value)
-
-            empty_values = {value for value in value_set if value.strip() == ""}
-            if empty_values:
-                print(f"Parse failed: Empty values found → {empty_values}")
-                return False
-
-            # Check if the required keys are present
-            if not SDP.REQUIRED.issubset(key_set):
-                print(f"Parse failed: Missing required keys → {SDP.REQUIRED - key_set}")
-                return False
-
-            return True
-
-        except Exception as err:
-            print(f"Parsing error (unexpected): {err}")
-            return False
+        return SDP.parse(msg) is not None
 
     @staticmethod
     def parse(msg):
         """
-        Parses a raw SDP message string and returns an SDP object.
+        Parses a raw SDP message string and returns an SDP object, in one pass over the lines.
+
+        Checks for the required keys, non-empty values and the line structure on the way.
 
         :param msg: Raw SDP message as a string.
         :type msg: str
@@ -103,104 +215,105 @@ class SDP:
         :return: SDP object if parsing is successful, None otherwise.
         :rtype: SDP or None
         """
-        if not SDP.can_parse(msg):
-            print("Parse failed: Message cannot be parsed (failed can_parse check).")
+        if not msg or msg[0] not in SDP.REQUIRED or '=' not in msg:
+            print("Parse failed: Message doesn't match expected format.")
             return None
-        try:
-            version = None
-            ip = None
-            session_id = None
-            video_port = None
-            video_format = None
-            audio_port = None
-            audio_format = None
-
-            lines = msg.split("\n")
-            for line in lines:
-                if not line.strip():
-                    continue
-                try:
-                    key, value = line.split("=", 1)
-                except ValueError:
-                    print(f"Parse failed: Line missing '=' character → '{line}'")
-                    return None
+        version = None
+        ip = None
+        session_id = None
+        direction = None
+        attributes = []
+        media_list = []
+        media = None  # the m= line attributes belong to
+        has_connection = False
+
+        for line in msg.splitlines():
+            if not line or line.isspace():
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                print(f"Parse failed: Line missing '=' character → '{line}'")
+                return None
+            if not value or value.isspace():
+                print(f"Parse failed: Empty value → '{line}'")
+                return None
+            key = key.lower()
 
-                key = key.lower()
-                if key == 'v':
-                    version = value.strip()
-                    try:
-                        version = int(version)
-                        if version != 0:
-                            print(f"Parse failed: Unsupported version '{version}'")
-                            return None
-                    except ValueError:
-                        print(f"Parse failed: Version is not an integer → '{version}'")
-                        return None
-
-                elif key == 'o':
-                    params = value.split()
-                    if len(params) < 5:
-                        print(f"Parse failed: 'o=' line must have at least 5 parts → '{value}'")
-                        return None
-                    session_id = params[1]
-                    ip_candidate = params[4]
-                    if not ip:
-                        ip = ip_candidate
-                    elif ip != ip_candidate:
-                        print(f"Parse failed: IP mismatch between lines → '{ip}' vs '{ip_candidate}'")
-                        return None
-
-                elif key == 'c':
-                    params = value.split()
-                    if len(params) != 3:
-                        print(f"Parse failed: 'c=' line must have 3 parts → '{value}'")
-                        return None
-                    ip_candidate = params[2]
-                    if not ip:
-                        ip = ip_candidate
-                    elif ip != ip_candidate:
-                        print(f"Parse failed: IP mismatch between lines → '{ip}' vs '{ip_candidate}'")
-                        return None
-
-                elif key == 'm':
-                    parts = value.split()
-                    if len(parts) < 4:
-                        print(f"Parse failed: 'm=' line must have at least 4 parts → '{value}'")
-                        return None
-                    media_type = parts[0]
-                    try:
-                        port = int(parts[1])
-                    except ValueError:
-                        print(f"Parse failed: Port is not an integer → '{parts[1]}'")
-                        return None
-                    format_ids = parts[3:]
-                    fmt = ' '.join(format_ids)
-                    if media_type == 'audio':
-                        audio_port = port
-                        audio_format = fmt
-                    elif media_type == 'video':
-                        video_port = port
-                        video_format = fmt
+            if key == 'a':
+                name, _, attr_value = value.partition(':')
+                if media is None:
+                    if name in DIRECTIONS:
+                        direction = name
                     else:
-                        print(f"Parse failed: Unknown media type → '{media_type}'")
-                        return None
+                        attributes.append(value)
+                elif name == 'rtpmap' or name == 'fmtp':
+                    fmt, _, params = attr_value.partition(' ')
+                    (media.rtpmap if name == 'rtpmap' else media.fmtp)[fmt] = params.strip()
+                elif name in DIRECTIONS:
+                    media.direction = name
+                elif name == 'crypto' and media.crypto is None:
+                    media.crypto = attr_value.strip()
+                else:
+                    media.attributes.append(value)
+
+            elif key == 'm':
+                parts = value.split()
+                if len(parts) < 4:
+                    print(f"Parse failed: 'm=' line must have at least 4 parts → '{value}'")
+                    return None
+                if not parts[1].isdigit():
+                    print(f"Parse failed: Port is not an integer → '{parts[1]}'")
+                    return None
+                media = SDPMedia(parts[0], int(parts[1]), parts[3:], profile=parts[2])
+                media_list.append(media)
 
-            if version is None:
-                print("Parse failed: Missing version ('v=')")
-                return None
-            if ip is None:
-                print("Parse failed: Missing IP address")
-                return None
-            if session_id is None:
-                print("Parse failed: Missing session ID")
-                return None
+            elif key == 'c':
+                params = value.split()
+                if len(params) != 3:
+                    print(f"Parse failed: 'c=' line must have 3 parts → '{value}'")
+                    return None
+                ip_candidate = params[2]
+                has_connection = True
+                if media is not None:
+                    if ip_candidate != ip:
+                        media.ip = ip_candidate
+                elif not ip:
+                    ip = ip_candidate
+                elif ip != ip_candidate:
+                    print(f"Parse failed: IP mismatch between lines → '{ip}' vs '{ip_candidate}'")
+                    return None
 
-            return SDP(version, ip, session_id, video_port, video_format, audio_port, audio_format)
+            elif key == 'o':
+                params = value.split()
+                if len(params) < 5:
+                    print(f"Parse failed: 'o=' line must have at least 5 parts → '{value}'")
+                    return None
+                session_id = params[1]
+                ip_candidate = params[-1]  # rfc 4566 has a session version before the address, ours don't
+                if not ip:
+                    ip = ip_candidate
+                elif ip != ip_candidate:
+                    print(f"Parse failed: IP mismatch between lines → '{ip}' vs '{ip_candidate}'")
+                    return None
 
-        except Exception as err:
-            print(f"Parse error (unexpected): {err}")
+            elif key == 'v':
+                version = value.strip()
+                if not version.isdigit():
+                    print(f"Parse failed: Version is not an integer → '{version}'")
+                    return None
+                version = int(version)
+                if version != 0:
+                    print(f"Parse failed: Unsupported version '{version}'")
+                    return None
+
+        missing = {key for key, seen in (('v', version is not None), ('o', session_id is not None),
+                                         ('c', has_connection), ('m', media_list)) if not seen}
+        if missing:
+            print(f"Parse failed: Missing required keys → {missing}")
             return None
 
+        return SDP(version, ip, session_id, media=media_list, direction=direction, attributes=attributes)
+
     def __str__(self):
         """
         Returns the SDP object as a string representation in standard SDP format.
@@ -209,12 +322,22 @@ class SDP:
         :rtype: str
         """
         lines = [f"v={self.version}", f"o=- {self.session_id} IN IP4 {self.ip}", f"c=IN IP4 {self.ip}"]
-        if self.audio_port and self.audio_format:
-            lines.append(f"m=audio {self.audio_port} RTP/AVP {self.audio_format}")
-        if self.video_port and self.video_format:
-            lines.append(f"m=video {self.video_port} RTP/AVP {self.video_format}")
+        if self.direction:
+            lines.append(f"a={self.direction}")
+        for attribute in self.attributes:
+            lines.append(f"a={attribute}")
+        for media in self.media:
+            media._add_lines(lines)
         return "\n".join(lines)
 
+    @staticmethod
+    def _profile(crypto):
+        """
+        :return: The transport of a media line - RTP/SAVP if the media is encrypted
+        :rtype: str
+        """
+        return "RTP/SAVP" if crypto else "RTP/AVP"
+
     @staticmethod
     def generate_session_id():
         """
@@ -223,4 +346,100 @@ class SDP:
         :return: A random session ID as a string.
         :rtype: str
         """
-        return ''.join(random.choices(string.digits, k=16))
\ No newline at end of file
+        return ''.join(random.choices(string.digits, k=16))
+
+
+class SDPNegotiator:
+    def __init__(self, local_media, cache_size=ANSWER_CACHE_SIZE):
+        """
+        Answers SDP offers (rfc 3264) with the media and codecs we support.
+
+        Every offered media section is answered in order - with the offered formats we also
+        support (in the offer's payload types and order) and the reverse of the offered
+        direction, or with port 0 if there is nothing in common. The negotiated sections
+        are cached by the offer's capability set, so a call from a known kind of client only
+        fills in its ports and keys.
+
+        :param local_media: What we support, a section per media type (the port is ignored)
+        :type local_media: list[SDPMedia]
+        :param cache_size: Capability sets to keep answers for
+        :type cache_size: int
+        """
+        self.local = {media.media_type: media for media in local_media}
+        self.local_codecs = {media.media_type: {media.codec(fmt) for fmt in media.formats}
+                             for media in local_media}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # capabilities -> negotiated sections (ports and keys not filled)
+        self.lock = threading.Lock()
+
+    def answer(self, offer, ip, session_id, ports, crypto=None):
+        """
+        Build the answer to an offer.
+
+        :param offer: The remote's offer
+        :type offer: SDP
+        :param ip: Our media address
+        :type ip: str
+        :param session_id: The session id of the answer
+        :type session_id: str
+        :param ports: Media type -> our receive port
+        :type ports: dict
+        :param crypto: Media type -> our srtp key, only answered for media the offer encrypts
+        :type crypto: dict or None
+
+        :return: The answer
+        :rtype: SDP
+        """
+        crypto = crypto or {}
+        media = []
+        for offered, negotiated in zip(offer.media, self._negotiated(offer)):
+            media_type = negotiated.media_type
+            port = ports.get(media_type) if negotiated.port else 0
+            if not port:
+                media.append(SDPMedia(media_type, 0, list(negotiated.formats), negotiated.profile))
+                continue
+            # copies - the cached sections are shared by every answer to the same capabilities
+            media.append(SDPMedia(media_type, port, list(negotiated.formats), None, dict(negotiated.rtpmap),
+                                  dict(negotiated.fmtp), negotiated.direction,
+                                  crypto.get(media_type) if offered.crypto else None))
+        return SDP(offer.version, ip, session_id, media=media)
+
+    def _negotiated(self, offer):
+        """
+        :return: The negotiated media sections of an offer's capability set, from the cache if it was seen
+        :rtype: list[SDPMedia]
+        """
+        key = offer.capabilities()
+        with self.lock:
+            negotiated = self.cache.get(key)
+            if negotiated is not None:
+                self.cache.move_to_end(key)
+                return negotiated
+        negotiated = [self._negotiate(media, offer.direction) for media in offer.media]
+        with self.lock:
+            self.cache[key] = negotiated
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return negotiated
+
+    def _negotiate(self, offered, session_direction):
+        """
+        :return: The answer to one offered media section - port 1 if accepted, 0 if rejected
+        :rtype: SDPMedia
+        """
+        local = self.local.get(offered.media_type)
+        if local is None or not offered.port:
+            return SDPMedia(offered.media_type, 0, offered.formats[:1], offered.profile)
+        ours = self.local_codecs[offered.media_type]
+        formats = [fmt for fmt in offered.formats if offered.codec(fmt) in ours]
+        if not formats:
+            return SDPMedia(offered.media_type, 0, offered.formats[:1], offered.profile)
+
+        # we send what they receive and receive what they send, as far as we can
+        remote_send, remote_recv = _DIRECTION_FLAGS[offered.direction or session_direction]
+        local_send, local_recv = _DIRECTION_FLAGS[local.direction]
+        direction = _FLAGS_DIRECTION[(remote_recv and local_send, remote_send and local_recv)]
+        return SDPMedia(offered.media_type, 1, formats,
+                        rtpmap={fmt: offered.rtpmap[fmt] for fmt in formats if fmt in offered.rtpmap},
+                        fmtp={fmt: offered.fmtp[fmt] for fmt in formats if fmt in offered.fmtp},
+                        direction=direction)
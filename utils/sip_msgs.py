@@ -1,8 +1,9 @@
-import copy
 import random
 import re
 import string
+import sys
 from enum import Enum
+from typing import NamedTuple, Union
 from abc import ABC, abstractmethod
 
 
@@ -85,11 +86,30 @@ class SIPStatusCode(Enum):
     NOT_ACCEPTABLE_ANYWHERE = (606, "Not Acceptable")
 
 
-SIP_MSG_PATTERN = r"^.*?\r\n([^:]+:[^\r\n]*\r\n)+\r\n"
-REQUEST_START_LINE_PATTERN = r'^[A-Z]+\ssip:.+\sSIP/\d\.\d'
-RESPONSE_START_LINE_PATTERN = r'^SIP/\d\.\d\s\d+\s[A-Za-z\s]+'
 REQUIRED_HEADERS = {'to', 'from', 'call-id', 'cseq', 'content-length'}
 
+# the parser (SIPMsgFactory.parse) - works on bytes, the start line is matched whole by a
+# compiled pattern and the headers are found with find/split, so the cost is linear in the message
+REQUEST_START_LINE = re.compile(rb'([A-Z]+) sip:(\S+) (SIP/\d\.\d)')
+RESPONSE_START_LINE = re.compile(rb'(SIP/\d\.\d) (\d+) ([A-Za-z][^\r\n]*)')
+# the required headers are kept in fields of their own - header name -> field name
+HEADER_FIELDS = {'to': 'to_uri', 'from': 'from_uri', 'call-id': 'call_id', 'cseq': 'cseq',
+                 'content-length': 'content_length'}
+_EAGER_HEADERS = {name.encode(): field for name, field in HEADER_FIELDS.items()}  # parsed right away, the rest on first use
+_METHODS = {member.value: member for member in SIPMethod}
+_STATUS_CODES = {member.value[0]: member for member in SIPStatusCode}
+
+# responses built straight from byte templates (SIPMsgFactory.response_bytes) - only to, from,
+# call-id and cseq are patched in. same bytes as str(create_response_from_request(...)).encode()
+TEMPLATE_STATUS_CODES = {SIPStatusCode.TRYING, SIPStatusCode.RINGING, SIPStatusCode.OK,
+                         SIPStatusCode.UNAUTHORIZED, SIPStatusCode.NOT_FOUND}
+_TEMPLATE_TO = b"to: <sip:"
+_TEMPLATE_FROM = b">\r\nfrom: <sip:"
+_TEMPLATE_CALL_ID = b">\r\ncall-id: "
+_TEMPLATE_CSEQ = b"\r\ncseq: "
+_CRLF = b"\r\n"  # after the cseq and after the extra headers - set_header skips the content-length 0
+_template_start_lines = {}  # (version, status code) -> start line bytes
+
 
 # required headers for sip in my use case: To, From, call-id, cseq, content-length
 # To - where to send
@@ -102,34 +122,181 @@ def generate_random_call_id():
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=16))
 
 
+def sip_method(name):
+    """
+    :param name: A method name, e.g. "INVITE"
+    :type name: str
+
+    :return: The SIPMethod of name, or name itself if it isn't one
+    :rtype: SIPMethod or str
+    """
+    return _METHODS.get(name, name)
+
+
+class CSeq(NamedTuple):
+    """
+    A parsed cseq header - the sequence number and the method (a SIPMethod, or the name of a
+    method this server doesn't know). Indexes like the [num, METHOD] list it replaced.
+    """
+    number: int
+    method: Union[SIPMethod, str]
+
+    @staticmethod
+    def of(value):
+        """
+        :param value: "num METHOD" or a (num, method) pair
+        :type value: CSeq or tuple or list or str
+
+        :return: The cseq of value
+        :rtype: CSeq
+        """
+        if isinstance(value, CSeq):
+            return value
+        if isinstance(value, str):
+            value = value.split()
+        method = value[1]
+        if isinstance(method, str):
+            method = sip_method(method.upper())
+        return CSeq(int(value[0]), method)
+
+    def __str__(self):
+        method = self.method.value if isinstance(self.method, SIPMethod) else self.method
+        return f"{self.number} {method}"
+
+
 class SIPMsg(ABC):
+    # the required headers have slots of their own, any other header goes to an overflow dict
+    # that is only made for messages that have one
+    __slots__ = ('version', 'to_uri', 'from_uri', 'call_id', 'cseq', 'content_length', 'body',
+                 '_extra_headers', '_raw_headers', '_cache', '_cache_bytes', '_cache_state')
+
     def __init__(self):
         """
         Base initializer for SIPMsg. Sets default values for headers and body.
         """
         self.version = None
-        self.headers = {}  # {'to': '', 'from': '', 'call-id': '', 'cseq': (0, ''), 'content-length': 0}
+        self.to_uri = None
+        self.from_uri = None
+        self.call_id = None
+        self.cseq = None  # CSeq
+        self.content_length = None
+        self._extra_headers = None  # {interned name: value} of the other headers
+        self._raw_headers = None  # header lines not parsed yet - parsed on first access
         self.body = None
+        # serialization cache - dropped by the header setters, rebuilt if a field or the body changed
+        self._cache = None
+        self._cache_bytes = None
+        self._cache_state = None
+
+    @property
+    def headers(self):
+        """
+        All the headers as one dict, in the order they are built in. A copy - use set_header
+        and delete_header (or the header fields) to change the message.
+
+        :rtype: dict
+        """
+        if self._raw_headers:
+            self._load_headers()
+        headers = {}
+        for name, value in (('to', self.to_uri), ('from', self.from_uri), ('call-id', self.call_id),
+                            ('cseq', self.cseq)):
+            if value is not None:
+                headers[name] = value
+        if self._extra_headers:
+            headers.update(self._extra_headers)
+        if self.content_length is not None:
+            headers['content-length'] = self.content_length
+        return headers
+
+    @headers.setter
+    def headers(self, headers):
+        for field in HEADER_FIELDS.values():
+            setattr(self, field, None)
+        self._extra_headers = None
+        self._raw_headers = None
+        self._cache = None
+        for key, value in headers.items():
+            self._put_header(key, value)
+
+    def _put_header(self, key, value):
+        """
+        Stores a header in its field, or in the overflow dict under an interned name.
+        """
+        field = HEADER_FIELDS.get(key)
+        if field:
+            setattr(self, field, value)
+        else:
+            if self._extra_headers is None:
+                self._extra_headers = {}
+            self._extra_headers[sys.intern(key)] = value
+
+    def _load_headers(self):
+        """
+        Parse the header lines _parse_bytes left for later into the overflow dict.
+        """
+        raw, self._raw_headers = self._raw_headers, None
+        for line in raw:
+            key, _, value = line.lower().partition(b": ")
+            self._put_header(key.decode(errors='replace'), value.decode(errors='replace'))
 
     @abstractmethod
-    def _can_parse_start_line(self, start_line):
+    def _parse_start_line_bytes(self, start_line):
         """
-        Checks if the given start line can be parsed by the specific SIP message type.
+        Checks and parses the start line in one match.
 
-        :param start_line: The start line of the SIP message.
-        :type start_line: str
+        :param start_line: The start line of the SIP message (without CRLF).
+        :type start_line: bytes
+
+        :return: True if the start line is valid.
+        :rtype: bool
         """
         pass
 
-    @abstractmethod
-    def _parse_start_line(self, start_line):
+    def _parse_bytes(self, data, line_end, headers_end):
         """
-        Parses the start line and extracts its components into internal fields.
+        Parse of a whole message. The required headers are parsed right away,
+        the other header lines are only checked and parsed when first used.
 
-        :param start_line: The start line of the SIP message.
-        :type start_line: str
+        :param data: The message.
+        :type data: bytes
+        :param line_end: Index of the CRLF after the start line.
+        :type line_end: int
+        :param headers_end: Index of the CRLFCRLF after the headers.
+        :type headers_end: int
+
+        :return: True if parsing succeeded, otherwise False.
+        :rtype: bool
         """
-        pass
+        if not self._parse_start_line_bytes(data[:line_end]):
+            return False
+        extras = []
+        for line in data[line_end + 2:headers_end].split(b"\r\n"):
+            key, sep, value = line.partition(b": ")
+            if not sep or not value.strip():
+                return False
+            field = _EAGER_HEADERS.get(key.lower())
+            if field:
+                setattr(self, field, value.lower().decode())
+            else:
+                extras.append(line)
+        self.body = data[headers_end + 4:].decode()
+        self._strip_essential_headers()
+        self._raw_headers = extras
+        return True
+
+    def missing_headers(self, names):
+        """
+        Returns the headers of names the message doesn't have, without parsing the
+        other headers if they are all there.
+
+        :param names: Header names.
+        :type names: set
+
+        :return: The missing header names.
+        :rtype: set
+        """
+        return {name for name in names if self.get_header(name) is None}
 
     @abstractmethod
     def _build_start_line(self):
@@ -141,6 +308,15 @@ class SIPMsg(ABC):
         """
         pass
 
+    @abstractmethod
+    def _start_line_state(self):
+        """
+        The fields the start line is built from, to tell if a cached serialization is stale.
+
+        :rtype: tuple
+        """
+        pass
+
     @abstractmethod
     def can_build(self):
         """
@@ -151,137 +327,83 @@ class SIPMsg(ABC):
     """
         pass
 
-    @staticmethod
-    def is_request(msg):
-        """
-        Determines whether a SIP message is a request (not a response).
-
-        :param msg: The SIP message string.
-        :type msg: str
-
-        :return: True if it is a request, False if it's a response.
-        :rtype: bool
-        """
-        return not bool(re.match(r"^SIP", msg))
-
-    def can_parse(self, msg):
-        """
-        Validates whether the SIP message string can be parsed based on syntax and required headers.
-
-        :param msg: The SIP message string to validate.
-        :type msg: str
-
-        :return: True if the message is syntactically valid and can be parsed, otherwise False.
-        :rtype: bool
-        """
-        try:
-            """checks validity not logic (if headers match what they need"""
-            if re.match(SIP_MSG_PATTERN, msg):
-                headers_part, body_part = msg.split("\r\n\r\n", 1)
-                lines = headers_part.split("\r\n")
-                if self._can_parse_start_line(lines[0]):
-                    key_set = set()
-                    value_set = set()
-                    for item in lines[1:]:
-                        key, value = item.split(": ", 1)  # Split on the first occurrence of ": "
-                        key = key.lower()
-                        key_set.add(key)  # Add the key to the key set
-                        value_set.add(value)  # Add the value to the value set
-                    # key_list = set(item.split(": ") for item in lines[1:])
-                    empty_values = {value for value in value_set if value.strip() == ""}
-                    # REQUIRED_HEADERS.issubset(key_set) and not
-                    if not empty_values:
-                        return True
-
-        except Exception as err:
-            print(f"something went wrong: {err}")
-        return False
-
     def _strip_essential_headers(self):
         """
         Normalizes and transforms key SIP headers into structured internal format.
         """
         # transform <sip:uri> to uri
-        if 'to' in self.headers:
-            self.headers['to'] = self.headers['to'][1:-1].removeprefix("sip:")
-        if 'from' in self.headers:
-            self.headers['from'] = self.headers['from'][1:-1].removeprefix("sip:")
+        if self.to_uri is not None:
+            self.to_uri = self.to_uri[1:-1].removeprefix("sip:")
+        if self.from_uri is not None:
+            self.from_uri = self.from_uri[1:-1].removeprefix("sip:")
 
-        # transform "num METHOD" to (int(num), METHOD)
-        if 'cseq' in self.headers:
-            self.headers['cseq'] = self.headers['cseq'].split()
-            self.headers['cseq'][0] = int(self.headers['cseq'][0])
-            self.headers['cseq'][1] = self.headers['cseq'][1].upper()
+        # transform "num METHOD" to CSeq(int(num), SIPMethod)
+        if self.cseq is not None:
+            self.cseq = CSeq.of(self.cseq)
 
-        if 'content-length' in self.headers:
-            self.headers['content-length'] = int(self.headers['content-length'])
+        if self.content_length is not None:
+            self.content_length = int(self.content_length)
 
     def _build_headers(self):
         """
-        Prepares SIP headers for message construction by transforming internal format to string values.
+        Formats the headers for message construction - the required ones from their fields
+        (uri to <sip:uri>, CSeq to "num METHOD"), then the other headers and the content-length.
 
-        :return: A copy of the headers dictionary formatted for message building, or False if formatting fails.
-        :rtype: dict | bool
-        """
-        # there is some error here!
-        headers_copy = copy.deepcopy(self.headers)
-
-        try:
-            # transform uri to <sip:uri>
-            if 'to' in headers_copy:
-                headers_copy['to'] = "<sip:" + headers_copy['to'] + ">"
-            if 'from' in headers_copy:
-                headers_copy['from'] = "<sip:" + headers_copy['from'] + ">"
-
-            # transform (int(num), METHOD) to "num METHOD"
-            if 'cseq' in headers_copy:
-                headers_copy['cseq'][0] = str(headers_copy['cseq'][0])
-                headers_copy['cseq'] = " ".join(headers_copy['cseq'])
-
-            if 'content-length' in headers_copy:
-                headers_copy['content-length'] = int(headers_copy['content-length'])
-
-            return headers_copy
-        except ValueError as err:
-            print(err)
-            return False
-
-    def parse(self, msg):
-        """
-        Parses a SIP message string into structured components including start line, headers, and body.
-
-        :param msg: The SIP message string to parse.
-        :type msg: str
-
-        :return: True if parsing succeeded, otherwise False.
-        :rtype: bool
+        :return: The header lines, each ending with CRLF.
+        :rtype: str
         """
-        if self.can_parse(msg):
-            headers_part, self.body = msg.split("\r\n\r\n", 1)
-            lines = headers_part.split("\r\n")
-            self._parse_start_line(lines[0])
-            self.headers = dict(item.lower().split(": ") for item in lines[1:])
-            self._strip_essential_headers()
-            return True
-        else:
-            return False
+        if self._raw_headers:
+            self._load_headers()
+        lines = []
+        if self.to_uri is not None:
+            lines.append(f"to: <sip:{self.to_uri}>\r\n")
+        if self.from_uri is not None:
+            lines.append(f"from: <sip:{self.from_uri}>\r\n")
+        if self.call_id is not None:
+            lines.append(f"call-id: {self.call_id}\r\n")
+        if self.cseq is not None:
+            lines.append(f"cseq: {self.cseq}\r\n")
+        if self._extra_headers:
+            lines.extend(f"{key}: {value}\r\n" for key, value in self._extra_headers.items())
+        if self.content_length is not None:
+            lines.append(f"content-length: {int(self.content_length)}\r\n")
+        return "".join(lines)
 
     def __str__(self):
         """
         Builds the SIP message string from internal components if possible.
+        The result is cached until the message changes.
 
         :return: The full SIP message string, or an empty string if build fails.
         :rtype: str | None
         """
+        state = (self._start_line_state(), self.to_uri, self.from_uri, self.call_id, self.cseq,
+                 self.content_length, self.body)
+        if self._cache is not None and self._cache_state == state:
+            return self._cache
+        msg = self._build()
+        self._cache, self._cache_bytes, self._cache_state = msg, None, state
+        return msg
+
+    def to_bytes(self):
+        """
+        The message encoded for sending, cached like __str__.
+
+        :return: The full SIP message, empty if the build fails.
+        :rtype: bytes
+        """
+        msg = str(self)
+        if self._cache_bytes is None:
+            self._cache_bytes = msg.encode() if msg else b""
+        return self._cache_bytes
+
+    def _build(self):
         if not self.can_build():
             print("cannot build")
             return ""
-        msg = self._build_start_line()
-        transformed_headers = self._build_headers()
-        if transformed_headers:
-            for key, value in transformed_headers.items():
-                msg += f"{key}: {value}\r\n"
-            msg += "\r\n"
+        headers = self._build_headers()
+        if headers:
+            msg = self._build_start_line() + headers + "\r\n"
             if self.body:
                 msg += self.body
             return msg
@@ -295,11 +417,16 @@ class SIPMsg(ABC):
         :param key: The name of the header.
         :type key: str
 
-        :param value: The value to assign to the header.
+        :param value: The value to assign to the header. The cseq can be a CSeq, a (num, method) pair or "num METHOD".
         :type value: Any
         """
         if key and value:
-            self.headers[key] = value
+            if key == 'cseq':
+                value = CSeq.of(value)
+            elif key not in HEADER_FIELDS and self._raw_headers:
+                self._load_headers()  # a parsed line of key must not override this value later
+            self._put_header(key, value)
+            self._cache = None
 
     def delete_header(self, key):
         """
@@ -308,20 +435,35 @@ class SIPMsg(ABC):
         :param key: The name of the header to delete.
         :type key: str
         """
-        if key in self.headers:
-            del self.headers[key]
+        field = HEADER_FIELDS.get(key)
+        if field:
+            setattr(self, field, None)
+        else:
+            if self._raw_headers:
+                self._load_headers()
+            if self._extra_headers:
+                self._extra_headers.pop(key, None)
+        self._cache = None
 
     def get_header(self, key):
         """
         Retrieves the value of a SIP header if it exists.
+        The required headers are plain fields (to_uri, from_uri, call_id, cseq, content_length) - hot paths should read those.
 
         :param key: The name of the header.
         :type key: str
 
         :return: The header value if found, otherwise None.
         """
-        if key in self.headers:
-            return self.headers[key]
+        field = HEADER_FIELDS.get(key)
+        if field:
+            return getattr(self, field)
+        if self._extra_headers and key in self._extra_headers:
+            return self._extra_headers[key]
+        if self._raw_headers:
+            self._load_headers()
+            if self._extra_headers:
+                return self._extra_headers.get(key)
         return None
 
     def set_body(self, body):
@@ -332,21 +474,27 @@ class SIPMsg(ABC):
         :type body: str
         """
         self.body = body
-        self.headers['content-length'] = len(body)
+        self.content_length = len(body)
 
 
 class SIPRequest(SIPMsg):
+    __slots__ = ('method', 'uri')
+
     def __init__(self):
         super().__init__()
         self.method = None
         self.uri = None
 
-    def _can_parse_start_line(self, start_line):
-        return bool(re.match(REQUEST_START_LINE_PATTERN, start_line))
+    def _parse_start_line_bytes(self, start_line):
+        match = REQUEST_START_LINE.fullmatch(start_line)
+        if not match:
+            return False
+        method, uri, version = match.groups()
+        self.method, self.uri, self.version = method.decode(), uri.decode(), version.decode()
+        return True
 
-    def _parse_start_line(self, start_line):
-        self.method, self.uri, self.version = start_line.split()
-        self.uri = self.uri.removeprefix("sip:")
+    def _start_line_state(self):
+        return self.method, self.uri, self.version
 
     def _build_start_line(self):
         if self.method and self.uri and self.version:
@@ -362,19 +510,22 @@ class SIPRequest(SIPMsg):
 
 
 class SIPResponse(SIPMsg):
+    __slots__ = ('status_code',)
+
     def __init__(self):
         super().__init__()
         self.status_code = None
 
-    def _can_parse_start_line(self, start_line):
-        return bool(re.match(RESPONSE_START_LINE_PATTERN, start_line))
+    def _parse_start_line_bytes(self, start_line):
+        match = RESPONSE_START_LINE.fullmatch(start_line)
+        if not match:
+            return False
+        self.version = match.group(1).decode()
+        self.status_code = _STATUS_CODES.get(int(match.group(2)))
+        return True
 
-    def _parse_start_line(self, start_line):
-        self.version, code, msg = start_line.split(" ", 2)
-        code_num = int(code)
-        for member in SIPStatusCode:
-            if member.value[0] == code_num:
-                self.status_code = member
+    def _start_line_state(self):
+        return self.status_code, self.version
 
     def _build_start_line(self):
         if self.status_code and self.version:
@@ -395,23 +546,27 @@ class SIPMsgFactory:
     def parse(raw_msg):
         """
         Parses a raw SIP message and returns the appropriate SIP object (request or response).
+        Single pass over the bytes - no regex over the whole message, headers other than the
+        required ones are parsed on first use.
 
-        :param raw_msg: The raw SIP message as a string.
-        :type raw_msg: str
+        :param raw_msg: The raw SIP message.
+        :type raw_msg: bytes or bytearray or memoryview or str
 
         :return: Parsed SIPRequest or SIPResponse object if valid, otherwise None.
         :rtype: Union[SIPRequest, SIPResponse, None]
         """
-        if SIPMsg.is_request(raw_msg):
-            req_object = SIPRequest()
-            if req_object.parse(raw_msg):
-                return req_object
-            return None
-        else:
-            res_object = SIPResponse()
-            if res_object.parse(raw_msg):
-                return res_object
-            return None
+        data = raw_msg.encode() if isinstance(raw_msg, str) else bytes(raw_msg)
+        headers_end = data.find(b"\r\n\r\n")
+        line_end = data.find(b"\r\n")
+        if headers_end <= line_end:
+            return None  # no headers or no end of headers
+        msg_object = SIPResponse() if data.startswith(b"SIP") else SIPRequest()
+        try:
+            if msg_object._parse_bytes(data, line_end, headers_end):
+                return msg_object
+        except (ValueError, IndexError) as err:  # bad cseq / content-length, not utf-8
+            print(f"something went wrong: {err}")
+        return None
 
     @staticmethod
     def create_request(method, version, to_uri, from_uri, call_id, cseq, additional_headers=None, body=None):
@@ -453,7 +608,7 @@ class SIPMsgFactory:
         req_object.set_header('to', to_uri)
         req_object.set_header('from', from_uri)
         req_object.set_header('call-id', call_id)
-        req_object.set_header('cseq', [cseq, method.value])
+        req_object.set_header('cseq', CSeq(cseq, method))
         if additional_headers:
             for key, value in additional_headers.items():
                 req_object.set_header(key, value)
@@ -495,10 +650,10 @@ class SIPMsgFactory:
                 res_object.set_header(key, value)
 
         res_object.version = request.version
-        res_object.set_header('to', request.get_header('from'))
+        res_object.set_header('to', request.from_uri)
         res_object.set_header('from', from_uri)
-        res_object.set_header('call-id', request.get_header('call-id'))
-        res_object.set_header('cseq', request.get_header('cseq'))
+        res_object.set_header('call-id', request.call_id)
+        res_object.set_header('cseq', request.cseq)
 
         if body:
             res_object.set_body(body)
@@ -507,6 +662,50 @@ class SIPMsgFactory:
             res_object.set_header('content-length', 0)
         return res_object
 
+    @staticmethod
+    def response_bytes(request, status_code, from_uri, additional_headers=None, body=None):
+        """
+        create_response_from_request(...).to_bytes() without building a SIPResponse. Common
+        bodiless responses (TEMPLATE_STATUS_CODES) are joined from byte templates with the
+        request's headers patched in, anything else goes through create_response_from_request.
+
+        :param request: The original SIPRequest to respond to.
+        :type request: SIPMsg
+
+        :param status_code: The response status code.
+        :type status_code: SIPStatusCode
+
+        :param from_uri: The URI of the responder.
+        :type from_uri: str
+
+        :param additional_headers: Optional additional SIP headers.
+        :type additional_headers: dict or None
+
+        :param body: Optional SIP message body.
+        :type body: str or None
+
+        :return: The encoded response.
+        :rtype: bytes
+        """
+        to_uri = request.from_uri
+        call_id = request.call_id
+        cseq = request.cseq
+        if (status_code not in TEMPLATE_STATUS_CODES or body or not request.version or not from_uri
+                or not to_uri or not call_id or not cseq
+                or (additional_headers and not REQUIRED_HEADERS.isdisjoint(additional_headers))):
+            return SIPMsgFactory.create_response_from_request(request, status_code, from_uri,
+                                                              additional_headers, body).to_bytes()
+        start_line = _template_start_lines.get((request.version, status_code))
+        if start_line is None:
+            start_line = f"{request.version} {status_code.value[0]} {status_code.value[1]}\r\n".encode()
+            _template_start_lines[(request.version, status_code)] = start_line
+        extra = b""
+        if additional_headers:
+            extra = "".join(f"{key}: {value}\r\n" for key, value in additional_headers.items() if value).encode()
+        return b"".join((start_line, _TEMPLATE_TO, to_uri.encode(), _TEMPLATE_FROM, from_uri.encode(),
+                         _TEMPLATE_CALL_ID, call_id.encode(), _TEMPLATE_CSEQ, str(cseq).encode(), _CRLF,
+                         extra, _CRLF))
+
     @staticmethod
     def create_response(status_code, version, method, cseq, to_uri, from_uri, call_id, additional_headers=None):
         """
@@ -552,7 +751,7 @@ class SIPMsgFactory:
 
         res_object.set_header('call-id', call_id)
 
-        res_object.set_header('cseq', [cseq, method.value])
+        res_object.set_header('cseq', CSeq(cseq, method))
 
         res_object.set_header('content-length', 0)  # assume this is for errors. no body needed
 
@@ -564,7 +763,8 @@ SipMsg
 
 properties:
     - version: version of the sip msg
-    - headers - dict of the headers {str: str} *must include required headers
+    - to_uri, from_uri, call_id, cseq (CSeq), content_length - the required headers, each in its own slot
+    - headers - dict of all the headers {str: str}, the other headers are kept in an overflow dict
     - body - the msg body
 
 functions:
@@ -0,0 +1,301 @@
+import threading
+import time
+
+from utils.sip_msgs import SIPMethod, SIPMsgFactory, SIPRequest
+
+# rfc 3261 17.1.1.1 timer values, in seconds
+T1 = 0.5  # round trip estimate - first retransmission interval
+T2 = 4.0  # longest retransmission interval of non INVITE requests and INVITE responses
+T4 = 5.0  # how long a message may stay in the network
+TRANSACTION_TIMEOUT = 64 * T1  # timers B, F and H - the request (or final response) gave up
+INVITE_PROCEEDING_LIMIT = 180.0  # timer C - an INVITE that is ringing waits this long for the answer
+INVITE_LINGER = 32.0  # timer D - a completed INVITE client transaction absorbs retransmitted responses
+SERVER_LINGER = 64 * T1  # timer J - a server transaction answers retransmitted requests
+MAX_DATAGRAM_SIZE = 65535
+
+
+class UDPPeer:
+    def __init__(self, addr):
+        """
+        Stands in for the socket of a client that talks SIP over UDP, so registrations and calls
+        can hold it like a connected client socket. There is no connection - messages for it
+        go out through the server's transaction layer to addr.
+
+        :param addr: (ip, port) of the client
+        :type addr: tuple
+        """
+        self.addr = addr
+        self.encrypt_obj = None  # plain sip
+        self.last_seen = time.monotonic()
+
+    def getpeername(self):
+        return self.addr
+
+    def close(self):
+        pass  # nothing to close, idle peers are swept by the server
+
+    def __repr__(self):
+        return f"UDPPeer({self.addr[0]}:{self.addr[1]})"
+
+
+class ClientTransaction:
+    def __init__(self, key, data, addr, invite):
+        """
+        A request the server sent over UDP, retransmitted until it is answered.
+
+        :param key: (addr, call-id, cseq number, cseq method)
+        :type key: tuple
+        :param data: The request
+        :type data: bytes
+        :param addr: Where it was sent
+        :type addr: tuple
+        :param invite: INVITE transactions stop retransmitting on a provisional response
+        :type invite: bool
+        """
+        self.key = key
+        self.data = data
+        self.addr = addr
+        self.invite = invite
+        self.interval = T1
+        self.proceeding = False  # got a provisional response
+        self.completed = False  # got a final response
+        self.last_status = None
+        self.retransmit = None  # timer A / E
+        self.timeout = None  # timer B / F (C once an INVITE is ringing), then timer D / K
+
+
+class ServerTransaction:
+    def __init__(self, key, invite):
+        """
+        A request received over UDP. Keeps the last response sent for it, so a retransmitted
+        request is answered again without reaching the handlers.
+
+        :param key: (addr, call-id, cseq number, cseq method)
+        :type key: tuple
+        :param invite: The final response of an INVITE is retransmitted until the ACK comes
+        :type invite: bool
+        """
+        self.key = key
+        self.invite = invite
+        self.response = None  # last response bytes
+        self.interval = T1
+        self.retransmit = None  # timer G
+        self.expiry = None  # timer J (C while an INVITE is ringing, H while waiting for the ACK)
+
+
+class TransactionLayer:
+    def __init__(self, timers, send, on_timeout=None):
+        """
+        RFC 3261 style transactions for SIP over UDP, between the socket and the server's handlers.
+
+        Requests the server sends are retransmitted (timer A for INVITE, E for the rest, doubling
+        from T1) until a response comes, and given up after timer B / F. Retransmitted requests
+        of a client are absorbed - answered with the response already sent, not handled again -
+        and so are retransmitted responses to the server's requests, except a 2xx to an INVITE:
+        it means the ACK was lost, so it goes to the handlers to be ACKed again, and ACKs have
+        no transaction. A final response to an INVITE is retransmitted (timer G) until the
+        client's ACK.
+
+        The messages have no Via branch, so a transaction is matched by peer address, call-id
+        and cseq.
+
+        :param timers: Scheduler of the retransmission and timeout timers
+        :type timers: TimerScheduler
+        :param send: send(data, addr) - puts a datagram on the wire
+        :type send: callable
+        :param on_timeout: on_timeout(addr, data) - called when a request got no final response in time
+        :type on_timeout: callable or None
+        """
+        self.timers = timers
+        self._send = send
+        self.on_timeout = on_timeout
+        self.client = {}  # key -> ClientTransaction
+        self.server = {}  # key -> ServerTransaction
+        self.invites = {}  # (addr, call-id) -> INVITE ServerTransaction waiting for its ACK
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(addr, msg):
+        return addr, msg.call_id, msg.cseq.number, msg.cseq.method
+
+    def receive(self, data, addr):
+        """
+        Handle a received datagram.
+
+        :param data: The datagram
+        :type data: bytes
+        :param addr: The sender
+        :type addr: tuple
+
+        :return: The parsed message if it is new for the handlers, None if it was absorbed or isn't valid
+        :rtype: SIPRequest or SIPResponse or None
+        """
+        msg = SIPMsgFactory.parse(data)
+        if not msg:
+            return None
+        if msg.call_id is None or msg.cseq is None or (not isinstance(msg, SIPRequest) and not msg.status_code):
+            return msg  # can't be matched - the handlers answer it with an error
+        key = self._key(addr, msg)
+        with self.lock:
+            if isinstance(msg, SIPRequest):
+                return self._receive_request(key, msg, addr)
+            return self._receive_response(key, msg)
+
+    def _receive_request(self, key, msg, addr):
+        tx = self.server.get(key)
+        if tx:
+            # retransmission - the client didn't get the response
+            if tx.response is not None:
+                self._send(tx.response, addr)
+            return None
+        if msg.cseq.method is SIPMethod.ACK:
+            invite = self.invites.pop((addr, msg.call_id), None)
+            if invite and invite.retransmit:
+                invite.retransmit.cancel()  # the final response arrived
+            # no transaction - an ACK repeated for a retransmitted 2xx has to reach the handlers too
+            return msg
+        tx = ServerTransaction(key, msg.cseq.method is SIPMethod.INVITE)
+        tx.expiry = self.timers.schedule(SERVER_LINGER, self._expire_server, tx)
+        self.server[key] = tx
+        return msg
+
+    def _receive_response(self, key, msg):
+        tx = self.client.get(key)
+        if tx is None:
+            return msg  # no transaction (gone or never sent) - the handlers check it against the call
+        if tx.invite and tx.completed and 200 <= msg.status_code.value[0] < 300:
+            # a retransmitted 2xx means the ACK was lost - it goes up so the ACK is relayed again
+            # (rfc 3261 17.1.1.2), only non 2xx finals are the transaction's own to absorb
+            return msg
+        if tx.completed or msg.status_code is tx.last_status:
+            return None  # retransmitted response
+        tx.last_status = msg.status_code
+        if msg.status_code.value[0] < 200:
+            if tx.invite and not tx.proceeding:
+                # timer A stops. the callee may ring for a while - timer C instead of B
+                tx.retransmit.cancel()
+                tx.timeout.cancel()
+                tx.timeout = self.timers.schedule(INVITE_PROCEEDING_LIMIT, self._timed_out, tx)
+            tx.proceeding = True
+            return msg
+        tx.completed = True
+        if tx.retransmit:
+            tx.retransmit.cancel()
+        tx.timeout.cancel()
+        # timer D / K - keep absorbing retransmissions of the final response for a while
+        tx.timeout = self.timers.schedule(INVITE_LINGER if tx.invite else T4, self._forget_client, tx)
+        return msg
+
+    def send(self, data, addr, msg=None, status_code=None):
+        """
+        Send a message the handlers built, with the transaction it starts or belongs to.
+
+        :param data: The encoded message
+        :type data: bytes
+        :param addr: The receiver
+        :type addr: tuple
+        :param msg: The message data encodes, or the one it answers when status_code is given.
+                    Only raw bytes (None) are parsed again for their call-id and cseq
+        :type msg: SIPRequest or SIPResponse or None
+        :param status_code: Status of the response data encodes, if msg is what it answers
+        :type status_code: SIPStatusCode or None
+        """
+        if msg is None:
+            msg = SIPMsgFactory.parse(data)
+        if not msg or msg.call_id is None or msg.cseq is None:
+            self._send(data, addr)
+            return
+        if status_code is None and not isinstance(msg, SIPRequest):
+            status_code = msg.status_code
+        key = self._key(addr, msg)
+        with self.lock:
+            if status_code is None:
+                if msg.cseq.method is not SIPMethod.ACK:  # ACK has no response and no transaction
+                    self._start_client(key, data, addr, msg.cseq.method is SIPMethod.INVITE)
+            else:
+                self._respond(key, data, addr, status_code.value[0] >= 200)
+            self._send(data, addr)
+
+    def _start_client(self, key, data, addr, invite):
+        old = self.client.pop(key, None)
+        if old:
+            self._cancel_client(old)
+        tx = ClientTransaction(key, data, addr, invite)
+        tx.retransmit = self.timers.schedule(tx.interval, self._retransmit, tx)
+        tx.timeout = self.timers.schedule(TRANSACTION_TIMEOUT, self._timed_out, tx)
+        self.client[key] = tx
+
+    def _respond(self, key, data, addr, final):
+        tx = self.server.get(key)
+        if tx is None:
+            return  # not an answer to a request received over udp (or it expired)
+        tx.response = data
+        if tx.invite and not final and tx.expiry.remaining() < INVITE_PROCEEDING_LIMIT / 2:
+            tx.expiry.cancel()  # ringing - keep answering retransmitted INVITEs until the answer (timer C)
+            tx.expiry = self.timers.schedule(INVITE_PROCEEDING_LIMIT, self._expire_server, tx)
+        if final and tx.invite and tx.retransmit is None:
+            # timer G until the ACK, timer H gives up
+            tx.retransmit = self.timers.schedule(tx.interval, self._retransmit_response, tx)
+            self.invites[(addr, key[1])] = tx
+            tx.expiry.cancel()
+            tx.expiry = self.timers.schedule(TRANSACTION_TIMEOUT, self._expire_server, tx)
+
+    def _retransmit(self, tx):
+        """Timer A / E"""
+        with self.lock:
+            if tx.completed or self.client.get(tx.key) is not tx or (tx.invite and tx.proceeding):
+                return
+            self._send(tx.data, tx.addr)
+            if tx.invite:
+                tx.interval *= 2
+            else:
+                # a provisional response means the answer is on its way - retransmit at T2 only
+                tx.interval = T2 if tx.proceeding else min(tx.interval * 2, T2)
+            tx.retransmit = self.timers.schedule(tx.interval, self._retransmit, tx)
+
+    def _retransmit_response(self, tx):
+        """Timer G"""
+        with self.lock:
+            if self.server.get(tx.key) is not tx or self.invites.get((tx.key[0], tx.key[1])) is not tx:
+                return
+            self._send(tx.response, tx.key[0])
+            tx.interval = min(tx.interval * 2, T2)
+            tx.retransmit = self.timers.schedule(tx.interval, self._retransmit_response, tx)
+
+    def _timed_out(self, tx):
+        """Timer B / F / C - no final response"""
+        with self.lock:
+            if self.client.get(tx.key) is not tx or tx.completed:
+                return
+            self._cancel_client(tx)
+            del self.client[tx.key]
+        print(f"transaction timed out: {tx.key}")
+        if self.on_timeout:
+            self.on_timeout(tx.addr, tx.data)
+
+    def _forget_client(self, tx):
+        """Timer D / K"""
+        with self.lock:
+            if self.client.get(tx.key) is tx:
+                del self.client[tx.key]
+
+    def _expire_server(self, tx):
+        """Timer J / H"""
+        with self.lock:
+            if self.server.get(tx.key) is tx:
+                del self.server[tx.key]
+            if tx.retransmit:
+                tx.retransmit.cancel()
+            invite_key = (tx.key[0], tx.key[1])
+            if self.invites.get(invite_key) is tx:
+                del self.invites[invite_key]
+
+    @staticmethod
+    def _cancel_client(tx):
+        if tx.retransmit:
+            tx.retransmit.cancel()
+        if tx.timeout:
+            tx.timeout.cancel()
+
+    def __len__(self):
+        return len(self.client) + len(self.server)
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import threading
+import time
+
+COMPACT_MIN = 1024  # cancelled timers before the heap is worth rebuilding
+
+
+class Timer:
+    def __init__(self, scheduler, deadline, callback, args):
+        """
+        A single scheduled callback. Created by TimerScheduler.schedule.
+
+        :param scheduler: the scheduler the timer belongs to
+        :type scheduler: TimerScheduler
+        :param deadline: time.monotonic() value the timer fires at
+        :type deadline: float
+        :param callback: function called when the timer fires
+        :type callback: callable
+        :param args: arguments for the callback
+        :type args: tuple
+        """
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        """
+        Stop the timer from firing. Does nothing if it already fired.
+        """
+        self.scheduler.cancel(self)
+
+    def remaining(self):
+        """
+        :return: seconds until the timer fires
+        :rtype: float
+        """
+        return self.deadline - time.monotonic()
+
+
+class TimerScheduler:
+    def __init__(self, name="timer_scheduler"):
+        """
+        Heap based scheduler that runs every timer of the server on one thread.
+        Scheduling and cancelling are O(log n) / O(1) and a wakeup only touches the timers
+        that actually expired, so the cost doesn't depend on how many timers are waiting.
+
+        :param name: name of the scheduler thread
+        :type name: str
+        """
+        self.name = name
+        self.heap = []  # (deadline, seq, Timer)
+        self.counter = itertools.count()  # tie breaker for equal deadlines
+        self.cond = threading.Condition()
+        self.cancelled = 0  # cancelled timers still in the heap
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the scheduler thread. Timers scheduled before start fire once it runs.
+        """
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread. Timers that didn't fire yet are dropped.
+        """
+        with self.cond:
+            self.running = False
+            self.heap.clear()
+            self.cancelled = 0
+            self.cond.notify()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) on the scheduler thread after delay seconds.
+
+        :param delay: seconds until the timer fires
+        :type delay: float
+        :param callback: function to call
+        :type callback: callable
+
+        :return: the timer, can be cancelled
+        :rtype: Timer
+        """
+        timer = Timer(self, time.monotonic() + delay, callback, args)
+        with self.cond:
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.cond.notify()  # new earliest deadline
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a timer. The heap entry is dropped lazily when it reaches the top, or when
+        enough cancelled entries pile up to rebuild the heap.
+
+        :param timer: the timer to cancel
+        :type timer: Timer
+        """
+        with self.cond:
+            if timer.cancelled or timer.fired:
+                return
+            timer.cancelled = True
+            self.cancelled += 1
+            if self.cancelled > COMPACT_MIN and self.cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    wait_time = self.heap[0][0] - time.monotonic()
+                    if wait_time <= 0:
+                        break
+                    self.cond.wait(wait_time)
+                if not self.running:
+                    return
+
+                expired = []
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    timer = heapq.heappop(self.heap)[2]
+                    if timer.cancelled:
+                        self.cancelled -= 1
+                        continue
+                    timer.fired = True
+                    expired.append(timer)
+
+            # callbacks run without the lock so they can schedule and cancel timers
+            for timer in expired:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as err:
+                    print(f"timer {timer.callback.__name__} failed: {err}")